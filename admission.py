@@ -0,0 +1,183 @@
+"""
+admission.py
+Admission control in front of the LLM stage of the async server.
+
+At most ADMISSION_MAX_IN_FLIGHT conversations call the LLM at once; further
+requests wait in a bounded priority queue (ADMISSION_MAX_QUEUE) for at most
+ADMISSION_QUEUE_TIMEOUT_SECONDS. A request that finds the queue full is shed
+immediately (429) unless it outranks a queued request, which is shed in its
+place; a request whose queue wait runs out gets 503. Both carry a Retry-After
+estimate.
+
+Priority classes, highest first: "interactive", "default", "batch" (selected
+per request with the X-Priority header; /classify/batch defaults to "batch").
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+
+PRIORITIES = {"interactive": 0, "default": 1, "batch": 2}
+
+QUEUE_FULL_ERROR = "Server busy: admission queue full"
+QUEUE_TIMEOUT_ERROR = "Server busy: queue wait deadline exceeded"
+
+_controller = None
+
+
+def priority_class(value):
+    """Normalizes a priority header value; unknown or missing values map to "default"."""
+    value = (value or "").strip().lower()
+    if value in ("live", "chat", "high"):
+        return "interactive"
+    if value in ("backfill", "bulk", "low"):
+        return "batch"
+    return value if value in PRIORITIES else "default"
+
+
+class _Waiter:
+    __slots__ = ("priority", "future", "enqueued_at")
+
+    def __init__(self, priority, future):
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class AdmissionController:
+    """Bounded in-flight count plus a priority wait queue, bound to one event loop."""
+
+    def __init__(self, max_in_flight=64, max_queue=256, queue_timeout=30.0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.loop = asyncio.get_running_loop()
+        self.in_flight = 0
+        # (rank, sequence, waiter); cancelled waiters are skipped lazily
+        self._heap = []
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._service_time = 1.0
+
+    def _export(self):
+        from metrics import REGISTRY
+        REGISTRY.gauge("admission_in_flight", "Conversations admitted to the LLM stage").set(self.in_flight)
+        REGISTRY.gauge("admission_queue_depth", "Conversations waiting for admission").set(self._queued)
+
+    def _reject(self, reason, priority):
+        from metrics import REGISTRY
+        REGISTRY.counter("admission_rejections_total", "Requests shed by admission control", ("reason", "priority")).inc(
+            reason=reason, priority=priority)
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: time to drain the current queue, at least 1."""
+        backlog = self._queued + self.in_flight
+        return max(1, math.ceil(backlog * self._service_time / self.max_in_flight))
+
+    async def acquire(self, priority="default"):
+        """
+        Waits for an LLM slot. Returns None once admitted (call release()
+        afterwards), or an error response when the request is shed.
+        """
+        from metrics import REGISTRY
+        if self.in_flight < self.max_in_flight and not self._queued:
+            self.in_flight += 1
+            self._export()
+            return None
+        rank = PRIORITIES.get(priority, PRIORITIES["default"])
+        if self._queued >= self.max_queue:
+            victim = self._lowest_ranked()
+            if victim is None or PRIORITIES[victim.priority] <= rank:
+                self._reject("queue_full", priority)
+                return {"error": QUEUE_FULL_ERROR}
+            # Make room by shedding a lower-priority waiter
+            victim.future.set_result({"error": QUEUE_FULL_ERROR})
+            self._queued -= 1
+            self._reject("queue_full", victim.priority)
+        waiter = _Waiter(priority, self.loop.create_future())
+        heapq.heappush(self._heap, (rank, next(self._sequence), waiter))
+        self._queued += 1
+        self._export()
+        try:
+            result = await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # Admitted (or shed) just as the deadline passed
+                result = waiter.future.result()
+            else:
+                waiter.future.cancel()
+                self._queued -= 1
+                self._export()
+                self._reject("queue_timeout", priority)
+                result = {"error": QUEUE_TIMEOUT_ERROR}
+        except asyncio.CancelledError:
+            # Client went away while queued: give up the place (or the slot it was just handed)
+            if waiter.future.done() and waiter.future.result() is None:
+                self.release()
+            elif not waiter.future.done():
+                waiter.future.cancel()
+                self._queued -= 1
+                self._export()
+            raise
+        REGISTRY.histogram(
+            "admission_queue_wait_seconds", "Time spent waiting for admission", ("priority",)
+        ).observe(time.perf_counter() - waiter.enqueued_at, priority=priority)
+        return result
+
+    def _lowest_ranked(self):
+        candidates = [entry for entry in self._heap if not entry[2].future.done()]
+        if not candidates:
+            return None
+        # Lowest priority, and among those the most recently queued
+        return max(candidates, key=lambda entry: (entry[0], entry[1]))[2]
+
+    def release(self, service_time=None):
+        """Frees a slot and hands it to the best queued waiter."""
+        if service_time is not None:
+            # Smoothed LLM-stage duration, used for Retry-After
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        self.in_flight -= 1
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            self._queued -= 1
+            self.in_flight += 1
+            waiter.future.set_result(None)
+            break
+        self._export()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+        }
+
+
+def get_admission_controller():
+    """
+    Returns the admission controller for the running event loop, or None when
+    ADMISSION_MAX_IN_FLIGHT is 0.
+    """
+    global _controller
+    max_in_flight = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+    if max_in_flight <= 0:
+        return None
+    loop = asyncio.get_running_loop()
+    config = (
+        max_in_flight,
+        int(os.getenv("ADMISSION_MAX_QUEUE", "256")),
+        float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30")),
+    )
+    if (
+        _controller is None
+        or _controller.loop is not loop
+        or (_controller.max_in_flight, _controller.max_queue, _controller.queue_timeout) != config
+    ):
+        _controller = AdmissionController(*config)
+    return _controller
@@ -1,8 +1,25 @@
 """
 aggregator.py
 Aggregates all messages in a customer conversation.
+
+Long threads are windowed to a token budget (AGGREGATE_TOKEN_BUDGET, or per
+model via AGGREGATE_TOKEN_BUDGETS): the opening customer message and the most
+recent turns are always kept, remaining space goes to customer turns before
+agent turns, and omitted turns are replaced by a marker.
 """
 
+import os
+
+from error_handler import error_response
+from logger import logger, log_payload
+from tracing import traced
+
+# Most recent turns kept regardless of sender when the thread is windowed
+RECENT_TURNS = 2
+# Estimated cost of the omission marker, and of the short "[...]" for further gaps
+MARKER_TOKENS = 8
+GAP_TOKENS = 2
+
 def map_role(role):
     if not role:
         return "unknown"
@@ -22,16 +39,140 @@ def tweets_to_messages(tweets):
         for tweet in tweets
     ]
 
-def aggregate_conversation(request_json):
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English chat text)."""
+    return (len(text) + 3) // 4
+
+
+def token_budget(model=None):
+    """
+    Token budget for the aggregated text of one conversation.
+    AGGREGATE_TOKEN_BUDGETS ("llama3=1500,mistral=3000") sets it per model
+    (matched on the full name, then the name before ":"); otherwise
+    AGGREGATE_TOKEN_BUDGET (default 2048). 0 disables windowing.
+    """
+    model = model if model is not None else os.getenv("OLLAMA_MODEL", "")
+    per_model = {}
+    for entry in os.getenv("AGGREGATE_TOKEN_BUDGETS", "").split(","):
+        name, _, value = entry.partition("=")
+        if name.strip() and value.strip():
+            per_model[name.strip()] = int(value)
+    for name in (model, model.split(":")[0]):
+        if name in per_model:
+            return per_model[name]
+    return int(os.getenv("AGGREGATE_TOKEN_BUDGET", "2048"))
+
+
+def _omitted_marker(count, first):
+    if not first:
+        return "[...]"
+    return f"[... {count} turn{'s' if count != 1 else ''} omitted ...]"
+
+
+def window_turns(turns, budget):
+    """
+    Fits (sender, text) pairs with non-empty text into `budget` estimated tokens.
+    Returns (texts, truncation): the texts to join in conversation order, with
+    a marker in place of the first run of omitted turns (and a short "[...]"
+    for any later one), and a summary dict, or None when everything fits.
+    """
+    costs = [estimate_tokens(text) for _, text in turns]
+    total = sum(costs)
+    if budget <= 0 or total <= budget:
+        return [text for _, text in turns], None
+    opening = next((i for i, (sender, _) in enumerate(turns) if sender == "customer"), 0)
+    keep = {opening}
+    remaining = budget - costs[opening] - MARKER_TOKENS
+    recent = range(len(turns) - 1, max(len(turns) - 1 - RECENT_TURNS, -1), -1)
+    customer = [i for i in range(len(turns) - 1, -1, -1) if turns[i][0] == "customer"]
+    others = [i for i in range(len(turns) - 1, -1, -1) if turns[i][0] != "customer"]
+    for phase in (recent, customer, others):
+        # Newest first; a turn that does not fit is skipped, smaller older ones may still fit.
+        # Each kept turn also pays for a possible "[...]" gap before it.
+        for i in phase:
+            if i not in keep and costs[i] + GAP_TOKENS <= remaining:
+                keep.add(i)
+                remaining -= costs[i] + GAP_TOKENS
+    texts = []
+    omitted_run = 0
+    gaps = 0
+    kept_tokens = 0
+    for i, (_, text) in enumerate(turns):
+        if i in keep:
+            if omitted_run:
+                texts.append(_omitted_marker(omitted_run, first=not gaps))
+                omitted_run = 0
+                gaps += 1
+            if i == opening and costs[i] > budget - MARKER_TOKENS:
+                # A single huge opening message is cut to what fits
+                text = text[:max(0, budget - MARKER_TOKENS) * 4] + " [...]"
+            texts.append(text)
+            kept_tokens += estimate_tokens(text)
+        else:
+            omitted_run += 1
+    if omitted_run:
+        texts.append(_omitted_marker(omitted_run, first=not gaps))
+    omitted = len(turns) - len(keep)
+    return texts, {
+        "budget_tokens": budget,
+        "estimated_tokens": total,
+        "kept_turns": len(keep),
+        "omitted_turns": omitted,
+        "omitted_tokens": max(0, total - kept_tokens),
+    }
+
+
+def aggregate_turns(conversation, budget=None):
+    """
+    Aggregates the turns of a conversation.Conversation in one pass.
+    Returns the same result shape as aggregate_conversation; 'messages' is the
+    conversation's own tuple of turns rather than a new list.
+    """
+    texts, truncation = window_turns(
+        [(turn.sender, turn.text) for turn in conversation.turns if turn.text],
+        token_budget() if budget is None else budget,
+    )
+    aggregated_text = " ".join(texts)
+    if not aggregated_text:
+        logger.error("All messages/tweets have empty text")
+        return error_response("All messages/tweets have empty text")
+    log_payload("Aggregated messages", aggregated_text, conversation.conversation_number)
+    return {
+        "conversation_number": conversation.conversation_number,
+        "aggregated_text": aggregated_text,
+        "messages": conversation.turns,
+        "truncation": truncation
+    }
+
+def _aggregate_sizes(result, request_json, budget=None):
+    """Span attributes of aggregate_conversation."""
+    if "error" in result:
+        return {}
+    truncation = result.get("truncation") or {}
+    return {
+        "turns": len(result["messages"]),
+        "aggregated_chars": len(result["aggregated_text"]),
+        "estimated_tokens": estimate_tokens(result["aggregated_text"]),
+        "omitted_turns": truncation.get("omitted_turns", 0),
+    }
+
+@traced("aggregate_conversation", _aggregate_sizes)
+def aggregate_conversation(request_json, budget=None):
     """
     Aggregates all messages in a customer conversation.
-    Supports both production-grade 'tweets' and legacy 'messages' formats.
+    Supports both production-grade 'tweets' and legacy 'messages' formats,
+    and conversation.Conversation objects.
+    Long threads are windowed to `budget` tokens (default: token_budget());
+    'truncation' in the result describes what was omitted, or is None.
     Returns aggregated text or error response if input is invalid.
     """
-    from logger import logger
-    from error_handler import error_response
+    if not isinstance(request_json, dict) and hasattr(request_json, "turns"):
+        if not request_json.turns:
+            logger.error("Messages must be a non-empty list")
+            return error_response("Messages must be a non-empty list")
+        return aggregate_turns(request_json, budget)
     try:
-        if "tweets" in request_json:
+        if request_json.get("tweets"):
             messages = tweets_to_messages(request_json["tweets"])
         else:
             messages = request_json.get("messages", [])
@@ -41,22 +182,24 @@ def aggregate_conversation(request_json):
         aggregated_texts = []
         for idx, msg in enumerate(messages):
             if not isinstance(msg, dict):
-                logger.error(f"Message at index {idx} is not a dict")
+                logger.error("Message at index %d is not a dict", idx)
                 return error_response(f"Message at index {idx} is not a dict")
             text = msg.get("text", "")
             # Skip empty text, do not error
             if text:
-                aggregated_texts.append(text)
+                aggregated_texts.append((msg.get("sender"), text))
         if len(aggregated_texts) == 0:
             logger.error("All messages/tweets have empty text")
             return error_response("All messages/tweets have empty text")
-        aggregated_text = " ".join(aggregated_texts)
-        logger.info(f"Aggregated messages: {aggregated_text}")
+        texts, truncation = window_turns(aggregated_texts, token_budget() if budget is None else budget)
+        aggregated_text = " ".join(texts)
+        log_payload("Aggregated messages", aggregated_text, request_json.get("conversation_number"))
         return {
             "conversation_number": request_json.get("conversation_number"),
             "aggregated_text": aggregated_text,
-            "messages": messages
+            "messages": messages,
+            "truncation": truncation
         }
     except Exception as e:
-        logger.error(f"Aggregation error: {str(e)}")
+        logger.error("Aggregation error: %s", e)
         return error_response("Aggregation error")
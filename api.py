@@ -3,73 +3,347 @@ api.py
 API layer for the Customer Support Query Classification module.
 """
 
-def classify_conversation(request_json):
+import os
+import time
+
+import llm_wrapper
+from admission import get_admission_controller
+from aggregator import aggregate_conversation, token_budget, window_turns
+from cache import cache_key, get_cache
+from classifier import fallback_classification, followup_text, parse_classification
+from conversation import Conversation
+from conversation_state import get_state_store, plan_incremental
+from error_handler import error_response
+from local_classifier import cascade_threshold, get_local_classifier
+from logger import logger, log_payload
+from metrics import REGISTRY
+from microbatch import get_microbatcher
+from prompt_builder import PROMPT_VERSION, build_fix_prompt, build_incremental_prompt, build_prompt
+from results_store import record_result
+from tracing import span, traced
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+def _prepare_llm_messages(request, timings):
     """
-    Main API entry point for classifying customer support conversations.
-    Accepts a JSON object, validates input, logs request, and returns classification or error response.
+    Validates the request, aggregates the conversation and builds the LLM message list.
+    `request` is a plain dict (validated here) or an already validated
+    conversation.Conversation. Stage durations (ms) are recorded into `timings`.
+    Returns {"messages": [...], "conversation": Conversation, ...} or an error response.
     """
-    from logger import logger
-    from error_handler import error_response
-    from aggregator import aggregate_conversation
-    from prompt_builder import build_prompt
-    from llm_wrapper import ollama_classify
-    from classifier import parse_classification
-    import copy
-    logger.info(f"Received request: {request_json}")
-    # Validate input schema
-    if not isinstance(request_json, dict):
-        logger.error("Invalid input: not a JSON object")
-        return error_response("Invalid input: not a JSON object")
-    if "conversation_number" not in request_json:
-        logger.error("Missing required field: conversation_number")
-        return error_response("Missing required field: conversation_number")
-    if "messages" in request_json and request_json["messages"] is not None:
-        if not isinstance(request_json["messages"], list) or len(request_json["messages"]) == 0:
-            logger.error("Messages must be a non-empty list")
-            return error_response("Messages must be a non-empty list")
-        for msg in request_json["messages"]:
-            if not isinstance(msg, dict) or "sender" not in msg or "text" not in msg:
-                logger.error("Each message must be a dict with sender and text fields")
-                return error_response("Each message must be a dict with sender and text fields")
-    elif "tweets" in request_json and request_json["tweets"] is not None:
-        if not isinstance(request_json["tweets"], list) or len(request_json["tweets"]) == 0:
-            logger.error("Tweets must be a non-empty list")
-            return error_response("Tweets must be a non-empty list")
-        for tweet in request_json["tweets"]:
-            if not isinstance(tweet, dict) or "role" not in tweet or "text" not in tweet:
-                logger.error("Each tweet must be a dict with role and text fields")
-                return error_response("Each tweet must be a dict with role and text fields")
+    started = time.perf_counter()
+    if isinstance(request, Conversation):
+        conversation = request
     else:
-        logger.error("Missing required fields: messages or tweets")
-        return error_response("Missing required fields: messages or tweets")
+        log_payload("Received request", request,
+                    request.get("conversation_number") if isinstance(request, dict) else None)
+        conversation = Conversation.from_dict(request)
+        if isinstance(conversation, dict):
+            return conversation
+    timings["validate"] = _elapsed_ms(started)
 
     # Aggregate conversation (handles both formats)
-    agg_result = aggregate_conversation(request_json)
+    started = time.perf_counter()
+    agg_result = aggregate_conversation(conversation)
+    timings["aggregate"] = _elapsed_ms(started)
     if "error" in agg_result:
         return agg_result
     aggregated_text = agg_result.get("aggregated_text")
 
     # Build message list for LLM
-    prompt_result = build_prompt(request_json["conversation_number"], aggregated_text)
+    started = time.perf_counter()
+    prompt_result = build_prompt(conversation.conversation_number, aggregated_text)
+    timings["build_prompt"] = _elapsed_ms(started)
     if "error" in prompt_result:
         return prompt_result
     messages = prompt_result.get("messages")
     if not messages or not isinstance(messages, list):
         logger.error("Prompt builder did not return a valid message list")
         return error_response("Prompt builder did not return a valid message list")
+    # "extra" collects pipeline metadata added to the response (e.g. cascade tier)
+    extra = {}
+    if agg_result.get("truncation"):
+        extra["truncation"] = agg_result["truncation"]
+    return {"messages": messages, "aggregated_text": aggregated_text, "conversation": conversation, "extra": extra}
+
+
+def _llm_cache_key(aggregated_text):
+    return cache_key(aggregated_text, os.getenv("OLLAMA_MODEL"), PROMPT_VERSION)
+
+
+def _local_tier(prepared, timings):
+    """
+    First tier of the classification cascade: answers from the local model when
+    CASCADE_MODEL_PATH is configured and its confidence reaches CASCADE_THRESHOLD.
+    Returns the classification, or None to escalate to the LLM.
+    """
+    model = get_local_classifier()
+    if model is None:
+        return None
+    started = time.perf_counter()
+    classification, confidence = model.predict(prepared["aggregated_text"])
+    timings["local"] = _elapsed_ms(started)
+    tier = "local" if classification is not None and confidence >= cascade_threshold() else "llm"
+    prepared["extra"]["cascade"] = {"tier": tier, "confidence": round(confidence, 4)}
+    REGISTRY.counter("cascade_decisions_total", "Conversations answered per cascade tier", ("tier",)).inc(tier=tier)
+    return classification if tier == "local" else None
+
+
+def _incremental_tier(prepared, timings):
+    """
+    Incremental re-classification of a conversation classified before (see
+    conversation_state). Returns the previous classification when only agent
+    turns were added. When new customer turns exist, replaces the prompt with
+    the compact "previous classification + new turns" one and returns None.
+    """
+    store = get_state_store()
+    if store is None:
+        return None
+    plan = plan_incremental(store, prepared["conversation"])
+    mode = plan["mode"] if plan else "full"
+    REGISTRY.counter("incremental_classifications_total", "Conversations per re-classification mode", ("mode",)).inc(
+        mode=mode)
+    if plan is None:
+        return None
+    prepared["extra"]["incremental"] = {"mode": mode, "new_turns": len(plan["new_turns"])}
+    if mode == "reused":
+        return plan["classification"]
+    started = time.perf_counter()
+    labels = {"customer": "Customer: ", "agent": "Agent: "}
+    texts, _ = window_turns(
+        [(turn.sender, labels.get(turn.sender, "") + turn.text) for turn in plan["new_turns"] if turn.text],
+        token_budget(),
+    )
+    conversation_number = prepared["conversation"].conversation_number
+    prompt_result = build_incremental_prompt(conversation_number, plan["classification"], "\n".join(texts))
+    timings["build_prompt"] = timings.get("build_prompt", 0) + _elapsed_ms(started)
+    if "error" in prompt_result:
+        # Fall back to the full-thread prompt already prepared
+        prepared["extra"]["incremental"]["mode"] = "full"
+        return None
+    prepared["messages"] = prompt_result["messages"]
+    prepared["cache_text"] = prompt_result["messages"][-1]["content"]
+    return None
+
+
+def _fix_messages(llm_response):
+    """Messages of the "fix this JSON" follow-up for a reply that local repair cannot use, else None."""
+    text = followup_text(llm_response)
+    if text is None:
+        return None
+    prompt_result = build_fix_prompt(text)
+    return prompt_result.get("messages")
+
+
+def _after_followup(original, fixed):
+    """
+    The follow-up's reply if it is usable; else either reply with unmatched
+    labels set to the catch-alls; else the original reply (without its raw content).
+    """
+    counter = REGISTRY.counter("classification_followups_total", "Single 'fix this JSON' LLM follow-ups",
+                               ("outcome",))
+    if followup_text(fixed) is None and not (isinstance(fixed, dict) and "error" in fixed):
+        counter.inc(outcome="fixed")
+        return fixed
+    for reply in (fixed, original):
+        classification = fallback_classification(reply)
+        if classification is not None:
+            counter.inc(outcome="fallback")
+            logger.warning("LLM follow-up could not fix the labels; using catch-all labels")
+            return classification
+    counter.inc(outcome="failed")
+    logger.error("LLM follow-up could not fix the reply")
+    return _without_content(original)
+
+
+def _without_content(llm_response):
+    # Parse errors carry the raw reply for the follow-up; it is not returned to clients
+    if isinstance(llm_response, dict) and "content" in llm_response and "error" in llm_response:
+        return error_response(llm_response["error"])
+    return llm_response
+
+
+def _classify_llm(messages):
+    """LLM call plus at most one short follow-up when the reply cannot be repaired locally."""
+    llm_response = llm_wrapper.ollama_classify(messages)
+    fix = _fix_messages(llm_response)
+    if fix is None:
+        return _without_content(llm_response)
+    return _after_followup(llm_response, llm_wrapper.ollama_classify(fix))
+
+
+async def _classify_llm_async(call_llm):
+    """Awaitable variant of _classify_llm around `call_llm` (direct or micro-batched call)."""
+    llm_response = await call_llm()
+    fix = _fix_messages(llm_response)
+    if fix is None:
+        return _without_content(llm_response)
+    return _after_followup(llm_response, await llm_wrapper.ollama_classify_async(fix))
+
 
-    # Call Ollama LLM with message list
-    llm_response = ollama_classify(messages)
+def _remember_state(conversation, classification):
+    """Stores the tweet_ids and classification for later incremental re-classification."""
+    store = get_state_store()
+    if store is None or not conversation.turns or any(turn.tweet_id is None for turn in conversation.turns):
+        return
+    store.put(conversation.conversation_number, [turn.tweet_id for turn in conversation.turns], classification)
+
+
+def _record_stage_timings(timings):
+    """Feeds the per-stage timings of one request into the stage histogram."""
+    histogram = REGISTRY.histogram("classify_stage_seconds", "Time spent per classification pipeline stage", ("stage",))
+    for stage, duration_ms in timings.items():
+        histogram.observe(duration_ms / 1000.0, stage=stage)
+
+
+def _result_source(prepared):
+    """Which tier produced the classification, for the results store."""
+    extra = prepared["extra"]
+    if extra.get("incremental", {}).get("mode") in ("reused", "incremental"):
+        return extra["incremental"]["mode"]
+    if extra.get("cascade", {}).get("tier") == "local":
+        return "local"
+    return "llm"
+
+
+def _build_response(prepared, llm_response, timings):
+    """
+    Parses the LLM output and attaches the classification to the original request fields.
+    Logs one structured record with the stage timings of the request.
+    """
     if isinstance(llm_response, dict) and "error" in llm_response:
+        _record_stage_timings(timings)
         return llm_response
 
     # Parse classification
+    started = time.perf_counter()
     classification = parse_classification(llm_response)
+    timings["parse"] = _elapsed_ms(started)
+    _record_stage_timings(timings)
     if isinstance(classification, dict) and "error" in classification:
         return classification
 
     # Build final response: retain all original fields, add classification
-    response = copy.deepcopy(request_json)
-    response["classification"] = classification
-    logger.info(f"Response: {response}")
+    conversation = prepared["conversation"]
+    _remember_state(conversation, classification)
+    response = conversation.to_response(classification)
+    response.update(prepared["extra"])
+    conversation_number = conversation.conversation_number
+    record_result(conversation_number, classification, round(sum(timings.values()), 3), _result_source(prepared))
+    log_payload("Response", response, conversation_number)
+    logger.info("Classified conversation %s", conversation_number,
+                extra={"conversation_number": conversation_number, "timings": timings, "event": "classified"})
     return response
+
+
+def _classify_sizes(result, request_json, *args, **kwargs):
+    """Span attributes of classify_conversation: the conversation, its size and which tier answered."""
+    conversation = request_json if isinstance(request_json, Conversation) else None
+    attributes = {"tier": "error" if "error" in result else result.get("cascade", {}).get("tier", "llm")}
+    if conversation is not None:
+        attributes.update(conversation_number=conversation.conversation_number, turns=len(conversation.turns))
+    elif isinstance(request_json, dict):
+        attributes["conversation_number"] = str(request_json.get("conversation_number"))
+        attributes["turns"] = len(request_json.get("tweets") or request_json.get("messages") or [])
+    if "incremental" in result:
+        attributes["incremental"] = result["incremental"].get("mode")
+    return attributes
+
+
+@traced("classify_conversation", _classify_sizes)
+def classify_conversation(request_json):
+    """
+    Main API entry point for classifying customer support conversations.
+    Accepts a JSON object (or a conversation.Conversation), validates input, logs request,
+    and returns classification or error response.
+    """
+    timings = {}
+    prepared = _prepare_llm_messages(request_json, timings)
+    if "error" in prepared:
+        return prepared
+
+    previous = _incremental_tier(prepared, timings)
+    if previous is not None:
+        return _build_response(prepared, previous, timings)
+
+    local = _local_tier(prepared, timings)
+    if local is not None:
+        return _build_response(prepared, local, timings)
+
+    # Call Ollama LLM with message list (through the classification cache if enabled)
+    messages = prepared["messages"]
+    started = time.perf_counter()
+    cache = get_cache()
+    if cache is None:
+        llm_response = _classify_llm(messages)
+    else:
+        llm_response = cache.get_or_compute(
+            _llm_cache_key(prepared.get("cache_text", prepared["aggregated_text"])),
+            lambda: _classify_llm(messages),
+        )
+    timings["llm"] = _elapsed_ms(started)
+    return _build_response(prepared, llm_response, timings)
+
+
+async def _call_admitted(admission, priority, call_llm):
+    """Runs call_llm once admission control grants a slot, or returns its rejection."""
+    with span("admission", priority=priority):
+        rejected = await admission.acquire(priority)
+    if rejected is not None:
+        return rejected
+    started = time.perf_counter()
+    try:
+        return await call_llm()
+    finally:
+        admission.release(time.perf_counter() - started)
+
+
+@traced("classify_conversation", _classify_sizes)
+async def classify_conversation_async(request_json, priority="default"):
+    """
+    Awaitable variant of classify_conversation for use inside the event loop.
+    Same validation and response format; the LLM call does not block other requests.
+    LLM calls pass through admission control; `priority` is its priority class
+    ("interactive", "default" or "batch").
+    """
+    timings = {}
+    prepared = _prepare_llm_messages(request_json, timings)
+    if "error" in prepared:
+        return prepared
+
+    previous = _incremental_tier(prepared, timings)
+    if previous is not None:
+        return _build_response(prepared, previous, timings)
+
+    local = _local_tier(prepared, timings)
+    if local is not None:
+        return _build_response(prepared, local, timings)
+
+    messages = prepared["messages"]
+    batcher = get_microbatcher()
+    # Batched prompts carry full threads, so compact incremental prompts go direct
+    if batcher is None or "cache_text" in prepared:
+        call_model = lambda: llm_wrapper.ollama_classify_async(messages)
+    else:
+        call_model = lambda: batcher.submit(
+            prepared["conversation"].conversation_number, prepared["aggregated_text"], messages
+        )
+    # The follow-up, if any, runs inside the same admission slot and is cached with the reply
+    call_llm = lambda: _classify_llm_async(call_model)
+    admission = get_admission_controller()
+    if admission is not None:
+        call_backend = call_llm
+        call_llm = lambda: _call_admitted(admission, priority, call_backend)
+    started = time.perf_counter()
+    cache = get_cache()
+    if cache is None:
+        llm_response = await call_llm()
+    else:
+        llm_response = await cache.get_or_compute_async(
+            _llm_cache_key(prepared.get("cache_text", prepared["aggregated_text"])), call_llm
+        )
+    timings["llm"] = _elapsed_ms(started)
+    return _build_response(prepared, llm_response, timings)
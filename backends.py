@@ -0,0 +1,248 @@
+"""
+backends.py
+Routing of LLM calls over several Ollama instances.
+
+OLLAMA_ENDPOINTS (comma-separated; falls back to OLLAMA_ENDPOINT) lists the
+backends. Each call goes to the available backend with the fewest outstanding
+requests. Every backend has a circuit breaker: after
+OLLAMA_BREAKER_FAILURES consecutive failures it opens for
+OLLAMA_BREAKER_RESET_SECONDS, then lets a single trial request through
+(half-open) and closes again if that succeeds. Periodic health probes
+(GET /api/tags every OLLAMA_HEALTH_INTERVAL seconds, async server only) take
+unreachable backends out of rotation until they answer again.
+
+With OLLAMA_HEDGE_PERCENTILE set (e.g. 95), a request still running after
+that percentile of recent latencies is re-issued to a second backend and the
+first reply wins.
+"""
+
+import collections
+import math
+import os
+import threading
+import time
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_pool = None
+_pool_config = None
+_pool_lock = threading.Lock()
+
+
+class Backend:
+    """One Ollama instance: outstanding request count, health and breaker state."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.chat_url = f"{self.url}/api/chat"
+        self.outstanding = 0
+        self.healthy = True
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def available(self, now, reset_timeout):
+        """Whether the breaker and health state allow a request (may move open -> half-open)."""
+        if not self.healthy:
+            return False
+        if self.state == OPEN and now - self.opened_at >= reset_timeout:
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return self.state == CLOSED
+
+    def __repr__(self):
+        return f"Backend({self.url!r}, state={self.state}, outstanding={self.outstanding})"
+
+
+class BackendPool:
+    """
+    Least-outstanding-requests routing with per-backend circuit breakers.
+    Thread-safe: used from the event loop and from worker threads.
+    """
+
+    def __init__(self, urls, failure_threshold=3, reset_timeout=10.0, hedge_percentile=None,
+                 hedge_min_samples=20, latency_window=200):
+        if not urls:
+            raise ValueError("At least one Ollama endpoint is required")
+        self.backends = [Backend(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def __len__(self):
+        return len(self.backends)
+
+    def acquire(self, exclude=()):
+        """
+        Reserves the available backend with the fewest outstanding requests
+        (ties rotate). Returns None when every backend is excluded, unhealthy
+        or has an open breaker.
+        """
+        now = time.monotonic()
+        with self._lock:
+            count = len(self.backends)
+            best = None
+            for offset in range(count):
+                backend = self.backends[(self._next + offset) % count]
+                if backend in exclude or not backend.available(now, self.reset_timeout):
+                    continue
+                if best is None or backend.outstanding < best.outstanding:
+                    best = backend
+            if best is None:
+                return None
+            self._next = (self.backends.index(best) + 1) % count
+            best.outstanding += 1
+            if best.state == HALF_OPEN:
+                best.trial_in_flight = True
+        self._export(best)
+        return best
+
+    def release(self, backend, success, duration=None):
+        """
+        Ends a request on `backend`. success=True/False feeds the breaker;
+        None (e.g. a cancelled hedge) leaves it untouched.
+        """
+        from logger import logger
+        from metrics import REGISTRY
+        with self._lock:
+            backend.outstanding -= 1
+            if success is None:
+                if backend.state == HALF_OPEN:
+                    backend.trial_in_flight = False
+            elif success:
+                backend.failures = 0
+                if backend.state != CLOSED:
+                    logger.info("Ollama backend %s recovered; circuit closed", backend.url)
+                backend.state = CLOSED
+                backend.trial_in_flight = False
+                if duration is not None:
+                    self._latencies.append(duration)
+            else:
+                backend.failures += 1
+                if backend.state == HALF_OPEN or (
+                    backend.state == CLOSED and backend.failures >= self.failure_threshold
+                ):
+                    logger.warning("Ollama backend %s failing; circuit open for %ss", backend.url, self.reset_timeout)
+                    backend.state = OPEN
+                    backend.opened_at = time.monotonic()
+                backend.trial_in_flight = False
+        if success is False:
+            REGISTRY.counter("llm_backend_failures_total", "Failed requests per Ollama backend", ("backend",)).inc(
+                backend=backend.url)
+        self._export(backend)
+
+    def hedge_delay(self):
+        """
+        Seconds to wait before hedging a request: the configured percentile of
+        recent successful latencies, or None when hedging is off, there is only
+        one backend, or too few samples exist yet.
+        """
+        if not self.hedge_percentile or len(self.backends) < 2:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        rank = max(1, math.ceil(self.hedge_percentile / 100.0 * len(ordered)))
+        return ordered[rank - 1]
+
+    def mark_health(self, backend, healthy):
+        from logger import logger
+        with self._lock:
+            changed = backend.healthy != healthy
+            backend.healthy = healthy
+        if changed:
+            logger.warning("Ollama backend %s is %s", backend.url, "healthy again" if healthy else "unreachable")
+        self._export(backend)
+
+    async def probe(self, client, timeout=2.0):
+        """Runs one health probe against every backend (GET /api/tags)."""
+        import asyncio
+
+        async def check(backend):
+            try:
+                response = await client.get(f"{backend.url}/api/tags", timeout=timeout)
+                healthy = response.status_code == 200
+            except Exception:
+                healthy = False
+            self.mark_health(backend, healthy)
+
+        await asyncio.gather(*[check(backend) for backend in self.backends])
+
+    def _export(self, backend):
+        from metrics import REGISTRY
+        REGISTRY.gauge("llm_backend_outstanding", "Outstanding requests per Ollama backend", ("backend",)).set(
+            backend.outstanding, backend=backend.url)
+        REGISTRY.gauge("llm_backend_state", "Breaker state per Ollama backend (0 closed, 1 half-open, 2 open, 3 unreachable)",
+                       ("backend",)).set(_STATE_VALUES[backend.state] if backend.healthy else 3, backend=backend.url)
+
+    def stats(self):
+        with self._lock:
+            return [
+                {"url": b.url, "state": b.state, "healthy": b.healthy, "outstanding": b.outstanding,
+                 "failures": b.failures}
+                for b in self.backends
+            ]
+
+
+def endpoints():
+    """Configured backend base URLs (OLLAMA_ENDPOINTS, else OLLAMA_ENDPOINT)."""
+    raw = os.getenv("OLLAMA_ENDPOINTS") or os.getenv("OLLAMA_ENDPOINT", "http://localhost:11434")
+    return [url.strip() for url in raw.split(",") if url.strip()]
+
+
+def timeouts():
+    """(connect, read) timeouts in seconds for Ollama calls; read applies between streamed chunks."""
+    return (
+        float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5")),
+        float(os.getenv("OLLAMA_READ_TIMEOUT", "120")),
+    )
+
+
+def health_interval():
+    """Seconds between health probes (OLLAMA_HEALTH_INTERVAL, default 10; 0 disables)."""
+    return float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+
+
+async def health_check_loop(client, interval):
+    """Probes the current backend pool every `interval` seconds until cancelled."""
+    import asyncio
+    while True:
+        await get_backend_pool().probe(client)
+        await asyncio.sleep(interval)
+
+
+def get_backend_pool():
+    """Returns the process-wide BackendPool for the current configuration."""
+    global _pool, _pool_config
+    hedge = os.getenv("OLLAMA_HEDGE_PERCENTILE")
+    config = (
+        tuple(endpoints()),
+        int(os.getenv("OLLAMA_BREAKER_FAILURES", "3")),
+        float(os.getenv("OLLAMA_BREAKER_RESET_SECONDS", "10")),
+        float(hedge) if hedge else None,
+    )
+    if _pool_config != config:
+        with _pool_lock:
+            if _pool_config != config:
+                _pool = BackendPool(
+                    list(config[0]), failure_threshold=config[1], reset_timeout=config[2], hedge_percentile=config[3]
+                )
+                _pool_config = config
+    return _pool
+
+
+def reset_backend_pool():
+    """Forgets breaker and health state (used by tests)."""
+    global _pool, _pool_config
+    with _pool_lock:
+        _pool = None
+        _pool_config = None
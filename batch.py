@@ -0,0 +1,159 @@
+"""
+batch.py
+Fans a batch of conversations out to the classifier with bounded concurrency.
+"""
+
+import asyncio
+import json
+
+
+_DONE = object()
+
+
+class _Slot:
+    """One concurrency slot of a batch item; release() is idempotent, acquire() takes it back."""
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        self.held = True
+
+
+def batch_concurrency():
+    """
+    Default number of conversations classified concurrently per batch (BATCH_CONCURRENCY, default 8).
+    """
+    import os
+    return max(1, int(os.getenv("BATCH_CONCURRENCY", "8")))
+
+
+def _batch_record(index, item, result):
+    """
+    Builds one NDJSON result record; errors are reported inline with their HTTP status code.
+    """
+    from error_handler import record_error
+    if isinstance(item, dict):
+        conversation_number = item.get("conversation_number")
+    else:
+        conversation_number = getattr(item, "conversation_number", None)
+    if isinstance(result, dict) and "error" in result:
+        return {
+            "index": index,
+            "conversation_number": conversation_number,
+            "status_code": record_error(result["error"]),
+            "error": result["error"],
+        }
+    return {
+        "index": index,
+        "conversation_number": conversation_number,
+        "status_code": 200,
+        "result": result,
+    }
+
+
+async def classify_batch(items, concurrency=None, priority="batch", dedup_threshold=None):
+    """
+    Classifies (index, item) pairs from an async iterable and yields result records
+    in completion order, not input order. Items are request dicts or Conversations.
+    Items that are already error responses (e.g. failed validation) are passed through.
+    At most `concurrency` conversations are in flight; the input is consumed only as
+    fast as slots free up. `priority` is the admission priority class (backfill
+    by default, so live /classify traffic goes first).
+    Near-duplicates within the batch (see dedup.py; threshold defaults to
+    DEDUP_THRESHOLD, 0 disables) wait for their cluster representative, without
+    holding a slot, and get its labels.
+    """
+    from api import classify_conversation_async
+    from dedup import DedupIndex, conversation_text, dedup_threshold as default_threshold, fan_out
+    from error_handler import error_response
+    from logger import logger
+    semaphore = asyncio.Semaphore(concurrency or batch_concurrency())
+    queue = asyncio.Queue()
+    tasks = set()
+    threshold = default_threshold() if dedup_threshold is None else dedup_threshold
+    index = DedupIndex(threshold) if threshold > 0 else None
+    # cluster id -> future of (classification, representative number), or None if it failed
+    clusters = {}
+
+    async def classify_item(item, slot):
+        prepared = conversation_text(item) if index is not None else None
+        assigned = index.assign(prepared[1]) if prepared is not None else None
+        if assigned is None:
+            return await classify_conversation_async(item, priority)
+        conversation = prepared[0]
+        cluster, representative = assigned
+        if representative:
+            clusters[cluster] = future = asyncio.get_running_loop().create_future()
+            outcome = None
+            try:
+                result = await classify_conversation_async(conversation, priority)
+                if not (isinstance(result, dict) and "error" in result):
+                    outcome = (result["classification"], conversation.conversation_number)
+                return result
+            finally:
+                future.set_result(outcome)
+        slot.release()
+        outcome = await asyncio.shield(clusters[cluster])
+        if outcome is not None:
+            return fan_out(conversation, outcome[0], cluster, outcome[1])
+        # The representative failed: classify this one on its own
+        await slot.acquire()
+        return await classify_conversation_async(conversation, priority)
+
+    async def run_one(index, item):
+        slot = _Slot(semaphore)
+        try:
+            if isinstance(item, dict) and "error" in item:
+                result = item
+            else:
+                result = await classify_item(item, slot)
+        except Exception as e:
+            logger.error("Batch item %d failed: %s", index, e)
+            result = error_response("Batch item error")
+        finally:
+            slot.release()
+        await queue.put(_batch_record(index, item, result))
+
+    async def feed():
+        try:
+            async for index, item in items:
+                await semaphore.acquire()
+                task = asyncio.create_task(run_one(index, item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*list(tasks))
+        finally:
+            await queue.put(_DONE)
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while True:
+            record = await queue.get()
+            if record is _DONE:
+                break
+            yield record
+        # Surface input errors raised while reading the batch
+        await feeder
+        if index is not None and len(index):
+            logger.info("Batch near-duplicate clusters: %s", index.stats(), extra={"event": "batch_dedup"})
+    finally:
+        feeder.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+async def classify_batch_ndjson(items, concurrency=None, priority="batch", dedup_threshold=None):
+    """
+    Same as classify_batch, encoded as NDJSON lines for a streaming response.
+    """
+    async for record in classify_batch(items, concurrency, priority, dedup_threshold):
+        yield json.dumps(record, ensure_ascii=False) + "\n"
@@ -0,0 +1,375 @@
+"""
+cache.py
+Content-addressed cache for LLM classifications.
+
+Entries are keyed on the normalized aggregated text, the Ollama model and the
+prompt version, so a changed prompt or model never serves stale labels.
+Tiers: an in-memory LRU with TTL, plus an optional SQLite file that survives
+restarts. Identical concurrent lookups share one in-flight LLM call.
+
+The SQLite tier stays off the event loop: async lookups read it in a worker
+thread, and writes are queued to a background thread that commits them in
+batches every CACHE_FLUSH_SECONDS (default 1) or CACHE_FLUSH_SIZE entries
+(default 500).
+"""
+
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from logger import logger
+
+_WHITESPACE = re.compile(r"\s+")
+MAX_PENDING_WRITES = 100000
+PRUNE_EVERY = 1000
+
+_cache = None
+_cache_lock = threading.Lock()
+_FLUSH = object()
+_STOP = object()
+
+
+def normalize_text(text):
+    """Canonical form of the aggregated text used for cache keys."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(aggregated_text, model, prompt_version):
+    """Hash of normalized text, model name and prompt version."""
+    h = hashlib.sha256()
+    for part in (model or "", prompt_version or "", normalize_text(aggregated_text)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _is_error(value):
+    return isinstance(value, dict) and "error" in value
+
+
+class _Flight:
+    """A synchronous in-flight computation other threads can wait on."""
+    __slots__ = ("event", "encoded")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.encoded = None
+
+
+class ClassificationCache:
+    """
+    LRU + TTL cache of LLM responses with an optional SQLite tier.
+    Values are stored JSON-encoded, so callers always get their own copy.
+    Error responses are never cached. Disk writes are batched by a background
+    thread; an entry is on disk after the next flush.
+    """
+
+    def __init__(self, max_entries=10000, ttl_seconds=3600.0, db_path=None, db_max_entries=1000000,
+                 flush_seconds=1.0, flush_size=500):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_max_entries = db_max_entries
+        self.flush_seconds = flush_seconds
+        self.flush_size = max(1, flush_size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._db_puts = 0
+        self._queue = None
+        self._writer = None
+        self.disk_dropped = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS classification_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS classification_cache_expires ON classification_cache (expires_at)"
+            )
+            self._db.commit()
+            self._queue = queue.Queue(maxsize=MAX_PENDING_WRITES)
+            self._writer = threading.Thread(target=self._write_loop, name="cache-writer", daemon=True)
+            self._writer.start()
+
+    # Raw encoded access
+
+    def _get_memory(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, encoded = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+    def _get_disk(self, key):
+        """Disk tier lookup (blocking); counts the miss when the key is not found."""
+        row = None
+        with self._db_lock:
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM classification_cache WHERE key = ?", (key,)
+                ).fetchone()
+        with self._lock:
+            if row is not None and row[1] > time.time():
+                # Promote to memory with the remaining disk TTL
+                self._store_memory(key, row[0], time.monotonic() + (row[1] - time.time()))
+                self.disk_hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def _get_encoded(self, key):
+        encoded = self._get_memory(key)
+        if encoded is not None:
+            return encoded
+        return self._get_disk(key)
+
+    async def _get_encoded_async(self, key):
+        encoded = self._get_memory(key)
+        if encoded is not None:
+            return encoded
+        if self._db is None:
+            return self._get_disk(key)
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _store_memory(self, key, encoded, expires_at):
+        self._entries[key] = (expires_at, encoded)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _put_encoded(self, key, encoded):
+        with self._lock:
+            self._store_memory(key, encoded, time.monotonic() + self.ttl_seconds)
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait((key, encoded, time.time() + self.ttl_seconds))
+            except queue.Full:
+                # The entry stays in memory; only its persistence is lost
+                with self._lock:
+                    self.disk_dropped += 1
+
+    def flush(self, timeout=10.0):
+        """Blocks until every entry put so far is committed to the disk tier."""
+        if self._queue is None:
+            return True
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def _write_loop(self):
+        while True:
+            rows, signals = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if isinstance(item[0], str):
+                    rows.append(item)
+                else:
+                    signals.append(item)
+                if signals or len(rows) >= self.flush_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self._write(rows)
+                except sqlite3.Error as e:
+                    logger.error("Failed to write %d cache entries to disk: %s", len(rows), e)
+            for signal, event in signals:
+                if signal is _STOP:
+                    return
+                event.set()
+
+    def _write(self, rows):
+        with self._db_lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO classification_cache (key, value, expires_at) VALUES (?, ?, ?)", rows
+                )
+                before = self._db_puts
+                self._db_puts += len(rows)
+                if self._db_puts // PRUNE_EVERY != before // PRUNE_EVERY:
+                    self._prune_db()
+
+    def _prune_db(self):
+        self._db.execute("DELETE FROM classification_cache WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM classification_cache WHERE key IN ("
+            "SELECT key FROM classification_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_entries,),
+        )
+
+    # Public API
+
+    def get(self, key):
+        encoded = self._get_encoded(key)
+        return None if encoded is None else json.loads(encoded)
+
+    def put(self, key, value):
+        if not _is_error(value):
+            self._put_encoded(key, json.dumps(value, ensure_ascii=False))
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, or calls compute() once for all threads
+        asking for the same key concurrently.
+        """
+        encoded = self._get_encoded(key)
+        if encoded is not None:
+            return json.loads(encoded)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.encoded is not None:
+                return json.loads(flight.encoded)
+            return compute()
+        try:
+            value = compute()
+            if not _is_error(value):
+                flight.encoded = json.dumps(value, ensure_ascii=False)
+                self._put_encoded(key, flight.encoded)
+            return value
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    async def get_or_compute_async(self, key, compute):
+        """
+        Async variant of get_or_compute; compute is a coroutine function.
+        Followers of a failed or cancelled leader run their own compute().
+        """
+        encoded = await self._get_encoded_async(key)
+        if encoded is not None:
+            return json.loads(encoded)
+        future = self._async_flights.get(key)
+        if future is not None:
+            self.coalesced += 1
+            encoded = await asyncio.shield(future)
+            if encoded is not None:
+                return json.loads(encoded)
+            return await compute()
+        future = asyncio.get_running_loop().create_future()
+        self._async_flights[key] = future
+        encoded = None
+        try:
+            value = await compute()
+            if not _is_error(value):
+                encoded = json.dumps(value, ensure_ascii=False)
+                self._put_encoded(key, encoded)
+            return value
+        finally:
+            self._async_flights.pop(key, None)
+            if not future.done():
+                future.set_result(encoded)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._db is not None:
+            # Queued writes would otherwise land after the delete
+            self.flush()
+            with self._db_lock:
+                self._db.execute("DELETE FROM classification_cache")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "disk_tier": self._db is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced,
+                "disk_dropped": self.disk_dropped,
+            }
+
+    def close(self):
+        """Commits queued writes and closes the disk tier."""
+        if self._writer is not None:
+            self._queue.put((_STOP, None))
+            self._writer.join(timeout=10.0)
+            self._writer = None
+            self._queue = None
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def get_cache():
+    """
+    Returns the process-wide cache configured from the environment, or None
+    when CACHE_ENABLED is false.
+    CACHE_MAX_ENTRIES (10000), CACHE_TTL_SECONDS (3600) and CACHE_DB_PATH
+    (optional SQLite tier, written every CACHE_FLUSH_SECONDS or
+    CACHE_FLUSH_SIZE entries) control its size and persistence.
+    """
+    global _cache
+    if os.getenv("CACHE_ENABLED", "true").lower() in ("0", "false", "no", "off"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ClassificationCache(
+                    max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "10000")),
+                    ttl_seconds=float(os.getenv("CACHE_TTL_SECONDS", "3600")),
+                    db_path=os.getenv("CACHE_DB_PATH") or None,
+                    flush_seconds=float(os.getenv("CACHE_FLUSH_SECONDS", "1")),
+                    flush_size=int(os.getenv("CACHE_FLUSH_SIZE", "500")),
+                )
+                # Commit queued disk writes when a CLI run or the server exits
+                atexit.register(_cache.close)
+    return _cache
+
+
+def reset_cache():
+    """Drops the process-wide cache so the next get_cache() re-reads the environment."""
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            atexit.unregister(_cache.close)
+            _cache.close()
+        _cache = None
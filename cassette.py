@@ -0,0 +1,160 @@
+"""
+cassette.py
+Record/replay of LLM calls for deterministic, LLM-free test and evaluation runs.
+
+LLM_MODE selects the behaviour of llm_wrapper:
+  live    (default) every call goes to Ollama
+  record  answers from the cassette when possible, otherwise calls Ollama and
+          appends the parsed result
+  replay  answers only from the cassette; a miss returns an error (never
+          reaches Ollama) and is counted and logged with its key
+
+The cassette (LLM_CASSETTE_PATH, default data/llm_cassette.jsonl) is an
+append-only JSONL file of {"k": key, "v": result} lines, keyed on model,
+prompt version and a hash of the request (messages, schema and options).
+Error results are never recorded.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import threading
+
+MODES = ("live", "record", "replay")
+DEFAULT_PATH = "data/llm_cassette.jsonl"
+
+_cassette = None
+_cassette_config = None
+_cassette_lock = threading.Lock()
+
+
+def request_key(model, payload):
+    """Cassette key for one /api/chat request (streaming and keep-alive settings do not affect it)."""
+    from prompt_builder import PROMPT_VERSION
+    body = {k: v for k, v in payload.items() if k not in ("model", "stream", "keep_alive")}
+    digest = hashlib.sha256(
+        json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()[:32]
+    return f"{model}|{PROMPT_VERSION}|{digest}"
+
+
+class Cassette:
+    """In-memory index over an append-only JSONL cassette file."""
+
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unsupported cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._needs_newline = False
+        self._load()
+
+    def _load(self):
+        from logger import logger
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                self._needs_newline = not line.endswith("\n")
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    self._entries[entry["k"]] = entry["v"]
+                except (ValueError, KeyError, TypeError):
+                    # A torn last line from an interrupted recording is skipped
+                    logger.warning("Skipping malformed cassette line %s in %s", line_number, self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """Recorded result for key (a private copy), or None."""
+        from metrics import REGISTRY
+        value = self._entries.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            REGISTRY.counter("llm_cassette_requests_total", "LLM cassette lookups", ("mode", "result")).inc(
+                mode=self.mode, result="hit")
+            value = copy.deepcopy(value)
+        return value
+
+    def miss(self, key):
+        """Reports a replay miss and returns the error response for it."""
+        from logger import logger
+        from metrics import REGISTRY
+        from error_handler import error_response
+        with self._lock:
+            self.misses += 1
+        REGISTRY.counter("llm_cassette_requests_total", "LLM cassette lookups", ("mode", "result")).inc(
+            mode=self.mode, result="miss")
+        logger.warning("LLM cassette miss in replay mode: %s", key)
+        return error_response(f"LLM cassette miss: {key}")
+
+    def record(self, key, result):
+        """Appends a successful result (errors are not recorded)."""
+        from metrics import REGISTRY
+        if self.mode != "record" or not isinstance(result, dict) or "error" in result:
+            return
+        line = json.dumps({"k": key, "v": result}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if key in self._entries:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                if self._needs_newline:
+                    f.write("\n")
+                    self._needs_newline = False
+                f.write(line)
+            self._entries[key] = result
+            self.recorded += 1
+        REGISTRY.counter("llm_cassette_requests_total", "LLM cassette lookups", ("mode", "result")).inc(
+            mode=self.mode, result="recorded")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "path": self.path,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+            }
+
+
+def get_cassette():
+    """
+    Returns the cassette for the configured LLM_MODE / LLM_CASSETTE_PATH,
+    or None in live mode.
+    """
+    global _cassette, _cassette_config
+    mode = os.getenv("LLM_MODE", "live").lower()
+    if mode not in MODES:
+        raise ValueError(f"LLM_MODE must be one of {MODES}, got {mode!r}")
+    if mode == "live":
+        return None
+    config = (mode, os.getenv("LLM_CASSETTE_PATH", DEFAULT_PATH))
+    if _cassette_config != config:
+        with _cassette_lock:
+            if _cassette_config != config:
+                _cassette = Cassette(config[1], mode)
+                _cassette_config = config
+    return _cassette
+
+
+def reset_cassette():
+    """Forgets the loaded cassette (used by tests)."""
+    global _cassette, _cassette_config
+    with _cassette_lock:
+        _cassette = None
+        _cassette_config = None
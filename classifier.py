@@ -1,43 +1,347 @@
 """
 classifier.py
-Parses and validates LLM output for classification.
+Parses, validates and repairs LLM output for classification.
+
+Labels are mapped onto the allowed enums (prompt_builder.*_OPTIONS) without
+another LLM call wherever possible:
+  - keys and values are matched case-, space- and punctuation-insensitively
+    through lookup tables built once at import ("order_status", "NEGATIVE");
+  - known aliases and unambiguous halves of compound labels
+    ("Cancellation", "Delivery", "Account/Billing" as a topic) map to their enum;
+  - labels cut off by truncation ("Neu") match the one label they begin;
+  - remaining near-misses ("Technical Suport") are fuzzy-matched.
+The classification may be wrapped ({"classification": {...}}, a one-element
+list, ...); `categorization` (or a synonym) is kept as a string. Replies that
+are fenced, surrounded by prose or truncated are repaired by extract_json.
+
+Only a reply that stays unusable (unparseable, missing a label, or with a
+label that matches nothing) needs the single "fix this JSON" follow-up, see
+followup_text. If the follow-up does not help either, an unmatched intent or
+topic falls back to "Other"/"General" (fallback_classification) rather than
+failing the request. Outcomes are counted in classifications_parsed_total and
+classification_repairs_total.
 """
 
+import difflib
+import json
+import re
+from functools import lru_cache
+
+from error_handler import error_response
+from logger import logger
+from metrics import REGISTRY
+from prompt_builder import INTENT_OPTIONS, SENTIMENT_OPTIONS, TOPIC_OPTIONS
+from tracing import traced
+
+REQUIRED_FIELDS = ("intent", "topic", "sentiment")
+OPTIONS = {"intent": INTENT_OPTIONS, "topic": TOPIC_OPTIONS, "sentiment": SENTIMENT_OPTIONS}
+# Catch-all labels for values that match nothing, used only once the follow-up failed; sentiment has none
+FALLBACKS = {"intent": "Other", "topic": "General"}
+FUZZY_CUTOFF = 0.8
+MIN_PREFIX = 3
+
+# Label synonyms seen in LLM output, by field (keys are compared normalized)
+ALIASES = {
+    "intent": {
+        "cancellation": "Cancel Order", "cancel": "Cancel Order", "cancel subscription": "Cancel Order",
+        "return": "Return/Refund", "refund request": "Return/Refund", "tracking": "Order Status",
+        "order tracking": "Order Status", "where is my order": "Order Status", "delivery": "Shipping/Delivery",
+        "billing": "Account/Billing", "payment": "Account/Billing", "account": "Account/Billing",
+        "tech support": "Technical Support", "technical issue": "Technical Support", "question": "Product Inquiry",
+        "inquiry": "Product Inquiry", "praise": "Feedback", "compliment": "Feedback", "complain": "Complaint",
+    },
+    "topic": {
+        "subscription": "Account", "billing": "Payments", "payment": "Payments", "order": "Orders",
+        "delivery": "Shipping/Delivery", "return": "Returns", "refund": "Refunds", "product": "Product Info",
+        "product information": "Product Info", "tech": "Technical", "technical support": "Technical",
+        "other": "General", "login": "Account",
+    },
+    "sentiment": {
+        "pos": "Positive", "happy": "Positive", "satisfied": "Positive", "neg": "Negative", "angry": "Negative",
+        "frustrated": "Negative", "upset": "Negative", "mixed": "Neutral",
+    },
+}
+KEY_ALIASES = {
+    "category": "categorization", "categorisation": "categorization", "description": "categorization",
+    "summary": "categorization", "issue": "categorization",
+}
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_SPLIT = re.compile(r"\s*(?:/|&|\+|,|;|\band\b|\bor\b)\s*", re.IGNORECASE)
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```\s*$")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def _norm(value):
+    return _NON_ALNUM.sub("", str(value).lower())
+
+
+def _build_lookup():
+    """{field: {normalized form: allowed label}} from the options, their unambiguous parts and ALIASES."""
+    lookup = {}
+    for field, options in OPTIONS.items():
+        table = {_norm(option): option for option in options}
+        parts = {}
+        for option in options:
+            for part in _SPLIT.split(option):
+                parts.setdefault(_norm(part), set()).add(option)
+        for part, owners in parts.items():
+            if part and part not in table and len(owners) == 1:
+                table[part] = next(iter(owners))
+        for alias, option in ALIASES.get(field, {}).items():
+            table.setdefault(_norm(alias), option)
+        lookup[field] = table
+    return lookup
+
+
+_LOOKUP = _build_lookup()
+_FIELD_KEYS = {_norm(field): field for field in REQUIRED_FIELDS + ("categorization",)}
+_FIELD_KEYS.update({_norm(alias): field for alias, field in KEY_ALIASES.items()})
+
+
+@lru_cache(maxsize=4096)
+def match_label(field, value):
+    """
+    Maps a raw label onto the allowed enum of `field`.
+    Returns (label, how) with how in "exact", "normalized", "alias", "prefix",
+    "fuzzy", or (None, None) when nothing matches.
+    """
+    options = OPTIONS[field]
+    if value in options:
+        return value, "exact"
+    table = _LOOKUP[field]
+    key = _norm(value)
+    if key in table:
+        return table[key], "normalized" if _norm(table[key]) == key else "alias"
+    # Compound replies ("Billing / Payments"): the first part that is a known label
+    for part in _SPLIT.split(str(value)):
+        if _norm(part) in table and _norm(part) != key:
+            return table[_norm(part)], "alias"
+    if len(key) >= MIN_PREFIX:
+        # A label cut off by truncation ("Neu"): the one label it begins
+        owners = {label for label in options if _norm(label).startswith(key)}
+        if len(owners) == 1:
+            return owners.pop(), "prefix"
+    if key:
+        close = difflib.get_close_matches(key, list(table), n=1, cutoff=FUZZY_CUTOFF)
+        if close:
+            return table[close[0]], "fuzzy"
+    return None, None
+
+
+def _repair_truncated(text):
+    """Closes the strings, arrays and objects left open by a cut-off reply; drops a dangling key or comma."""
+    stack, in_string, escaped = [], False, False
+    # Positions after which the text can be cut back to a complete member
+    cut_points = []
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+        elif ch == ",":
+            cut_points.append((i, list(stack)))
+    if not stack and not in_string:
+        # Balanced but invalid: malformed rather than cut off, nothing to close
+        return None
+    candidates = [text + ('"' if in_string else "") + "".join(reversed(stack))]
+    for position, open_at in reversed(cut_points):
+        candidates.append(text[:position] + "".join(reversed(open_at)))
+    for candidate in candidates:
+        try:
+            return json.loads(_TRAILING_COMMA.sub(r"\1", candidate))
+        except ValueError:
+            continue
+    return None
+
+
+def extract_json(text):
+    """
+    Parses the JSON in an LLM reply, tolerating code fences, surrounding prose,
+    trailing commas and truncation. Returns (value, repaired) or (None, False).
+    """
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    body = _FENCE.sub("", text.strip())
+    start = min((i for i in (body.find("{"), body.find("[")) if i != -1), default=-1)
+    if start == -1:
+        return None, False
+    body = body[start:]
+    end = body.rfind("}" if body[0] == "{" else "]")
+    for candidate in ((body[:end + 1],) if end != -1 else ()) + (body,):
+        try:
+            return json.loads(_TRAILING_COMMA.sub(r"\1", candidate)), True
+        except ValueError:
+            continue
+    value = _repair_truncated(body)
+    return (value, True) if value is not None else (None, False)
+
+
+def _unwrap(value):
+    """The dict holding the labels: the value itself, a "classification" (or other single) wrapper, or a 1-list."""
+    for _ in range(3):
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+            continue
+        if not isinstance(value, dict):
+            return None
+        if any(_FIELD_KEYS.get(_norm(key)) in REQUIRED_FIELDS for key in value):
+            return value
+        nested = [v for v in value.values() if isinstance(v, (dict, list))]
+        if len(nested) != 1:
+            return value
+        value = nested[0]
+    return value if isinstance(value, dict) else None
+
+
+def normalize_classification(value, fallback=False):
+    """
+    Validates a decoded reply and maps its labels onto the allowed enums.
+    With `fallback`, an unmatched intent or topic becomes its FALLBACKS label.
+    Returns (classification, repairs), repairs being the list of fixes applied,
+    or an error response (no metrics or logging; see parse_classification).
+    """
+    labels = _unwrap(value)
+    if labels is None:
+        return error_response("Invalid response type")
+    repairs = []
+    if labels is not value:
+        repairs.append("unwrapped")
+    fields = {}
+    for key, raw in labels.items():
+        field = _FIELD_KEYS.get(_norm(key))
+        if field is None or field in fields:
+            continue
+        if key != field:
+            repairs.append("key")
+        fields[field] = raw
+    classification = {}
+    if "categorization" in fields and fields["categorization"] is not None:
+        categorization = fields["categorization"]
+        if not isinstance(categorization, str):
+            categorization = json.dumps(categorization, ensure_ascii=False)
+            repairs.append("categorization")
+        classification["categorization"] = categorization
+    for field in REQUIRED_FIELDS:
+        raw = fields.get(field)
+        if raw is None or raw == "":
+            return error_response(f"Missing field in classification: {field}")
+        if isinstance(raw, list) and raw:
+            raw = raw[0]
+        label, how = match_label(field, raw if isinstance(raw, str) else str(raw))
+        if label is None and fallback and field in FALLBACKS:
+            label, how = FALLBACKS[field], "fallback"
+        if label is None:
+            return error_response(f"Invalid {field} in classification: {raw}")
+        if how != "exact":
+            repairs.append(how)
+        classification[field] = label
+    return classification, repairs
+
+
+def followup_text(response):
+    """
+    The reply text to send to the "fix this JSON" follow-up, or None when the
+    response is usable as is (or is an error the follow-up cannot help with).
+    """
+    if isinstance(response, dict) and "error" in response:
+        return response.get("content") or None
+    if isinstance(response, str):
+        value, _ = extract_json(response)
+        if value is None:
+            return response or None
+    else:
+        value = response
+    if isinstance(normalize_classification(value), tuple):
+        return None
+    return response if isinstance(response, str) else json.dumps(response, ensure_ascii=False)
+
+
+def _parse_sizes(result, response):
+    """Span attributes of parse_classification."""
+    if isinstance(response, str):
+        return {"reply_chars": len(response)}
+    return {"reply_type": type(response).__name__}
+
+
+def fallback_classification(response):
+    """
+    Last resort after a failed follow-up: the classification of `response`
+    with unmatched intent/topic labels replaced by "Other"/"General", or None
+    when that does not make it usable either (unparseable, missing label,
+    unmatched sentiment).
+    """
+    if isinstance(response, str):
+        response, _ = extract_json(response)
+    if not isinstance(response, (dict, list)) or (isinstance(response, dict) and "error" in response):
+        return None
+    result = normalize_classification(response, fallback=True)
+    if isinstance(result, dict) or "fallback" not in result[1]:
+        return None
+    REGISTRY.counter("classification_repairs_total", "Local repairs applied to LLM replies", ("kind",)).inc(
+        kind="fallback")
+    return result[0]
+
+
+@traced("parse_classification", _parse_sizes)
 def parse_classification(response):
     """
-    Parses LLM output and validates classification schema (intent, topic, sentiment).
-    Returns parsed result or error response.
+    Parses LLM output, validates it and repairs labels onto the allowed enums.
+    Returns the classification (intent, topic, sentiment and, if present,
+    categorization) or an error response.
     """
-    import json
-    from logger import logger
-    from error_handler import error_response
+    outcomes = REGISTRY.counter("classifications_parsed_total", "LLM replies parsed by outcome", ("outcome",))
     try:
         if not response:
             logger.error("Empty LLM response")
+            outcomes.inc(outcome="failed")
             return error_response("Empty LLM response")
+        repairs = []
         # Parse response (assume JSON string)
         if isinstance(response, str):
-            classification = json.loads(response)
-        elif isinstance(response, dict):
-            classification = response
+            value, repaired = extract_json(response)
+            if value is None:
+                logger.error("Failed to parse LLM response as JSON")
+                outcomes.inc(outcome="failed")
+                return error_response("Failed to parse LLM response as JSON")
+            if repaired:
+                repairs.append("json")
+        elif isinstance(response, (dict, list)):
+            value = response
         else:
             logger.error("Invalid response type")
+            outcomes.inc(outcome="failed")
             return error_response("Invalid response type")
-        # Validate schema
-        required_fields = ["intent", "topic", "sentiment"]
-        if "classification" in classification:
-            class_obj = classification["classification"]
-        else:
-            class_obj = classification
-        for field in required_fields:
-            if field not in class_obj:
-                logger.error(f"Missing field in classification: {field}")
-                return error_response(f"Missing field in classification: {field}")
-        logger.info(f"Classification parsed: {class_obj}")
-        return class_obj
-    except json.JSONDecodeError:
-        logger.error("Failed to parse LLM response as JSON")
-        return error_response("Failed to parse LLM response as JSON")
+        result = normalize_classification(value)
+        if isinstance(result, dict):
+            logger.error(result["error"])
+            outcomes.inc(outcome="failed")
+            return result
+        classification, fixes = result
+        repairs.extend(fixes)
+        if repairs:
+            counter = REGISTRY.counter("classification_repairs_total", "Local repairs applied to LLM replies",
+                                       ("kind",))
+            for kind in repairs:
+                counter.inc(kind=kind)
+            logger.debug("Classification repaired (%s): %s", ", ".join(repairs), classification)
+        outcomes.inc(outcome="repaired" if repairs else "clean")
+        logger.debug("Classification parsed: %s", classification)
+        return classification
     except Exception as e:
-        logger.error(f"Parsing error: {str(e)}")
+        logger.error("Parsing error: %s", e)
+        outcomes.inc(outcome="failed")
         return error_response("Parsing error")
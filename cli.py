@@ -0,0 +1,287 @@
+"""
+cli.py
+Command-line tools for the Customer Support Query Classification module.
+
+Usage:
+    python -m cli classify-file INPUT [--output OUT.jsonl] [--workers N] [--tweets]
+    python -m cli ingest TWEETS [--output conversations.jsonl] [--min-tweets N]
+    python -m cli train-local RESULTS... [--output data/local_classifier.json]
+    python -m cli fewshot RESULTS... [--output data/fewshots.jsonl] [--per-label N] [--max-tokens N]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ingest import iter_conversations
+
+
+def normalize_conversation(conversation):
+    """
+    Coerces export records into the request format: string conversation_number,
+    and a role on every tweet (derived from `inbound` when the export omits it).
+    """
+    if "conversation_number" in conversation:
+        conversation["conversation_number"] = str(conversation["conversation_number"])
+    for tweet in conversation.get("tweets") or []:
+        if isinstance(tweet, dict) and "role" not in tweet:
+            tweet["role"] = "Customer" if tweet.get("inbound") else "Service Provider"
+    return conversation
+
+
+def load_checkpoint(path):
+    """
+    Returns the conversation_numbers already present in an output JSONL file.
+    A truncated last line (e.g. after a crash) is ignored.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("conversation_number") is not None:
+                done.add(str(record["conversation_number"]))
+    return done
+
+
+def classify_with_retry(conversation, retries=3, backoff=1.0):
+    """
+    Classifies one conversation in-process, retrying server-side failures
+    (LLM connectivity, timeouts, bad LLM output) with exponential backoff.
+    Input errors are not retried. Returns (result, attempts).
+    """
+    from api import classify_conversation
+    from error_handler import status_code_for_error
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = classify_conversation(conversation)
+        except Exception as e:
+            result = {"error": f"Unhandled error: {str(e)}"}
+        if not (isinstance(result, dict) and "error" in result):
+            return result, attempt
+        if status_code_for_error(result["error"]) < 500 or attempt > retries:
+            return result, attempt
+        time.sleep(backoff * (2 ** (attempt - 1)) * (0.5 + random.random()))
+
+
+def _terminate_partial_line(path):
+    # A crash mid-write leaves a partial last line; start appending on a fresh one
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+
+def _append_jsonl(f, record):
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+
+
+def classify_file(input_path, output_path, dead_letter_path=None, workers=4, retries=3, backoff=1.0,
+                  dedup_threshold=None, raw_tweets=False, input_format=None):
+    """
+    Classifies every conversation in input_path and appends results to output_path
+    as they complete. With raw_tweets, input_path is a flat tweet dump
+    (JSON/JSONL/CSV) whose threads are reconstructed on the fly (see ingest.py). Conversations already in output_path are skipped, so an
+    interrupted run can be resumed. Conversations that still fail after retries
+    are appended to the dead-letter file.
+    Near-duplicates (see dedup.py; threshold defaults to DEDUP_THRESHOLD, 0
+    disables) are not classified: they get their cluster representative's labels.
+    Returns a summary dict.
+    """
+    from logger import logger
+    from dedup import DedupIndex, conversation_text, dedup_threshold as default_threshold, fan_out
+    dead_letter_path = dead_letter_path or output_path + ".dead.jsonl"
+    done = load_checkpoint(output_path)
+    summary = {"classified": 0, "skipped": 0, "failed": 0}
+    if done:
+        logger.info("Resuming: %d conversations already classified in %s", len(done), output_path)
+    threshold = default_threshold() if dedup_threshold is None else dedup_threshold
+    index = DedupIndex(threshold) if threshold > 0 else None
+    # cluster id -> [classification or None while pending or False after failure, representative number, waiting]
+    clusters = {}
+    # Duplicates held back until their representative finishes count towards the in-flight bound
+    held = {"duplicates": 0}
+    _terminate_partial_line(output_path)
+    with open(output_path, "a", encoding="utf-8") as out, \
+            open(dead_letter_path, "a", encoding="utf-8") as dead, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def submit(conversation, cluster=None):
+            pending[pool.submit(classify_with_retry, conversation, retries, backoff)] = (conversation, cluster)
+
+        def drain():
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                conversation, cluster = pending.pop(future)
+                result, attempts = future.result()
+                failed = isinstance(result, dict) and "error" in result
+                if failed:
+                    summary["failed"] += 1
+                    _append_jsonl(dead, {
+                        "conversation_number": conversation.get("conversation_number"),
+                        "error": result["error"],
+                        "attempts": attempts,
+                        "input": conversation,
+                    })
+                else:
+                    summary["classified"] += 1
+                    _append_jsonl(out, result)
+                if cluster is None:
+                    continue
+                state = clusters[cluster]
+                waiting, state[2] = state[2], []
+                held["duplicates"] -= len(waiting)
+                if failed:
+                    # Duplicates of a failed representative are classified on their own
+                    state[0] = False
+                    for duplicate in waiting:
+                        submit(duplicate.raw)
+                else:
+                    state[0] = result["classification"]
+                    for duplicate in waiting:
+                        summary["classified"] += 1
+                        _append_jsonl(out, fan_out(duplicate, state[0], cluster, state[1]))
+
+        if raw_tweets:
+            from ingest import iter_threads
+            conversations = iter_threads(input_path, input_format)
+        else:
+            conversations = iter_conversations(input_path)
+        for conversation in conversations:
+            conversation = normalize_conversation(conversation)
+            if str(conversation.get("conversation_number")) in done:
+                summary["skipped"] += 1
+                continue
+            # Keep a bounded number of submissions in flight
+            while len(pending) + held["duplicates"] >= workers * 2:
+                drain()
+            prepared = conversation_text(conversation) if index is not None else None
+            assigned = index.assign(prepared[1]) if prepared is not None else None
+            if assigned is None:
+                submit(conversation)
+                continue
+            parsed = prepared[0]
+            cluster, representative = assigned
+            if representative:
+                clusters[cluster] = [None, parsed.conversation_number, []]
+                submit(conversation, cluster)
+                continue
+            state = clusters[cluster]
+            if state[0] is None:
+                state[2].append(parsed)
+                held["duplicates"] += 1
+            elif state[0] is False:
+                submit(conversation)
+            else:
+                summary["classified"] += 1
+                _append_jsonl(out, fan_out(parsed, state[0], cluster, state[1]))
+        while pending:
+            drain()
+    if index is not None:
+        summary["dedup"] = index.stats()
+    logger.info("classify-file finished: %s", summary)
+    return summary
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(prog="python -m cli", description="Customer Support Query Classification tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    classify_parser = subparsers.add_parser("classify-file", help="Classify a JSONL/JSON export in-process")
+    classify_parser.add_argument("input", help="JSONL file or JSON array of conversations")
+    classify_parser.add_argument("--output", help="Output JSONL (default: data/classified_results_<input>.jsonl)")
+    classify_parser.add_argument("--dead-letter", help="Dead-letter JSONL (default: <output>.dead.jsonl)")
+    classify_parser.add_argument("--workers", type=int, default=4)
+    classify_parser.add_argument("--retries", type=int, default=3)
+    classify_parser.add_argument("--backoff", type=float, default=1.0, help="Initial retry backoff in seconds")
+    classify_parser.add_argument("--dedup-threshold", type=float,
+                                 help="Near-duplicate similarity threshold (default: DEDUP_THRESHOLD; 0 disables)")
+    classify_parser.add_argument("--tweets", action="store_true",
+                                 help="INPUT is a flat tweet dump; reconstruct reply threads first")
+    classify_parser.add_argument("--format", choices=("json", "jsonl", "csv"), help="Tweet dump format (default: by extension)")
+
+    ingest_parser = subparsers.add_parser("ingest", help="Reconstruct conversations from a flat tweet dump")
+    ingest_parser.add_argument("input", help="JSON array, JSONL or CSV of tweets with reply links")
+    ingest_parser.add_argument("--output", help="Conversations JSONL (default: stdout)")
+    ingest_parser.add_argument("--format", choices=("json", "jsonl", "csv"), help="Dump format (default: by extension)")
+    ingest_parser.add_argument("--min-tweets", type=int, default=1, help="Drop threads with fewer tweets")
+
+    train_parser = subparsers.add_parser("train-local", help="Train the local pre-classifier from classified results")
+    train_parser.add_argument("results", nargs="+", help="classified_results_*.json / .jsonl files")
+    train_parser.add_argument("--output", default=os.path.join("data", "local_classifier.json"))
+
+    fewshot_parser = subparsers.add_parser("fewshot", help="Build the few-shot library from classified results")
+    fewshot_parser.add_argument("results", nargs="+", help="classified_results_*.json / .jsonl files")
+    fewshot_parser.add_argument("--output", default=os.path.join("data", "fewshots.jsonl"))
+    fewshot_parser.add_argument("--per-label", type=int, default=5,
+                                help="Examples kept per (intent, topic, sentiment) combination")
+    fewshot_parser.add_argument("--max-tokens", type=int, default=200, help="Skip longer conversations")
+
+    args = parser.parse_args(argv)
+    if args.command == "fewshot":
+        from classifier import OPTIONS
+        from fewshot import select_examples
+        records = (record for path in args.results for record in iter_conversations(path))
+        examples = select_examples(records, OPTIONS, args.per_label, args.max_tokens)
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            for example in examples:
+                f.write(json.dumps(example, ensure_ascii=False) + "\n")
+        print(json.dumps({"output": args.output, "examples": len(examples)}))
+        return 0 if examples else 1
+    if args.command == "train-local":
+        from local_classifier import train_from_files
+        model, used = train_from_files(args.results)
+        model.save(args.output)
+        print(json.dumps({"output": args.output, "examples": used}))
+        return 0 if used else 1
+    if args.command == "ingest":
+        from ingest import iter_threads
+        stats = {}
+        out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        try:
+            for thread in iter_threads(args.input, args.format, args.min_tweets, stats):
+                out.write(json.dumps(thread, ensure_ascii=False) + "\n")
+        finally:
+            if args.output:
+                out.close()
+        print(json.dumps({"output": args.output, **stats}), file=sys.stderr if not args.output else sys.stdout)
+        return 0
+    if args.command == "classify-file":
+        output = args.output
+        if not output:
+            stem = os.path.splitext(os.path.basename(args.input))[0]
+            out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+            os.makedirs(out_dir, exist_ok=True)
+            output = os.path.join(out_dir, f"classified_results_{stem}.jsonl")
+        summary = classify_file(args.input, output, args.dead_letter, args.workers, args.retries, args.backoff,
+                                args.dedup_threshold, args.tweets, args.format)
+        from cassette import get_cassette
+        cassette = get_cassette()
+        if cassette is not None:
+            # Replay misses are reported explicitly (they also land in the dead-letter file)
+            summary["cassette"] = cassette.stats()
+        print(json.dumps({"output": output, **summary}))
+        return 0 if summary["failed"] == 0 else 1
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
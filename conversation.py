@@ -0,0 +1,96 @@
+"""
+conversation.py
+Compact internal representation of a conversation.
+
+A Conversation is built once at the edge (from the validated Pydantic request,
+or from a plain dict after validation) and passed through aggregation, prompt
+building and response assembly, so the input is never re-validated, copied or
+re-walked into intermediate message lists.
+"""
+
+from aggregator import map_role
+from error_handler import error_response
+from logger import logger
+
+
+class Turn:
+    """One message or tweet: normalized sender ("customer", "agent" or "unknown") and text."""
+    __slots__ = ("sender", "text", "tweet_id")
+
+    def __init__(self, sender, text, tweet_id=None):
+        self.sender = sender
+        self.text = text
+        self.tweet_id = tweet_id
+
+    def __repr__(self):
+        return f"Turn({self.sender!r}, {self.text!r})"
+
+
+class Conversation:
+    """
+    A conversation_number, its turns (tuple of Turn) and the original request
+    fields (`raw`), which are echoed back in the response without copying.
+    """
+    __slots__ = ("conversation_number", "turns", "raw")
+
+    def __init__(self, conversation_number, turns, raw):
+        self.conversation_number = conversation_number
+        self.turns = turns
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.turns)
+
+    @classmethod
+    def from_request(cls, request):
+        """Builds a Conversation from an already validated ConversationRequest model."""
+        if request.tweets:
+            turns = tuple(Turn(map_role(t.role), t.text, t.tweet_id) for t in request.tweets)
+        else:
+            turns = tuple(Turn(m.sender, m.text) for m in request.messages or ())
+        return cls(request.conversation_number, turns, request.model_dump())
+
+    @classmethod
+    def from_dict(cls, request_json):
+        """
+        Validates a plain request dict and builds a Conversation.
+        Returns the Conversation or an error response.
+        """
+        # Validate input schema
+        if not isinstance(request_json, dict):
+            logger.error("Invalid input: not a JSON object")
+            return error_response("Invalid input: not a JSON object")
+        if "conversation_number" not in request_json:
+            logger.error("Missing required field: conversation_number")
+            return error_response("Missing required field: conversation_number")
+        if "messages" in request_json and request_json["messages"] is not None:
+            if not isinstance(request_json["messages"], list) or len(request_json["messages"]) == 0:
+                logger.error("Messages must be a non-empty list")
+                return error_response("Messages must be a non-empty list")
+            for msg in request_json["messages"]:
+                if not isinstance(msg, dict) or "sender" not in msg or "text" not in msg:
+                    logger.error("Each message must be a dict with sender and text fields")
+                    return error_response("Each message must be a dict with sender and text fields")
+            turns = tuple(Turn(msg["sender"], msg["text"]) for msg in request_json["messages"])
+        elif "tweets" in request_json and request_json["tweets"] is not None:
+            if not isinstance(request_json["tweets"], list) or len(request_json["tweets"]) == 0:
+                logger.error("Tweets must be a non-empty list")
+                return error_response("Tweets must be a non-empty list")
+            for tweet in request_json["tweets"]:
+                if not isinstance(tweet, dict) or "role" not in tweet or "text" not in tweet:
+                    logger.error("Each tweet must be a dict with role and text fields")
+                    return error_response("Each tweet must be a dict with role and text fields")
+            turns = tuple(
+                Turn(map_role(tweet["role"]), tweet["text"], tweet.get("tweet_id"))
+                for tweet in request_json["tweets"]
+            )
+        else:
+            logger.error("Missing required fields: messages or tweets")
+            return error_response("Missing required fields: messages or tweets")
+        return cls(request_json["conversation_number"], turns, request_json)
+
+    def to_response(self, classification):
+        """Original request fields plus the classification (shallow; the input is not mutated)."""
+        response = dict(self.raw)
+        response["classification"] = classification
+        return response
@@ -0,0 +1,126 @@
+"""
+conversation_state.py
+Per-conversation state for incremental re-classification.
+
+Remembers, per conversation_number, the tweet_ids already classified and the
+last classification. When a thread is re-submitted with new tweets, only the
+new turns need the LLM: if they are all agent tweets (or there are none) the
+previous classification is reused as is; otherwise a compact "previous
+classification + new turns" prompt replaces the full thread.
+
+The store is an LRU bounded by CONVERSATION_STATE_MAX_ENTRIES (default
+100000; 0 disables), so memory stays flat however many conversations pass
+through. Entries are tied to the model and prompt version that produced them.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+_store = None
+_store_size = None
+_store_lock = threading.Lock()
+
+
+class _State:
+    __slots__ = ("seen", "classification", "version")
+
+    def __init__(self, seen, classification, version):
+        self.seen = seen
+        self.classification = classification
+        self.version = version
+
+
+def state_version():
+    """Model and prompt version a stored classification belongs to."""
+    from prompt_builder import PROMPT_VERSION
+    return os.getenv("OLLAMA_MODEL", ""), PROMPT_VERSION
+
+
+class ConversationStateStore:
+    """Thread-safe LRU of conversation_number -> (seen tweet_ids, last classification)."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, conversation_number):
+        """Returns (seen tweet_ids, classification) for the current version, or None."""
+        key = str(conversation_number)
+        with self._lock:
+            state = self._entries.get(key)
+            if state is None:
+                return None
+            if state.version != state_version():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return state.seen, dict(state.classification)
+
+    def put(self, conversation_number, tweet_ids, classification):
+        key = str(conversation_number)
+        state = _State(frozenset(str(t) for t in tweet_ids), dict(classification), state_version())
+        with self._lock:
+            self._entries[key] = state
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "evictions": self.evictions}
+
+
+def plan_incremental(store, conversation):
+    """
+    Decides how much of a re-submitted conversation needs the LLM.
+    Returns None for a full classification (unknown conversation, turns without
+    tweet_ids, or a thread that is not an extension of the stored one), else
+    {"mode": "reused", "classification": ...} when only agent turns were added
+    (or none at all), or {"mode": "incremental", "classification": previous, "new_turns": [Turn, ...]}.
+    """
+    if not conversation.turns or any(turn.tweet_id is None for turn in conversation.turns):
+        return None
+    state = store.get(conversation.conversation_number)
+    if state is None:
+        return None
+    seen, previous = state
+    current = {str(turn.tweet_id) for turn in conversation.turns}
+    if not seen <= current:
+        return None
+    new_turns = [turn for turn in conversation.turns if str(turn.tweet_id) not in seen]
+    if all(turn.sender == "agent" for turn in new_turns):
+        return {"mode": "reused", "classification": previous, "new_turns": new_turns}
+    return {"mode": "incremental", "classification": previous, "new_turns": new_turns}
+
+
+def get_state_store():
+    """Returns the process-wide state store, or None when CONVERSATION_STATE_MAX_ENTRIES is 0."""
+    global _store, _store_size
+    max_entries = int(os.getenv("CONVERSATION_STATE_MAX_ENTRIES", "100000"))
+    if max_entries <= 0:
+        return None
+    if _store_size != max_entries:
+        with _store_lock:
+            if _store_size != max_entries:
+                _store = ConversationStateStore(max_entries)
+                _store_size = max_entries
+    return _store
+
+
+def reset_state_store():
+    """Drops all conversation state (used by tests)."""
+    global _store, _store_size
+    with _store_lock:
+        _store = None
+        _store_size = None
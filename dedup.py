@@ -0,0 +1,219 @@
+"""
+dedup.py
+Near-duplicate detection for bulk and batch classification.
+
+Conversations whose aggregated text is nearly identical once @handles, URLs,
+numbers, agent signatures such as "*QB", case and punctuation are stripped
+are grouped into clusters. Only the first conversation of a cluster (its
+representative) is classified; its labels are fanned out to the rest.
+
+Similarity is the Jaccard similarity of word-bigram shingles, estimated with
+MinHash signatures. LSH banding means each new conversation is compared with
+a handful of candidate clusters instead of all of them, and exact duplicates
+(after normalization) skip the signature entirely. DEDUP_THRESHOLD (default
+0.8; 0 disables) is the estimated similarity needed to join a cluster.
+"""
+
+import os
+import random
+import re
+import zlib
+from array import array
+
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_HANDLE = re.compile(r"@\w+")
+# Agent initials such as "*QB", "^JK" or "-AB" (matched before lowercasing)
+_SIGNATURE = re.compile(r"(?<!\w)[*^~-]\s?[A-Z]{1,4}\b")
+_NUMBER = re.compile(r"(?<!\w)#?\d[\d,.:/-]*")
+_NON_WORD = re.compile(r"[^\w']+|_")
+
+# Upper bounds and labels of the cluster size histogram; larger clusters are "100+"
+SIZE_BUCKETS = ((1, "1"), (4, "2-4"), (9, "5-9"), (99, "10-99"))
+_SIZE_LABELS = [name for _, name in SIZE_BUCKETS] + ["100+"]
+
+_MERSENNE = (1 << 61) - 1
+_MASK32 = 0xFFFFFFFF
+
+
+def dedup_threshold():
+    """Similarity needed to join a cluster (DEDUP_THRESHOLD, default 0.8; 0 disables)."""
+    return float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+
+
+def normalize_text(text):
+    """Lowercased words of `text` without handles, URLs, numbers, signatures or punctuation."""
+    for pattern in (_URL, _HANDLE, _SIGNATURE, _NUMBER):
+        text = pattern.sub(" ", text)
+    return " ".join(_NON_WORD.sub(" ", text.lower()).split())
+
+
+def shingles(normalized, size=2):
+    """Set of crc32 hashes of the word `size`-grams of a normalized text."""
+    words = normalized.split()
+    if len(words) <= size:
+        grams = [normalized]
+    else:
+        grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return {zlib.crc32(gram.encode("utf-8")) for gram in grams}
+
+
+def lsh_bands(threshold, num_perm):
+    """
+    (bands, rows) for LSH banding: the split whose candidate threshold
+    (1/bands)^(1/rows) is the highest one not above `threshold`, so pairs near
+    the threshold still become candidates (candidates are verified anyway).
+    """
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    below = [(b, r) for b, r in options if (1.0 / b) ** (1.0 / r) <= threshold]
+    if not below:
+        return options[-1]
+    return max(below, key=lambda option: (1.0 / option[0]) ** (1.0 / option[1]))
+
+
+class MinHasher:
+    """
+    `num_perm` hash functions (a*x + b mod 2^61-1, computed in wrapping uint64
+    arithmetic), seeded for reproducibility.
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        import numpy as np
+        rng = random.Random(seed)
+        self.a = np.array([rng.randrange(1, _MERSENNE) for _ in range(num_perm)], dtype=np.uint64)
+        self.b = np.array([rng.randrange(0, _MERSENNE) for _ in range(num_perm)], dtype=np.uint64)
+
+    def signature(self, hashes):
+        """MinHash signature of a set of 32-bit shingle hashes, as a uint32 array."""
+        import numpy as np
+        x = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        values = (x[:, None] * self.a + self.b) % np.uint64(_MERSENNE)
+        return (values.min(axis=0) & np.uint64(_MASK32)).astype(np.uint32)
+
+
+class DedupIndex:
+    """
+    Online clustering of texts by near-duplicate similarity.
+    Memory per cluster is one packed signature plus a few LSH bucket entries;
+    a duplicate only adds an exact-text entry.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, shingle_size=2, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self._exact = {}
+        # band key -> cluster id, or a list of ids when several share the bucket
+        self._buckets = {}
+        self._signatures = array("I")
+        self.sizes = array("I")
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def similarity(self, signature, cluster):
+        """Estimated Jaccard similarity between a signature and a cluster's representative."""
+        import numpy as np
+        start = cluster * self.num_perm
+        other = np.frombuffer(self._signatures[start:start + self.num_perm], dtype=np.uint32)
+        return int(np.count_nonzero(signature == other)) / self.num_perm
+
+    def assign(self, text):
+        """
+        Places `text` in a cluster. Returns (cluster_id, is_representative), or
+        None when nothing is left to compare after normalization.
+        """
+        from metrics import REGISTRY
+        counter = REGISTRY.counter("dedup_conversations_total", "Conversations seen by near-duplicate detection",
+                                   ("role",))
+        normalized = normalize_text(text)
+        if not normalized:
+            self.skipped += 1
+            counter.inc(role="skipped")
+            return None
+        key = hash(normalized)
+        cluster = self._exact.get(key)
+        if cluster is not None:
+            self.sizes[cluster] += 1
+            counter.inc(role="duplicate")
+            return cluster, False
+        signature = self.hasher.signature(shingles(normalized, self.shingle_size))
+        band_keys = [
+            hash((band, signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+            for band in range(self.bands)
+        ]
+        best, best_score = None, self.threshold
+        seen = set()
+        for band_key in band_keys:
+            entry = self._buckets.get(band_key)
+            if entry is None:
+                continue
+            for candidate in entry if isinstance(entry, list) else (entry,):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                score = self.similarity(signature, candidate)
+                if score >= best_score:
+                    best, best_score = candidate, score
+        if best is not None:
+            self._exact[key] = best
+            self.sizes[best] += 1
+            counter.inc(role="duplicate")
+            return best, False
+        cluster = len(self.sizes)
+        self.sizes.append(1)
+        self._signatures.frombytes(signature.tobytes())
+        self._exact[key] = cluster
+        for band_key in band_keys:
+            entry = self._buckets.get(band_key)
+            if entry is None:
+                self._buckets[band_key] = cluster
+            elif isinstance(entry, list):
+                entry.append(cluster)
+            else:
+                self._buckets[band_key] = [entry, cluster]
+        counter.inc(role="representative")
+        return cluster, True
+
+    def stats(self):
+        """Cluster counts and a histogram of cluster sizes."""
+        histogram = {}
+        for size in self.sizes:
+            label = next((name for limit, name in SIZE_BUCKETS if size <= limit), "100+")
+            histogram[label] = histogram.get(label, 0) + 1
+        clustered = sum(self.sizes)
+        return {
+            "threshold": self.threshold,
+            "conversations": clustered + self.skipped,
+            "clusters": len(self.sizes),
+            "duplicates": clustered - len(self.sizes),
+            "largest_cluster": max(self.sizes, default=0),
+            "cluster_sizes": {name: histogram[name] for name in _SIZE_LABELS if name in histogram},
+        }
+
+
+def conversation_text(item):
+    """
+    (Conversation, aggregated_text) for a request dict or Conversation, or None
+    when it does not validate (it is then classified as is and gets the error).
+    """
+    from aggregator import aggregate_conversation
+    from conversation import Conversation
+    conversation = item if isinstance(item, Conversation) else Conversation.from_dict(item)
+    if isinstance(conversation, dict):
+        return None
+    aggregated = aggregate_conversation(conversation)
+    if "error" in aggregated:
+        return None
+    return conversation, aggregated["aggregated_text"]
+
+
+def fan_out(conversation, classification, cluster, representative):
+    """Response for a duplicate: its own fields plus the representative's classification."""
+    from results_store import record_result
+    response = conversation.to_response(dict(classification))
+    response["dedup"] = {"cluster": cluster, "representative": representative}
+    record_result(conversation.conversation_number, classification, source="dedup")
+    return response
@@ -3,6 +3,47 @@ error_handler.py
 Handles and formats error responses for the module.
 """
 
+from metrics import REGISTRY
+
 def error_response(message):
     # Placeholder for error response logic
     return {"error": message}
+
+def status_code_for_error(message):
+    """
+    Maps an error message to the HTTP status code returned by the API.
+    """
+    err = message.lower()
+    if ("input" in err or "message" in err or "conversation_number" in err or "aggregated_text" in err):
+        return 400
+    if ("llm connectivity" in err or "timed out" in err):
+        return 502
+    if "admission queue full" in err:
+        return 429
+    if "queue wait deadline" in err:
+        return 503
+    if "cassette miss" in err:
+        # Replay mode: retrying cannot help, the request was never recorded
+        return 404
+    return 500
+
+# Metric label for each status code returned by status_code_for_error
+ERROR_CATEGORIES = {
+    400: "invalid_input",
+    404: "cassette_miss",
+    429: "overloaded",
+    500: "internal",
+    502: "llm_unavailable",
+    503: "queue_timeout",
+}
+
+def record_error(message):
+    """
+    Counts an error response by category and status code (classify_errors_total).
+    Returns the status code.
+    """
+    status_code = status_code_for_error(message)
+    REGISTRY.counter(
+        "classify_errors_total", "Classification error responses by category", ("category", "status_code")
+    ).inc(category=ERROR_CATEGORIES.get(status_code, "internal"), status_code=status_code)
+    return status_code
@@ -0,0 +1,225 @@
+"""
+fewshot.py
+Retrieval of few-shot examples for the classification prompt.
+
+Instead of the same fixed examples for every conversation, each prompt gets
+the k library examples most similar to the conversation, as long as they fit
+a token budget. The library is the built-in prompt_builder.FEW_SHOTS plus an
+optional JSONL file (FEWSHOT_LIBRARY_PATH) built from labeled results with
+`python -m cli fewshot`.
+
+Similarity is TF-IDF cosine over words (handles, URLs and stop words dropped). The index is
+an inverted index in flat numpy arrays: a query gathers the postings of its
+terms in one vectorized step and scores every example with a single bincount,
+so retrieval takes tens of microseconds for libraries of thousands of examples.
+"""
+
+import hashlib
+import json
+import re
+import time
+
+from aggregator import estimate_tokens, map_role
+from metrics import REGISTRY
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+_NOISE = re.compile(r"@\w+|https?://\S+")
+# Function words carry no signal about the issue; without them, "shares a word" means "shares a topic word"
+STOP_WORDS = frozenset(
+    "a an the and or but if so to of in on at for from with by about as is are was were be been am do does did "
+    "have has had i i'm i've me my we our you your it it's its this that these those there here what which who "
+    "can could will would should please just not no yes hi hello thanks thank".split()
+)
+# Bounds for examples taken from classified results
+MAX_EXAMPLE_TOKENS = 200
+PER_LABEL = 5
+RETRIEVAL_BUCKETS = (0.00002, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(_NOISE.sub(" ", text.lower())) if token not in STOP_WORDS]
+
+
+def render_turns(messages):
+    """The few-shot user turn for a list of {"sender", "text"} messages ("Customer: ..." / "Agent: ...")."""
+    lines = []
+    for msg in messages:
+        if msg.get("sender") == "customer":
+            lines.append(f"Customer: {msg['text']}")
+        elif msg.get("sender") == "agent":
+            lines.append(f"Agent: {msg['text']}")
+    return "\n".join(lines)
+
+
+def example_from_record(record):
+    """
+    A library example {"text", "output"} from a few-shot entry ({"messages"}
+    or {"text"} plus "output") or a classified API response (tweets or
+    messages plus "classification"); None if it has neither text nor labels.
+    """
+    if not isinstance(record, dict):
+        return None
+    output = record.get("output") or record.get("classification")
+    if not isinstance(output, dict):
+        return None
+    if isinstance(record.get("text"), str):
+        text = record["text"]
+    elif record.get("tweets"):
+        text = render_turns([
+            {"sender": map_role(t.get("role")), "text": t.get("text", "")}
+            for t in record["tweets"] if isinstance(t, dict)
+        ])
+    else:
+        text = render_turns([m for m in record.get("messages") or [] if isinstance(m, dict)])
+    if not text:
+        return None
+    labels = ("categorization", "intent", "topic", "sentiment")
+    return {"text": text, "output": {key: output[key] for key in labels if key in output}}
+
+
+def load_examples(path):
+    """Library examples from a JSONL (or JSON array) file."""
+    from ingest import iter_conversations
+    examples = []
+    for record in iter_conversations(path):
+        example = example_from_record(record)
+        if example is not None:
+            examples.append(example)
+    return examples
+
+
+def select_examples(records, allowed, per_label=PER_LABEL, max_tokens=MAX_EXAMPLE_TOKENS):
+    """
+    Picks library examples from classified results: labels all within
+    `allowed` ({field: options}), at most `max_tokens` long, no repeated text,
+    and at most `per_label` per (intent, topic, sentiment) combination.
+    """
+    seen, per_combination, selected = set(), {}, []
+    for record in records:
+        example = example_from_record(record)
+        if example is None:
+            continue
+        output = example["output"]
+        if any(output.get(field) not in options for field, options in allowed.items()):
+            continue
+        if estimate_tokens(example["text"]) > max_tokens:
+            continue
+        key = " ".join(tokenize(example["text"]))
+        combination = tuple(output[field] for field in allowed)
+        if key in seen or per_combination.get(combination, 0) >= per_label:
+            continue
+        seen.add(key)
+        per_combination[combination] = per_combination.get(combination, 0) + 1
+        selected.append(example)
+    return selected
+
+
+class FewShotLibrary:
+    """
+    Labeled examples with a TF-IDF inverted index.
+    Postings are stored term by term: for term t, its examples are
+    docs[starts[t]:starts[t + 1]] with weights[...] (unit-length document vectors).
+    """
+
+    def __init__(self, examples):
+        import numpy as np
+        self.examples = list(examples)
+        # Cost of one example in the prompt: its user turn plus the JSON answer
+        self.costs = np.array([
+            estimate_tokens(e["text"]) + estimate_tokens(json.dumps(e["output"], ensure_ascii=False))
+            for e in self.examples
+        ], dtype=np.int64)
+        self.vocabulary = {}
+        doc_terms = []
+        for example in self.examples:
+            counts = {}
+            for token in tokenize(example["text"]):
+                term = self.vocabulary.setdefault(token, len(self.vocabulary))
+                counts[term] = counts.get(term, 0) + 1
+            doc_terms.append(counts)
+        size = len(self.examples)
+        df = np.zeros(len(self.vocabulary), dtype=np.float64)
+        for counts in doc_terms:
+            df[list(counts)] += 1
+        self.idf = np.log((1 + size) / (1 + df)) + 1.0
+        terms, docs, weights = [], [], []
+        for doc, counts in enumerate(doc_terms):
+            ids = np.fromiter(counts, dtype=np.int64, count=len(counts))
+            tf = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+            vector = tf * self.idf[ids]
+            norm = np.linalg.norm(vector)
+            terms.append(ids)
+            docs.append(np.full(len(ids), doc, dtype=np.int32))
+            weights.append(vector / norm if norm else vector)
+        terms = np.concatenate(terms) if terms else np.zeros(0, dtype=np.int64)
+        order = np.argsort(terms, kind="stable")
+        self.docs = np.concatenate(docs)[order] if docs else np.zeros(0, dtype=np.int32)
+        self.weights = (np.concatenate(weights)[order] if weights else np.zeros(0)).astype(np.float32)
+        self.starts = np.searchsorted(terms[order], np.arange(len(self.vocabulary) + 1))
+        self.fingerprint = hashlib.sha256(
+            json.dumps(self.examples, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.examples)
+
+    def scores(self, text):
+        """Cosine similarity of `text` to every example (zeros if nothing is shared)."""
+        import numpy as np
+        counts = {}
+        for token in tokenize(text):
+            term = self.vocabulary.get(token)
+            if term is not None:
+                counts[term] = counts.get(term, 0) + 1
+        if not counts:
+            return np.zeros(len(self.examples), dtype=np.float32)
+        ids = np.fromiter(counts, dtype=np.int64, count=len(counts))
+        query = (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))) * self.idf[ids]
+        query /= np.linalg.norm(query)
+        starts, lengths = self.starts[ids], self.starts[ids + 1] - self.starts[ids]
+        # Positions of all postings of the query terms, without a Python loop per term
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.bincount(self.docs[offsets], weights=self.weights[offsets] * np.repeat(query, lengths),
+                           minlength=len(self.examples))
+
+    def search(self, text, k=3, budget=400):
+        """
+        Indices of up to `k` examples most similar to `text` whose total cost
+        fits `budget` tokens, most similar first. Examples sharing no word with
+        the text are never returned.
+        """
+        import numpy as np
+        if not self.examples or k <= 0 or budget <= 0:
+            return []
+        scores = self.scores(text)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > 4 * k:
+            candidates = candidates[np.argpartition(-scores[candidates], 4 * k)[:4 * k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        chosen, spent = [], 0
+        for index in candidates:
+            cost = int(self.costs[index])
+            if spent + cost > budget:
+                continue
+            chosen.append(int(index))
+            spent += cost
+            if len(chosen) == k:
+                break
+        return chosen
+
+    def turns(self, text, k=3, budget=400):
+        """
+        Few-shot (role, content) turns for `text`: user/assistant pairs of the
+        retrieved examples, the most similar one last (closest to the query).
+        """
+        started = time.perf_counter()
+        chosen = self.search(text, k, budget)
+        REGISTRY.histogram("fewshot_retrieval_seconds", "Time to retrieve few-shot examples for one prompt",
+                           buckets=RETRIEVAL_BUCKETS).observe(time.perf_counter() - started)
+        REGISTRY.counter("fewshot_examples_total", "Few-shot examples placed in prompts").inc(len(chosen))
+        result = []
+        for index in reversed(chosen):
+            example = self.examples[index]
+            result.append(("user", example["text"]))
+            result.append(("assistant", json.dumps(example["output"], ensure_ascii=False)))
+        return result
@@ -0,0 +1,341 @@
+"""
+ingest.py
+Streaming ingestion of raw tweet dumps into conversation records.
+
+Reads a flat tweet table (JSON array, JSONL or CSV, e.g. the customer support
+on Twitter dump with tweet_id, author_id, inbound, created_at, text and
+in_response_to_tweet_id) and reconstructs reply threads as
+ConversationRequest-shaped records, tweets ordered by created_at:
+
+    {"conversation_number": "<root tweet_id>", "tweets": [{"tweet_id", "author_id", "role", ...}]}
+
+Two streaming passes keep memory bounded by a compact index rather than the
+text:
+  1. Builds the reply-to index. Tweet ids, parent ids, interned author ids and
+     inbound flags go into flat arrays (~21 bytes per tweet). Thread roots are
+     then resolved with vectorized pointer jumping.
+  2. Re-reads the dump and buffers a thread's tweets only until its last
+     tweet has been seen, then yields the thread.
+
+iter_json_array and iter_conversations stream JSON arrays and JSONL exports
+for the other readers too (cli, local_classifier, fewshot).
+
+Roles come from a `role` column (via aggregator.map_role) when the dump has
+one, else from `inbound`; without either, the author of the root tweet is the
+customer. Tweets without an integer tweet_id are skipped, as are repeated
+tweet_ids.
+"""
+
+import csv
+import json
+import math
+from array import array
+from datetime import datetime
+
+from aggregator import map_role
+
+FORMATS = ("json", "jsonl", "csv")
+TWITTER_TIME = "%a %b %d %H:%M:%S %z %Y"
+PARENT_FIELDS = ("in_response_to_tweet_id", "in_reply_to_status_id", "in_reply_to_tweet_id")
+
+_UNKNOWN = -1
+
+
+def detect_format(path):
+    lower = path.lower()
+    if lower.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if lower.endswith(".csv"):
+        return "csv"
+    return "json"
+
+
+def iter_tweet_records(path, fmt=None):
+    """Streams raw tweet dicts from a JSON array, JSONL or CSV file."""
+    fmt = fmt or detect_format(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported tweet dump format: {fmt}")
+    if fmt == "csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            yield from csv.DictReader(f)
+    elif fmt == "jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from iter_json_array(f)
+
+
+def iter_json_array(f, chunk_size=65536):
+    """
+    Yields the elements of a top-level JSON array one at a time without
+    loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace and separators between elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if not started and pos < len(buffer):
+            if buffer[pos] != "[":
+                raise ValueError("Input is not a JSON array")
+            started = True
+            pos += 1
+            continue
+        if started and pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos < len(buffer):
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number at the end of the buffer may be incomplete
+                if end < len(buffer) or eof:
+                    yield obj
+                    pos = end
+                    continue
+        if eof:
+            if not started or pos >= len(buffer):
+                raise ValueError("Unexpected end of JSON array")
+            continue
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_conversations(path):
+    """
+    Streams conversation records from a JSONL file or a JSON array export
+    (e.g. sprintcare_*.json).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+
+def parse_tweet_id(value):
+    """Integer tweet id from an int or string ("8", "8.0" as written by pandas); None if absent or invalid."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    if value.endswith(".0"):
+        value = value[:-2]
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_inbound(value):
+    """True/False from a bool or a CSV string, None when unknown."""
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower() if value is not None else ""
+    if value in ("true", "1", "yes"):
+        return True
+    if value in ("false", "0", "no"):
+        return False
+    return None
+
+
+def parse_created_at(value):
+    """Epoch seconds from Twitter's "Tue Oct 31 21:45:10 +0000 2017" or ISO 8601; None if unparseable."""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return datetime.strptime(value, TWITTER_TIME).timestamp()
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def _parent_id(record):
+    for field in PARENT_FIELDS:
+        if record.get(field) not in (None, ""):
+            return parse_tweet_id(record[field])
+    return None
+
+
+class ReplyIndex:
+    """
+    Reply-to index over the valid tweets of a dump, in file order. Positions
+    (not tweet ids) link the arrays; author ids are interned to small integers.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.parents = array("q")
+        self.authors = array("I")
+        self.inbound = array("b")
+        self.author_names = []
+        self._author_index = {}
+        self.skipped = 0
+        self.duplicates = 0
+        self.roots = None
+        self.sizes = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern_author(self, author_id):
+        author_id = str(author_id or "")
+        index = self._author_index.get(author_id)
+        if index is None:
+            index = self._author_index[author_id] = len(self.author_names)
+            self.author_names.append(author_id)
+        return index
+
+    def add(self, record):
+        """Indexes one raw tweet; returns False (and counts it) when it has no valid tweet_id."""
+        tweet_id = parse_tweet_id(record.get("tweet_id")) if isinstance(record, dict) else None
+        if tweet_id is None:
+            self.skipped += 1
+            return False
+        parent = _parent_id(record)
+        inbound = parse_inbound(record.get("inbound"))
+        self.ids.append(tweet_id)
+        self.parents.append(_UNKNOWN if parent is None else parent)
+        self.authors.append(self.intern_author(record.get("author_id")))
+        self.inbound.append(_UNKNOWN if inbound is None else int(inbound))
+        return True
+
+    def resolve(self):
+        """
+        Computes the thread root position of every tweet (roots: replies to tweets
+        missing from the dump start their own thread) and the size of every thread.
+        Repeated tweet_ids get root -1 and are dropped.
+        """
+        import numpy as np
+        count = len(self.ids)
+        ids = np.frombuffer(self.ids, dtype=np.int64) if count else np.zeros(0, dtype=np.int64)
+        parents = np.frombuffer(self.parents, dtype=np.int64) if count else np.zeros(0, dtype=np.int64)
+        positions = np.arange(count, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        sorted_ids = ids[order]
+        duplicate = np.zeros(count, dtype=bool)
+        if count > 1:
+            duplicate[order[1:][sorted_ids[1:] == sorted_ids[:-1]]] = True
+        parent = positions.copy()
+        linked = np.flatnonzero(parents != _UNKNOWN)
+        if count and len(linked):
+            found = np.minimum(np.searchsorted(sorted_ids, parents[linked]), count - 1)
+            hit = sorted_ids[found] == parents[linked]
+            parent[linked[hit]] = order[found[hit]]
+        # Pointer jumping: every step halves the remaining distance to the root
+        roots = parent
+        for _ in range(max(1, math.ceil(math.log2(count + 1))) + 1):
+            following = roots[roots]
+            if np.array_equal(following, roots):
+                break
+            roots = following
+        roots = np.where(duplicate, -1, roots)
+        self.duplicates = int(duplicate.sum())
+        self.roots = roots
+        self.sizes = np.bincount(roots[roots >= 0], minlength=count) if count else np.zeros(0, dtype=np.int64)
+        return self
+
+    def stats(self):
+        return {
+            "tweets": len(self.ids),
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "threads": int((self.sizes > 0).sum()) if self.sizes is not None else None,
+            "authors": len(self.author_names),
+        }
+
+
+def build_index(path, fmt=None):
+    """Pass 1: streams the dump into a resolved ReplyIndex."""
+    index = ReplyIndex()
+    for record in iter_tweet_records(path, fmt):
+        index.add(record)
+    return index.resolve()
+
+
+def _tweet(index, position, record, root):
+    sender = map_role(record.get("role"))
+    if sender == "unknown":
+        inbound = index.inbound[position]
+        if inbound == _UNKNOWN:
+            # No role or inbound flag: the author who opened the thread is the customer
+            inbound = index.authors[position] == index.authors[root]
+        sender = "customer" if inbound else "agent"
+    return {
+        "tweet_id": index.ids[position],
+        "author_id": index.author_names[index.authors[position]],
+        "role": "Customer" if sender == "customer" else "Service Provider",
+        "inbound": sender == "customer",
+        "created_at": str(record.get("created_at") or ""),
+        "text": str(record.get("text") or ""),
+    }
+
+
+def _chronological(tweet):
+    created = parse_created_at(tweet["created_at"])
+    return (math.inf if created is None else created, tweet["tweet_id"])
+
+
+def _thread(index, root, tweets, stats):
+    tweets.sort(key=_chronological)
+    stats["threads"] += 1
+    return {"conversation_number": str(index.ids[root]), "tweets": tweets}
+
+
+def iter_threads(path, fmt=None, min_tweets=1, stats=None):
+    """
+    Yields reconstructed conversations from a raw tweet dump (two streaming
+    passes; see the module docstring). Threads with fewer than `min_tweets`
+    tweets are dropped. `stats`, if given, is filled with index and output counts.
+    """
+    from logger import logger
+    index = build_index(path, fmt)
+    summary = index.stats()
+    summary.update({"threads": 0, "dropped_threads": 0})
+    open_threads = {}
+    position = 0
+    for record in iter_tweet_records(path, fmt):
+        if parse_tweet_id(record.get("tweet_id") if isinstance(record, dict) else None) is None:
+            continue
+        current, position = position, position + 1
+        root = int(index.roots[current])
+        if root < 0:
+            continue
+        size = int(index.sizes[root])
+        if size < min_tweets:
+            summary["dropped_threads"] += current == root
+            continue
+        tweet = _tweet(index, current, record, root)
+        if size == 1:
+            yield _thread(index, root, [tweet], summary)
+            continue
+        tweets = open_threads.setdefault(root, [])
+        tweets.append(tweet)
+        if len(tweets) == size:
+            del open_threads[root]
+            yield _thread(index, root, tweets, summary)
+    # Only reply cycles leave threads open; emit what was collected
+    for root, tweets in open_threads.items():
+        yield _thread(index, root, tweets, summary)
+    logger.info("Ingested tweet dump %s: %s", path, summary)
+    if stats is not None:
+        stats.update(summary)
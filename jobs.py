@@ -0,0 +1,599 @@
+"""
+jobs.py
+Asynchronous classification jobs on a persistent SQLite queue.
+
+POST /jobs stores one or many conversations as a job and returns its id at
+once; GET /jobs/{id} reports progress and results, and can long-poll
+(?wait=seconds, capped at JOBS_MAX_WAIT_SECONDS so it stays under gateway
+timeouts). JOB_WORKERS asyncio workers in the server process drain the
+queue through the normal async pipeline (cache, admission, cascade, ...).
+SQLite calls from the event loop go through asyncio.to_thread, so a commit
+never stalls in-flight requests.
+
+Every item is committed to JOBS_DB_PATH before the job id is returned. A
+claimed item is leased to the claiming process for JOBS_LEASE_SECONDS
+(default 60), renewed while it runs; items whose lease expired (their process
+died) are re-queued by any live process, at startup and periodically, so an
+accepted job is finished after a restart without running items that another
+process on the same database still holds. Overload and LLM errors (429, 5xx)
+are retried with exponential backoff up to JOB_RETRIES times; other errors
+are final and reported per item like /classify/batch results. A job with a
+webhook_url gets its final state POSTed there when it completes (retried,
+and re-sent after a restart until delivered). Webhook hosts must be listed in
+WEBHOOK_ALLOWED_HOSTS when it is set, and otherwise must resolve to public
+addresses only (no loopback, private or link-local targets such as the
+Ollama port or a cloud metadata service); redirects are not followed.
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import httpx
+
+from admission import PRIORITIES
+from api import classify_conversation_async
+from conversation import Conversation
+from error_handler import error_response, record_error, status_code_for_error
+from logger import logger
+from metrics import REGISTRY
+
+WEBHOOK_TIMEOUT_SECONDS = 10.0
+WEBHOOK_ATTEMPTS = 3
+JOB_SECONDS_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0)
+
+_store = None
+_store_path = None
+_store_lock = threading.Lock()
+_workers = None
+
+
+def jobs_db_path():
+    return os.getenv("JOBS_DB_PATH") or os.path.join(os.getenv("WORKING_DIR", "./data"), "jobs.db")
+
+
+def max_wait_seconds():
+    """Upper bound of a GET /jobs/{id} long-poll (JOBS_MAX_WAIT_SECONDS, default 25)."""
+    return float(os.getenv("JOBS_MAX_WAIT_SECONDS", "25"))
+
+
+def max_job_size():
+    """Conversations accepted per job (JOBS_MAX_CONVERSATIONS, default 10000)."""
+    return int(os.getenv("JOBS_MAX_CONVERSATIONS", "10000"))
+
+
+def _retryable(status_code):
+    # Shed by admission control or failed on the LLM side: worth another attempt later
+    return status_code == 429 or status_code >= 500
+
+
+def _item_record(index, conversation_number, result):
+    """Result record of one job item, in the shape of a /classify/batch line."""
+    if isinstance(result, dict) and "error" in result:
+        return {
+            "index": index,
+            "conversation_number": conversation_number,
+            "status_code": record_error(result["error"]),
+            "error": result["error"],
+        }
+    return {"index": index, "conversation_number": conversation_number, "status_code": 200, "result": result}
+
+
+class JobItem:
+    """A claimed queue entry."""
+    __slots__ = ("job_id", "index", "request", "priority", "attempts")
+
+    def __init__(self, job_id, index, request, priority, attempts):
+        self.job_id = job_id
+        self.index = index
+        self.request = request
+        self.priority = priority
+        self.attempts = attempts
+
+
+class JobStore:
+    """
+    Jobs and their items in SQLite. Queued items are claimed in priority
+    order, then submission order; all writes are short transactions. Claims
+    are leased to this store's `owner` for `lease_seconds`.
+    """
+
+    def __init__(self, db_path, lease_seconds=60.0):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        # Autocommit mode: transactions are explicit (BEGIN IMMEDIATE) where needed
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, priority TEXT NOT NULL, webhook_url TEXT, "
+            "total INTEGER NOT NULL, done INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL, "
+            "webhook_delivered INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, status TEXT NOT NULL, rank INTEGER NOT NULL, "
+            "request TEXT NOT NULL, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "not_before REAL NOT NULL DEFAULT 0, owner TEXT, lease_until REAL, PRIMARY KEY (job_id, idx))"
+        )
+        # Databases created before leases existed
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(job_items)")}
+        for column in ("owner TEXT", "lease_until REAL"):
+            if column.split()[0] not in columns:
+                self._db.execute(f"ALTER TABLE job_items ADD COLUMN {column}")
+        # Index entries are ordered by (status, rank, rowid): claiming reads the head of the queue
+        self._db.execute("CREATE INDEX IF NOT EXISTS job_items_queue ON job_items (status, rank)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at)")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def submit(self, items, priority="default", webhook_url=None):
+        """
+        Stores a job. `items` are (request dict, None) for conversations to
+        classify or (conversation_number, error response) for invalid ones, which
+        are recorded as finished right away. Returns the job id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        rank = PRIORITIES.get(priority, PRIORITIES["default"])
+        rows, failed = [], 0
+        for index, (request, error) in enumerate(items):
+            if error is None:
+                rows.append((job_id, index, "queued", rank, json.dumps(request, ensure_ascii=False), None))
+            else:
+                failed += 1
+                record = _item_record(index, request, error)
+                rows.append((job_id, index, "failed", rank, "null", json.dumps(record, ensure_ascii=False)))
+        finished = failed == len(rows)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT INTO jobs (id, status, priority, webhook_url, total, done, failed, created_at, "
+                    "updated_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, "completed" if finished else "queued", priority, webhook_url, len(rows), failed,
+                     failed, now, now, now if finished else None),
+                )
+                self._db.executemany(
+                    "INSERT INTO job_items (job_id, idx, status, rank, request, result) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def claim(self, now=None):
+        """Marks the next due queued item as running (leased to this store) and returns it as a JobItem, or None."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT i.rowid, i.job_id, i.idx, i.request, i.attempts, j.priority "
+                    "FROM job_items i JOIN jobs j ON j.id = i.job_id "
+                    "WHERE i.status = 'queued' AND i.not_before <= ? ORDER BY i.rank, i.rowid LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    self._db.execute("COMMIT")
+                    return None
+                rowid, job_id, index, request, attempts, priority = row
+                self._db.execute(
+                    "UPDATE job_items SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ? "
+                    "WHERE rowid = ?",
+                    (self.owner, now + self.lease_seconds, rowid),
+                )
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                    (now, job_id),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return JobItem(job_id, index, json.loads(request), priority, attempts + 1)
+
+    def retry(self, item, delay):
+        """Puts a claimed item back in the queue, due after `delay` seconds."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_items SET status = 'queued', not_before = ?, owner = NULL "
+                "WHERE job_id = ? AND idx = ? AND status = 'running' AND owner = ?",
+                (time.time() + delay, item.job_id, item.index, self.owner),
+            )
+
+    def complete(self, item, record):
+        """
+        Stores the result record of a claimed item. Returns True when this was
+        the job's last outstanding item (the job is then completed). Nothing is
+        stored when the lease was lost and the item re-queued meanwhile.
+        """
+        now = time.time()
+        failed = int(record["status_code"] != 200)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                updated = self._db.execute(
+                    "UPDATE job_items SET status = ?, result = ?, owner = NULL "
+                    "WHERE job_id = ? AND idx = ? AND status = 'running' AND owner = ?",
+                    ("failed" if failed else "done", json.dumps(record, ensure_ascii=False), item.job_id, item.index,
+                     self.owner),
+                ).rowcount
+                finished = False
+                if updated:
+                    self._db.execute(
+                        "UPDATE jobs SET done = done + 1, failed = failed + ?, updated_at = ? WHERE id = ?",
+                        (failed, now, item.job_id),
+                    )
+                    finished = bool(self._db.execute(
+                        "UPDATE jobs SET status = 'completed', finished_at = ? WHERE id = ? AND done = total",
+                        (now, item.job_id),
+                    ).rowcount)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return finished
+
+    def renew(self, now=None):
+        """Extends the leases of the items this store is running. Returns how many."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                "UPDATE job_items SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                (now + self.lease_seconds, self.owner),
+            ).rowcount
+
+    def recover(self, now=None):
+        """Re-queues running items whose lease expired (their process died). Returns how many."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                "UPDATE job_items SET status = 'queued', not_before = 0, owner = NULL "
+                "WHERE status = 'running' AND COALESCE(lease_until, 0) < ?",
+                (now,),
+            ).rowcount
+
+    def undelivered_webhooks(self):
+        """Ids of completed jobs whose webhook has not been delivered yet."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'completed' AND webhook_url IS NOT NULL "
+                "AND webhook_delivered = 0"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_webhook_delivered(self, job_id):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET webhook_delivered = 1 WHERE id = ?", (job_id,))
+
+    def get(self, job_id, include_results=True):
+        """Job status, counts and (finished items only, by index) results; None if unknown."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, priority, webhook_url, total, done, failed, created_at, updated_at, finished_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            results = None
+            if include_results:
+                results = [json.loads(r[0]) for r in self._db.execute(
+                    "SELECT result FROM job_items WHERE job_id = ? AND result IS NOT NULL ORDER BY idx", (job_id,)
+                )]
+        status, priority, webhook_url, total, done, failed, created_at, updated_at, finished_at = row
+        job = {
+            "job_id": job_id,
+            "status": status,
+            "priority": priority,
+            "total": total,
+            "done": done,
+            "failed": failed,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "finished_at": finished_at,
+        }
+        if webhook_url:
+            job["webhook_url"] = webhook_url
+        if results is not None:
+            job["results"] = results
+        return job
+
+    def queue_depth(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM job_items WHERE status = 'queued'").fetchone()[0]
+
+    def purge(self, older_than):
+        """Deletes jobs that finished before the epoch time `older_than`. Returns how many."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [r[0] for r in self._db.execute(
+                    "SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,)
+                )]
+                for job_id in ids:
+                    self._db.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return len(ids)
+
+
+def webhook_allowed_hosts():
+    return {host.strip().lower() for host in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+
+
+def _public_address(address):
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def webhook_url_error(url):
+    """
+    None if `url` may receive webhooks, else the reason it may not. With
+    WEBHOOK_ALLOWED_HOSTS set only those hosts are accepted; otherwise every
+    address the host resolves to must be public.
+    """
+    parsed = urlsplit(url) if isinstance(url, str) else None
+    if parsed is None or parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "Invalid input: webhook_url must be an http(s) URL"
+    host = parsed.hostname.lower()
+    allowed = webhook_allowed_hosts()
+    if allowed:
+        return None if host in allowed else "Invalid input: webhook_url host is not in WEBHOOK_ALLOWED_HOSTS"
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, ValueError):
+        return "Invalid input: webhook_url host does not resolve"
+    if not infos or not all(_public_address(info[4][0]) for info in infos):
+        return "Invalid input: webhook_url must not point to a loopback, private or link-local address"
+    return None
+
+
+async def post_webhook(url, payload):
+    """One webhook delivery attempt; True on a 2xx response."""
+    # Checked again at delivery: the host may resolve differently than at submission
+    error = await webhook_url_error(url)
+    if error is not None:
+        logger.warning("Webhook %s refused: %s", url, error)
+        return False
+    try:
+        async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT_SECONDS, follow_redirects=False) as client:
+            response = await client.post(url, json=payload)
+        return response.is_success
+    except httpx.HTTPError as e:
+        logger.warning("Webhook %s failed: %s", url, e)
+        return False
+
+
+class JobWorkers:
+    """
+    The worker pool of one server process, bound to its event loop. Also wakes
+    long-polling readers when a job completes.
+    """
+
+    def __init__(self, store, workers=4, retries=3, backoff=1.0, poll_interval=1.0):
+        self.store = store
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        # job_id -> [event set on completion, number of long-polls waiting for it]
+        self._completed = {}
+        self._tasks = set()
+
+    def start(self):
+        # Runs once at startup, before requests are served, so the store is used directly
+        recovered = self.store.recover()
+        if recovered:
+            logger.info("Re-queued %d job items whose lease expired", recovered)
+        retention = float(os.getenv("JOBS_RETENTION_HOURS", "168"))
+        if retention > 0:
+            purged = self.store.purge(time.time() - retention * 3600)
+            if purged:
+                logger.info("Purged %d finished jobs older than %sh", purged, retention)
+        for job_id in self.store.undelivered_webhooks():
+            self._spawn(self._deliver_webhook(job_id))
+        for _ in range(self.workers):
+            self._spawn(self._work())
+        self._spawn(self._keep_leases())
+        self._spawn(self._update_depth())
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        for task in list(self._tasks):
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submitted(self, job_id):
+        """Wakes idle workers for a new job (or sends its webhook if no item needed classifying)."""
+        self._wakeup.set()
+        await self._update_depth()
+        job = await asyncio.to_thread(self.store.get, job_id, False)
+        if job is not None and job["status"] == "completed" and job.get("webhook_url"):
+            self._spawn(self._deliver_webhook(job_id))
+
+    async def _update_depth(self):
+        depth = await asyncio.to_thread(self.store.queue_depth)
+        REGISTRY.gauge("job_queue_depth", "Job items waiting in the persistent queue").set(depth)
+
+    async def wait(self, job_id, timeout):
+        """
+        Returns the job once it has completed or `timeout` seconds have passed,
+        whichever comes first; None if the job does not exist.
+        """
+        job = await asyncio.to_thread(self.store.get, job_id, False)
+        if job is None or job["status"] == "completed" or timeout <= 0:
+            return await asyncio.to_thread(self.store.get, job_id)
+        waiting = self._completed.setdefault(job_id, [asyncio.Event(), 0])
+        waiting[1] += 1
+        try:
+            await asyncio.wait_for(waiting[0].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiting[1] -= 1
+            # The last long-poll to give up drops the entry; completion pops it otherwise
+            if not waiting[1] and self._completed.get(job_id) is waiting:
+                del self._completed[job_id]
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def _keep_leases(self):
+        """Renews this process's leases and re-queues items of processes that stopped renewing theirs."""
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            await asyncio.to_thread(self.store.renew)
+            recovered = await asyncio.to_thread(self.store.recover)
+            if recovered:
+                logger.info("Re-queued %d job items whose lease expired", recovered)
+                self._wakeup.set()
+
+    async def _work(self):
+        while True:
+            # Cleared before claiming, so a submit that races with an empty claim still wakes us
+            self._wakeup.clear()
+            item = await asyncio.to_thread(self.store.claim)
+            if item is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(item)
+            except Exception as e:
+                logger.error("Job %s item %d failed: %s", item.job_id, item.index, e)
+                await self._finish(item, _item_record(item.index, None, error_response("Job item error")))
+
+    async def _run(self, item):
+        conversation = Conversation.from_dict(item.request)
+        if isinstance(conversation, dict):
+            await self._finish(item, _item_record(item.index, item.request.get("conversation_number"), conversation))
+            return
+        result = await classify_conversation_async(conversation, item.priority)
+        if isinstance(result, dict) and "error" in result:
+            status_code = status_code_for_error(result["error"])
+            if _retryable(status_code) and item.attempts <= self.retries:
+                delay = self.backoff * (2 ** (item.attempts - 1)) * (0.5 + random.random())
+                await asyncio.to_thread(self.store.retry, item, delay)
+                REGISTRY.counter("job_items_total", "Job items processed by outcome", ("outcome",)).inc(
+                    outcome="retried")
+                logger.warning("Job %s item %d: %s; retrying in %.1fs", item.job_id, item.index, result["error"],
+                               delay)
+                return
+        await self._finish(item, _item_record(item.index, conversation.conversation_number, result))
+
+    async def _finish(self, item, record):
+        REGISTRY.counter("job_items_total", "Job items processed by outcome", ("outcome",)).inc(
+            outcome="ok" if record["status_code"] == 200 else "failed")
+        if not await asyncio.to_thread(self.store.complete, item, record):
+            return
+        job = await asyncio.to_thread(self.store.get, item.job_id, False)
+        REGISTRY.counter("jobs_completed_total", "Jobs whose every item has finished").inc()
+        REGISTRY.histogram("job_seconds", "Time from job submission to completion",
+                           buckets=JOB_SECONDS_BUCKETS).observe(
+            job["finished_at"] - job["created_at"])
+        logger.info("Job %s completed: %d/%d failed", item.job_id, job["failed"], job["total"],
+                    extra={"event": "job_completed"})
+        waiting = self._completed.pop(item.job_id, None)
+        if waiting is not None:
+            waiting[0].set()
+        if job.get("webhook_url"):
+            self._spawn(self._deliver_webhook(item.job_id))
+        await self._update_depth()
+
+    async def _deliver_webhook(self, job_id):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return
+        counter = REGISTRY.counter("job_webhooks_total", "Job completion webhook deliveries", ("outcome",))
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            if await post_webhook(job["webhook_url"], job):
+                await asyncio.to_thread(self.store.mark_webhook_delivered, job_id)
+                counter.inc(outcome="delivered")
+                return
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+        counter.inc(outcome="failed")
+        logger.error("Webhook for job %s not delivered after %d attempts", job_id, WEBHOOK_ATTEMPTS)
+
+
+def get_job_store():
+    """Returns the process-wide job store for JOBS_DB_PATH."""
+    global _store, _store_path
+    path = jobs_db_path()
+    if _store_path != path:
+        with _store_lock:
+            if _store_path != path:
+                if _store is not None:
+                    _store.close()
+                _store = JobStore(path, float(os.getenv("JOBS_LEASE_SECONDS", "60")))
+                _store_path = path
+    return _store
+
+
+def start_job_workers():
+    """Starts this process's job workers on the running event loop (called at app startup)."""
+    global _workers
+    _workers = JobWorkers(
+        get_job_store(),
+        workers=int(os.getenv("JOB_WORKERS", "4")),
+        retries=int(os.getenv("JOB_RETRIES", "3")),
+        backoff=float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "1")),
+    )
+    _workers.start()
+    return _workers
+
+
+def get_job_workers():
+    return _workers
+
+
+async def stop_job_workers():
+    global _workers
+    if _workers is not None:
+        await _workers.stop()
+        _workers = None
+
+
+def reset_job_store():
+    """Closes and forgets the job store (used by tests)."""
+    global _store, _store_path
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = None
+        _store_path = None
@@ -3,66 +3,503 @@ llm_wrapper.py
 Handles LLM connectivity and interaction.
 """
 
+import asyncio
+import json
+import os
+import time
 
+import httpx
+import requests
+
+from backends import get_backend_pool, timeouts
+from cassette import get_cassette, request_key
+from classifier import extract_json
+from error_handler import error_response
+from logger import logger, log_payload
+from metrics import REGISTRY, TOKEN_BUCKETS
+from prompt_builder import CLASSIFICATION_SCHEMA, CLASSIFICATION_NUM_PREDICT
+from tracing import annotate, traced
+
+# Shared pooled HTTP client for the async path; created at app startup.
+_async_client = None
+
+
+def _ollama_settings():
+    """
+    Reads the Ollama backends and model from the environment.
+    Returns (backend_pool, model) or an error response if OLLAMA_MODEL is unset.
+    """
+    ollama_model = os.getenv("OLLAMA_MODEL")
+    if not ollama_model:
+        return {"error": "OLLAMA_MODEL environment variable not set"}
+    return get_backend_pool(), ollama_model
+
+
+def _build_payload(model, messages, num_predict=None, schema=None):
+    """
+    Chat request constrained to `schema` (default: the single classification
+    schema) via Ollama's `format`, with a generation cap sized to that schema.
+    LLM_NUM_PREDICT overrides the computed cap. Streamed so the reply can be
+    cut off shortly after the JSON object is complete. OLLAMA_KEEP_ALIVE (e.g.
+    "30m", "-1") keeps the model loaded between requests.
+    """
+    if num_predict is None:
+        num_predict = int(os.getenv("LLM_NUM_PREDICT", "0")) or CLASSIFICATION_NUM_PREDICT
+    payload = {
+        "model": model,
+        "messages": messages,
+        "format": schema or CLASSIFICATION_SCHEMA,
+        "options": {"num_predict": num_predict},
+        "stream": True
+    }
+    keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
+    if keep_alive:
+        payload["keep_alive"] = keep_alive
+    return payload
+
+
+def stream_tail_chunks():
+    return int(os.getenv("LLM_STREAM_TAIL_CHUNKS", "8"))
+
+
+class _StreamReader:
+    """
+    Accumulates /api/chat stream chunks (one JSON object per line) and tracks
+    brace depth outside string literals, so it knows when the top-level JSON
+    object in the content is balanced. After that, up to `tail_chunks` more
+    chunks are read waiting for Ollama's final "done" chunk, the only one
+    carrying token counts and durations; reading stops at that chunk or at
+    the cap. A non-streamed body is handled as a single final chunk.
+    """
+
+    def __init__(self, tail_chunks=None):
+        self.parts = []
+        self.chunks = 0
+        self.final = None
+        self.error = None
+        self.complete = False
+        self.tail_chunks = stream_tail_chunks() if tail_chunks is None else tail_chunks
+        self._tail = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, line):
+        """Consumes one line; returns True once nothing more needs to be read."""
+        if not line or not line.strip():
+            return False
+        data = json.loads(line)
+        self.chunks += 1
+        if data.get("error"):
+            self.error = data["error"]
+            return True
+        # Whatever the model emits after the object is not part of the reply
+        was_complete = self.complete
+        if "message" in data:
+            content = data["message"].get("content", "")
+        elif data.get("messages"):
+            content = data["messages"][0].get("content", "")
+        else:
+            content = ""
+        if content and not was_complete:
+            self._scan(content)
+        # A body without "done" is a plain non-streamed reply
+        if data.get("done") or "done" not in data:
+            self.final = data
+            return True
+        if was_complete:
+            self._tail += 1
+            return self._tail >= self.tail_chunks
+        return self.complete and self.tail_chunks <= 0
+
+    def _scan(self, text):
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = self._depth > 0
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.parts.append(text[:i + 1])
+                    self.complete = True
+                    return
+        self.parts.append(text)
+
+    def content(self):
+        return "".join(self.parts)
+
+    def usage(self):
+        """Ollama's final token accounting, or an estimate when the stream was cut short."""
+        if self.final is not None and "eval_count" in self.final:
+            return self.final
+        # One streamed chunk carries roughly one generated token
+        return {"eval_count": self.chunks, "estimated": True}
+
+
+def _record_usage(data):
+    """
+    Records Ollama's token accounting for one /api/chat call.
+    prompt_eval_count only counts tokens Ollama had to evaluate, so a reused
+    prompt-prefix KV cache shows up as a small count on repeated requests.
+    """
+    prompt_eval_count = data.get("prompt_eval_count")
+    eval_count = data.get("eval_count")
+    if prompt_eval_count is not None:
+        REGISTRY.histogram(
+            "llm_prompt_eval_tokens", "Prompt tokens evaluated by Ollama per request", buckets=TOKEN_BUCKETS
+        ).observe(prompt_eval_count)
+    if eval_count is not None:
+        REGISTRY.histogram(
+            "llm_eval_tokens", "Tokens generated by Ollama per request", buckets=TOKEN_BUCKETS
+        ).observe(eval_count)
+    tokens = REGISTRY.counter("llm_tokens_total", "Tokens processed by Ollama", ("kind",))
+    tokens.inc(prompt_eval_count or 0, kind="prompt")
+    tokens.inc(eval_count or 0, kind="generated")
+    # Ollama reports durations in nanoseconds
+    durations = REGISTRY.histogram("llm_duration_seconds", "Ollama-reported time per phase of a request", ("phase",))
+    for phase in ("total", "load", "prompt_eval", "eval"):
+        value = data.get(f"{phase}_duration")
+        if value is not None:
+            durations.observe(value / 1e9, phase=phase)
+    annotate(prompt_eval_count=prompt_eval_count, eval_count=eval_count,
+             eval_count_estimated=bool(data.get("estimated")))
+    logger.info("Ollama usage: prompt_eval_count=%s eval_count=%s", prompt_eval_count, eval_count)
+
+
+def _parse_content(content):
+    """
+    Parses the JSON object in the LLM reply text, repairing fenced, wrapped
+    or truncated JSON (classifier.extract_json).
+    Returns the parsed object or an error response carrying the raw `content`
+    (for the "fix this JSON" follow-up).
+    """
+    content = content.strip()
+    if not content:
+        logger.error("Empty LLM response content")
+        return error_response("Empty LLM response content")
+    parsed, repaired = extract_json(content)
+    if parsed is None:
+        logger.error("Failed to parse LLM response content as JSON")
+        error = error_response("Failed to parse LLM response as JSON")
+        error["content"] = content
+        return error
+    if repaired:
+        REGISTRY.counter("classification_repairs_total", "Local repairs applied to LLM replies", ("kind",)).inc(
+            kind="json")
+        logger.debug("Repaired JSON in LLM reply: %s", parsed)
+    else:
+        logger.debug("Extracted JSON object: %s", parsed)
+    return parsed
+
+
+def _finish_stream(reader):
+    """Records usage for a (possibly early-terminated) stream and parses its content."""
+    if reader.error:
+        logger.error("LLM error: %s", reader.error)
+        return {"error": "LLM error"}
+    if reader.complete and reader.final is None:
+        REGISTRY.counter(
+            "llm_early_stops_total", "LLM streams closed after the JSON object without Ollama's final chunk"
+        ).inc()
+    log_payload("Raw LLM response", reader.content())
+    _record_usage(reader.usage())
+    return _parse_content(reader.content())
+
+
+def _llm_in_flight():
+    return REGISTRY.gauge("llm_requests_in_flight", "Ollama requests currently in flight")
+
+
+def _cassette_lookup(model, payload):
+    """
+    Consults the record/replay cassette (LLM_MODE). Returns (cassette, key,
+    result): result is the recorded answer, or the miss error in replay mode,
+    and None when Ollama must be called. cassette is None in live mode.
+    """
+    cassette = get_cassette()
+    if cassette is None:
+        return None, None, None
+    key = request_key(model, payload)
+    result = cassette.lookup(key)
+    if result is None and cassette.mode == "replay":
+        result = cassette.miss(key)
+    return cassette, key, result
+
+
+def _no_backend_error():
+    logger.error("LLM connectivity error: no available Ollama backend")
+    return {"error": "LLM connectivity error"}
+
+
+def _stream_sync(backend, payload):
+    """One streamed /api/chat call on `backend`; raises on transport or HTTP errors."""
+    reader = _StreamReader()
+    in_flight = _llm_in_flight()
+    in_flight.inc()
+    try:
+        with requests.post(backend.chat_url, json=payload, timeout=timeouts(), stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if reader.feed(line):
+                    # Closing the connection stops any further generation on the server
+                    break
+    finally:
+        in_flight.dec()
+    return reader
+
+
+def _call_sizes(result, messages, *args, **kwargs):
+    """Span attributes of an LLM call."""
+    return {
+        "model": os.getenv("OLLAMA_MODEL") or "",
+        "messages": len(messages),
+        "prompt_chars": sum(len(message.get("content") or "") for message in messages),
+    }
+
+
+@traced("ollama_classify", _call_sizes)
 def ollama_classify(messages):
     """
     Sends message list to Ollama LLM (localhost) and returns parsed JSON response.
-    Uses OLLAMA_MODEL environment variable for model selection.
+    Uses OLLAMA_MODEL environment variable for model selection. The reply is
+    schema-constrained and streamed; reading stops at Ollama's final chunk, or
+    LLM_STREAM_TAIL_CHUNKS chunks after the object is complete.
+    Routes over the configured backends and fails over to the next one when a
+    backend errors or times out.
     Handles errors and logs interactions.
     """
-    import os
-    import requests
-    import json
-    from logger import logger
-    from error_handler import error_response
     try:
-        ollama_endpoint = os.getenv("OLLAMA_ENDPOINT", "http://localhost:11434")
-        ollama_model = os.getenv("OLLAMA_MODEL")
-        if not ollama_model:
-            logger.error("OLLAMA_MODEL environment variable not set")
-            return {"error": "OLLAMA_MODEL environment variable not set"}
-        url = f"{ollama_endpoint}/api/chat"
-        payload = {
-            "model": ollama_model,
-            "messages": messages,
-            "options": {"num_predict": 700},
-            "stream": False
-        }
-        logger.info(f"Sending messages to Ollama: {payload}")
-        response = requests.post(url, json=payload, timeout=None)
-        response.raise_for_status()
-        data = response.json()
-        logger.info(f"Raw LLM response: {data}")
-        content = ""
-        if "message" in data:
-            content = data["message"].get("content", "").strip()
-        elif "messages" in data and len(data["messages"]) > 0:
-            content = data["messages"][0].get("content", "").strip()
-        if not content:
-            logger.error("Empty LLM response content")
-            return error_response("Empty LLM response content")
+        settings = _ollama_settings()
+        if isinstance(settings, dict):
+            logger.error(settings["error"])
+            return settings
+        pool, ollama_model = settings
+        payload = _build_payload(ollama_model, messages)
+        log_payload("Sending messages to Ollama", payload)
+        cassette, key, recorded = _cassette_lookup(ollama_model, payload)
+        if recorded is not None:
+            return recorded
+        tried = []
+        last_error = None
+        while True:
+            backend = pool.acquire(exclude=tried)
+            if backend is None:
+                break
+            if tried:
+                REGISTRY.counter("llm_failovers_total", "LLM calls retried on another backend").inc()
+            tried.append(backend)
+            annotate(backend=backend.url, attempts=len(tried))
+            started = time.perf_counter()
+            try:
+                reader = _stream_sync(backend, payload)
+            except requests.exceptions.RequestException as e:
+                pool.release(backend, False)
+                logger.warning("Ollama backend %s failed: %s", backend.url, e)
+                last_error = e
+                continue
+            except Exception:
+                pool.release(backend, None)
+                raise
+            pool.release(backend, True, time.perf_counter() - started)
+            result = _finish_stream(reader)
+            if cassette is not None:
+                cassette.record(key, result)
+            return result
+        if isinstance(last_error, requests.exceptions.Timeout):
+            logger.error("LLM request timed out")
+            return {"error": "LLM request timed out"}
+        if last_error is not None:
+            logger.error("LLM connectivity error: %s", last_error)
+            return {"error": "LLM connectivity error"}
+        return _no_backend_error()
+    except Exception as e:
+        logger.error("LLM error: %s", e)
+        return {"error": "LLM error"}
+
+
+def init_async_client():
+    """
+    Creates the shared keep-alive connection pool used by ollama_classify_async.
+    Pool size comes from OLLAMA_MAX_CONNECTIONS (default 64).
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        max_connections = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "64"))
+        _async_client = httpx.AsyncClient(
+            timeout=None,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _async_client
+
+
+async def preload_model_async():
+    """
+    Loads OLLAMA_MODEL on every backend without generating anything (an empty
+    chat request), with OLLAMA_KEEP_ALIVE so it stays resident.
+    Returns None once at least one backend has the model loaded, else an error response.
+    """
+    settings = _ollama_settings()
+    if isinstance(settings, dict):
+        return settings
+    pool, model = settings
+    client = init_async_client()
+    connect, read = timeouts()
+    body = {"model": model, "messages": []}
+    keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
+    if keep_alive:
+        body["keep_alive"] = keep_alive
+
+    async def load(backend):
+        started = time.perf_counter()
+        try:
+            response = await client.post(
+                backend.chat_url, json=body, timeout=httpx.Timeout(read, connect=connect, pool=None)
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning("Preloading %s on %s failed: %s", model, backend.url, e)
+            return False
+        logger.info("Preloaded %s on %s in %.2fs", model, backend.url, time.perf_counter() - started)
+        return True
+
+    loaded = await asyncio.gather(*[load(backend) for backend in pool.backends])
+    if not any(loaded):
+        return error_response(f"LLM connectivity error: could not preload model {model}")
+    return None
+
+
+async def close_async_client():
+    """Closes the shared connection pool (called at app shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def _stream_async(client, pool, backend, payload):
+    """
+    One streamed /api/chat call on `backend`. Releases the backend with the
+    outcome (a cancelled hedge counts as neither success nor failure) and
+    returns the reader; raises on transport or HTTP errors.
+    """
+    connect, read = timeouts()
+    reader = _StreamReader()
+    in_flight = _llm_in_flight()
+    in_flight.inc()
+    started = time.perf_counter()
+    outcome = None
+    try:
+        async with client.stream(
+            "POST", backend.chat_url, json=payload, timeout=httpx.Timeout(read, connect=connect, pool=None)
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if reader.feed(line):
+                    # Leaving the block closes the stream, which stops generation
+                    break
+        outcome = True
+        return reader
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        outcome = False
+        raise
+    finally:
+        in_flight.dec()
+        pool.release(backend, outcome, time.perf_counter() - started if outcome else None)
+
+
+@traced("ollama_classify", _call_sizes)
+async def ollama_classify_async(messages, num_predict=None, schema=None):
+    """
+    Awaitable variant of ollama_classify.
+    Reuses the shared pooled client so many requests can be in flight at once
+    without blocking the event loop. num_predict and schema override the
+    generation cap and output schema (used for micro-batched prompts).
+    Fails over between backends like ollama_classify; with hedging enabled, a
+    request slower than the hedge percentile is also sent to a second backend
+    and the first reply wins.
+    """
+    try:
+        settings = _ollama_settings()
+        if isinstance(settings, dict):
+            logger.error(settings["error"])
+            return settings
+        pool, ollama_model = settings
+        payload = _build_payload(ollama_model, messages, num_predict, schema)
+        log_payload("Sending messages to Ollama", payload)
+        cassette, key, recorded = _cassette_lookup(ollama_model, payload)
+        if recorded is not None:
+            return recorded
+        client = init_async_client()
+        tried = []
+        pending = set()
+        last_error = None
+
+        def launch():
+            backend = pool.acquire(exclude=tried)
+            if backend is None:
+                return False
+            tried.append(backend)
+            annotate(backend=backend.url, attempts=len(tried))
+            pending.add(asyncio.ensure_future(_stream_async(client, pool, backend, payload)))
+            return True
+
+        if not launch():
+            return _no_backend_error()
+        hedge_delay = pool.hedge_delay()
+        reader = None
         try:
-            parsed = json.loads(content)
-            logger.info(f"Extracted JSON object: {parsed}")
-            return parsed
-        except Exception as e:
-            logger.error(f"Failed to parse LLM response content as JSON: {e}")
-            # Try to extract JSON substring
-            start, end = content.find("{"), content.rfind("}")
-            if start != -1 and end != -1:
-                try:
-                    parsed = json.loads(content[start:end+1])
-                    logger.info(f"Extracted JSON substring: {parsed}")
-                    return parsed
-                except Exception as e2:
-                    logger.error(f"Failed to parse JSON substring: {e2}")
-            return error_response("Failed to parse LLM response as JSON")
-    except requests.exceptions.Timeout:
-        logger.error("LLM request timed out")
-        return {"error": "LLM request timed out"}
-    except requests.exceptions.RequestException as e:
-        logger.error(f"LLM connectivity error: {str(e)}")
-        return {"error": "LLM connectivity error"}
+            while pending and reader is None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slower than the hedge percentile: race a second backend
+                    hedge_delay = None
+                    if launch():
+                        REGISTRY.counter("llm_hedged_requests_total", "LLM calls re-issued to a second backend").inc()
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        reader = task.result()
+                        break
+                    last_error = task.exception()
+                    logger.warning("Ollama backend failed: %s", last_error)
+                if reader is None and not pending:
+                    hedge_delay = None
+                    if launch():
+                        REGISTRY.counter("llm_failovers_total", "LLM calls retried on another backend").inc()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        if reader is not None:
+            result = _finish_stream(reader)
+            if cassette is not None:
+                cassette.record(key, result)
+            return result
+        if isinstance(last_error, httpx.TimeoutException):
+            logger.error("LLM request timed out")
+            return {"error": "LLM request timed out"}
+        if isinstance(last_error, httpx.HTTPError):
+            logger.error("LLM connectivity error: %s", last_error)
+            return {"error": "LLM connectivity error"}
+        if last_error is not None:
+            raise last_error
+        return _no_backend_error()
     except Exception as e:
-        logger.error(f"LLM error: {str(e)}")
+        logger.error("LLM error: %s", e)
         return {"error": "LLM error"}
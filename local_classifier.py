@@ -0,0 +1,202 @@
+"""
+local_classifier.py
+Fast local pre-classifier used as the first tier of a classification cascade.
+
+A multinomial naive Bayes model per field (intent, topic, sentiment) over hashed
+word unigrams and bigrams, trained from accumulated LLM results
+(data/classified_results_*.json / .jsonl). Predictions carry a confidence score;
+only conversations below CASCADE_THRESHOLD are escalated to the LLM.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+FIELDS = ("intent", "topic", "sentiment")
+MODEL_VERSION = 1
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+_NOISE = re.compile(r"@\w+|https?://\S+")
+
+_model = None
+_model_path = None
+_model_lock = threading.Lock()
+
+
+def features(text, buckets):
+    """Hashed unigram + bigram counts of the text as {bucket: count}."""
+    tokens = _TOKEN.findall(_NOISE.sub(" ", text.lower()))
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = {}
+    for gram in grams:
+        # crc32 is stable across processes (unlike hash()), so saved models stay valid
+        index = zlib.crc32(gram.encode("utf-8")) % buckets
+        counts[index] = counts.get(index, 0) + 1
+    return counts
+
+
+class LocalClassifier:
+    """Per-field multinomial naive Bayes over hashed n-grams."""
+
+    def __init__(self, buckets=1 << 18, alpha=0.5):
+        self.buckets = buckets
+        self.alpha = alpha
+        # field -> {"docs": {label: n}, "tokens": {label: n}, "counts": {label: {bucket: n}}}
+        self.fields = {field: {"docs": {}, "tokens": {}, "counts": {}} for field in FIELDS}
+
+    def train(self, examples, allowed=None):
+        """
+        Adds (text, classification) examples. Labels outside `allowed`
+        ({field: label list}) are ignored for that field.
+        Returns the number of examples used.
+        """
+        used = 0
+        for text, classification in examples:
+            if not text or not isinstance(classification, dict):
+                continue
+            feats = features(text, self.buckets)
+            size = sum(feats.values())
+            counted = False
+            for field in FIELDS:
+                label = classification.get(field)
+                if not isinstance(label, str) or (allowed and label not in allowed[field]):
+                    continue
+                model = self.fields[field]
+                model["docs"][label] = model["docs"].get(label, 0) + 1
+                model["tokens"][label] = model["tokens"].get(label, 0) + size
+                label_counts = model["counts"].setdefault(label, {})
+                for index, count in feats.items():
+                    label_counts[index] = label_counts.get(index, 0) + count
+                counted = True
+            used += counted
+        return used
+
+    def _predict_field(self, field, feats):
+        model = self.fields[field]
+        total_docs = sum(model["docs"].values())
+        if not total_docs:
+            return None, 0.0
+        scores = {}
+        for label, docs in model["docs"].items():
+            label_counts = model["counts"][label]
+            denominator = model["tokens"][label] + self.alpha * self.buckets
+            score = math.log(docs / total_docs)
+            for index, count in feats.items():
+                score += count * math.log((label_counts.get(index, 0) + self.alpha) / denominator)
+            scores[label] = score
+        best = max(scores, key=scores.get)
+        # Softmax probability of the best label
+        top = scores[best]
+        confidence = 1.0 / sum(math.exp(score - top) for score in scores.values())
+        return best, confidence
+
+    def predict(self, text):
+        """
+        Returns (classification, confidence) where confidence is the lowest
+        per-field posterior, or (None, 0.0) if the model cannot answer.
+        """
+        feats = features(text, self.buckets)
+        if not feats:
+            return None, 0.0
+        classification = {}
+        confidence = 1.0
+        for field in FIELDS:
+            label, field_confidence = self._predict_field(field, feats)
+            if label is None:
+                return None, 0.0
+            classification[field] = label
+            confidence = min(confidence, field_confidence)
+        return classification, confidence
+
+    def to_dict(self):
+        return {
+            "version": MODEL_VERSION,
+            "buckets": self.buckets,
+            "alpha": self.alpha,
+            "fields": {
+                field: {
+                    "docs": model["docs"],
+                    "tokens": model["tokens"],
+                    "counts": {label: {str(k): v for k, v in counts.items()} for label, counts in model["counts"].items()},
+                }
+                for field, model in self.fields.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != MODEL_VERSION:
+            raise ValueError(f"Unsupported local classifier version: {data.get('version')}")
+        model = cls(buckets=data["buckets"], alpha=data["alpha"])
+        for field in FIELDS:
+            stored = data["fields"][field]
+            model.fields[field] = {
+                "docs": stored["docs"],
+                "tokens": stored["tokens"],
+                "counts": {label: {int(k): v for k, v in counts.items()} for label, counts in stored["counts"].items()},
+            }
+        return model
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def iter_labeled_examples(paths):
+    """
+    Yields (aggregated_text, classification) pairs from classified result files
+    (JSON arrays or JSONL of API responses).
+    """
+    from ingest import iter_conversations
+    for path in paths:
+        for record in iter_conversations(path):
+            if not isinstance(record, dict) or not isinstance(record.get("classification"), dict):
+                continue
+            turns = record.get("tweets") or record.get("messages") or []
+            text = " ".join(t.get("text", "") for t in turns if isinstance(t, dict) and t.get("text"))
+            if text:
+                yield text, record["classification"]
+
+
+def train_from_files(paths, buckets=1 << 18, alpha=0.5):
+    """Trains a LocalClassifier on result files, using the prompt's label sets."""
+    from prompt_builder import INTENT_OPTIONS, TOPIC_OPTIONS, SENTIMENT_OPTIONS
+    model = LocalClassifier(buckets=buckets, alpha=alpha)
+    allowed = {"intent": INTENT_OPTIONS, "topic": TOPIC_OPTIONS, "sentiment": SENTIMENT_OPTIONS}
+    used = model.train(iter_labeled_examples(paths), allowed)
+    return model, used
+
+
+def get_local_classifier():
+    """
+    Returns the model at CASCADE_MODEL_PATH (loaded once), or None when the
+    cascade is not configured or the model cannot be loaded.
+    """
+    global _model, _model_path
+    from logger import logger
+    path = os.getenv("CASCADE_MODEL_PATH")
+    if not path:
+        return None
+    if _model_path != path:
+        with _model_lock:
+            if _model_path != path:
+                try:
+                    _model = LocalClassifier.load(path)
+                except Exception as e:
+                    logger.error("Failed to load local classifier from %s: %s", path, e)
+                    _model = None
+                _model_path = path
+    return _model
+
+
+def cascade_threshold():
+    """Minimum confidence for the local tier to answer (CASCADE_THRESHOLD, default 0.9)."""
+    return float(os.getenv("CASCADE_THRESHOLD", "0.9"))
@@ -1,9 +1,140 @@
 """
 logger.py
 Centralized logging for the module.
+
+Records are handed to a background thread through a queue, so request handlers
+never block on formatting or stderr writes; messages are formatted lazily in
+that thread. Output is one JSON object per line (LOG_FORMAT=text for plain
+lines) carrying structured fields such as conversation_number and stage timings.
+
+Large payloads (requests, prompts, raw LLM responses) go through log_payload:
+DEBUG level, sampled by LOG_PAYLOAD_SAMPLE_RATE and truncated to
+LOG_PAYLOAD_MAX_CHARS, and free when DEBUG is disabled.
 """
 
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+LOGGER_NAME = "customer_support_query_classification"
+
+# Extra attributes copied into JSON records when present
+STRUCTURED_FIELDS = ("conversation_number", "stage", "duration_ms", "timings", "event")
+
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers message formatting to the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class _Payload:
+    """Renders a payload as truncated JSON only when the record is formatted."""
+    __slots__ = ("payload", "max_chars")
+
+    def __init__(self, payload, max_chars):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self):
+        try:
+            text = json.dumps(self.payload, ensure_ascii=False, default=str)
+        except Exception:
+            text = repr(self.payload)
+        if self.max_chars and len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}... [truncated {len(text) - self.max_chars} chars]"
+        return text
+
+
+def configure_logging(level=None, stream=None, fmt=None):
+    """
+    Routes root logging through a queue to a background listener thread.
+    Safe to call again (e.g. in tests); the previous listener is stopped.
+    """
+    global _listener, _queue_handler
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "json").lower()
+    root = logging.getLogger()
+    shutdown_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "text":
+        output.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    _queue_handler = _LazyQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    logging.getLogger(LOGGER_NAME).setLevel(level)
+    # One INFO line per Ollama round-trip is noise on the hot path
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _listener.start()
+    return _listener
+
+
+def flush_logging():
+    """Blocks until queued records are written (restarts the listener)."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+def shutdown_logging():
+    """Flushes and stops the background listener and detaches it from the root logger."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener = None
+        _queue_handler = None
+
+
+def log_payload(label, payload, conversation_number=None):
+    """
+    Logs a (potentially large) payload at DEBUG, sampled and truncated.
+    Nothing is serialized unless the record is actually emitted.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    sample_rate = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    max_chars = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+    logger.debug("%s: %s", label, _Payload(payload, max_chars),
+                 extra={"conversation_number": conversation_number, "event": "payload"})
+
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("customer_support_query_classification")
+logger = logging.getLogger(LOGGER_NAME)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+# Like logging.basicConfig: leave existing root handlers (e.g. uvicorn, pytest) alone
+if not logging.getLogger().handlers:
+    configure_logging()
+atexit.register(shutdown_logging)
@@ -3,14 +3,83 @@ main.py
 FastAPI server for Customer Support Query Classification
 """
 
+import time
+# Process start, for time-to-ready (measured before the heavy imports below)
+_STARTED = time.perf_counter()
+
 from dotenv import load_dotenv
 load_dotenv()
-from fastapi import FastAPI, Response, status
-from pydantic import BaseModel
-from api import classify_conversation
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, Header, Query, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from admission import get_admission_controller, priority_class
+from api import classify_conversation_async
+from backends import health_check_loop, health_interval
+from batch import classify_batch_ndjson
+from cache import get_cache
+from conversation import Conversation
+from error_handler import error_response, record_error
+from jobs import (get_job_store, get_job_workers, max_job_size, max_wait_seconds, start_job_workers,
+                  stop_job_workers, webhook_url_error)
+from llm_wrapper import init_async_client, close_async_client
+from logger import logger
+from metrics import REGISTRY, render_prometheus
+from profiler import capture_profile
+from results_store import LABELS, get_results_store, parse_time
+from tracing import export_trace, should_trace, start_trace
+from warmup import check_ready, start_readiness, warm_up, warmup_enabled
+import asyncio
+import hmac
+import json
+import os
 import uvicorn
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    readiness = start_readiness(_STARTED)
+    readiness.record_phase("imports", _STARTED)
+    # One pooled keep-alive client to Ollama for the lifetime of the worker
+    client = init_async_client()
+    logger.info("Ollama connection pool ready")
+    interval = health_interval()
+    tasks = [asyncio.create_task(health_check_loop(client, interval))] if interval > 0 else []
+    # Job workers resume whatever the persistent queue holds (including items interrupted by a restart)
+    start_job_workers()
+    # Warm-up runs in the background: /healthz answers at once, /readyz once it is done
+    if warmup_enabled():
+        tasks.append(asyncio.create_task(warm_up(readiness)))
+    else:
+        readiness.mark_ready()
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await stop_job_workers()
+    await close_async_client()
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    in_flight = REGISTRY.gauge("http_requests_in_flight", "HTTP requests currently being handled")
+    in_flight.inc()
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        in_flight.dec()
+        # Route templates (not raw paths) as labels keep cardinality bounded
+        route = request.scope.get("route")
+        REGISTRY.histogram(
+            "http_request_seconds", "HTTP request duration until the response starts", ("path", "status_code")
+        ).observe(time.perf_counter() - started, path=getattr(route, "path", "other"), status_code=status_code)
 
 
 from typing import List, Optional, Union
@@ -40,21 +109,246 @@ class ConversationRequest(BaseModel):
         return self
 
 @app.post("/classify")
-async def classify(request: ConversationRequest, response: Response):
-    # Convert Pydantic model to dict for compatibility
-    result = classify_conversation(request.dict())
+async def classify(request: ConversationRequest, response: Response,
+                   x_priority: Optional[str] = Header(None), x_trace: Optional[str] = Header(None),
+                   x_admin_token: Optional[str] = Header(None)):
+    # X-Trace is an admin feature: without a valid token only sampling applies
+    if x_trace is not None and _admin_denied(x_admin_token) is not None:
+        x_trace = None
+    if not should_trace(x_trace):
+        return await _classify(request, response, x_priority)
+    try:
+        with start_trace("main.classify", defer_export=True,
+                         conversation_number=request.conversation_number) as root:
+            result = await _classify(request, response, x_priority)
+            root.set(status_code=response.status_code)
+    finally:
+        await asyncio.to_thread(export_trace, root.trace)
+    response.headers["X-Trace-Id"] = root.trace.trace_id
+    return result
+
+async def _classify(request, response, x_priority):
+    # Validated once by Pydantic; the typed Conversation skips re-validation downstream
+    result = await classify_conversation_async(Conversation.from_request(request), priority_class(x_priority))
     # Set status code based on error type
     if isinstance(result, dict) and "error" in result:
-        err = result["error"].lower()
-        if ("input" in err or "message" in err or "conversation_number" in err or "aggregated_text" in err):
-            response.status_code = status.HTTP_400_BAD_REQUEST
-        elif ("llm connectivity" in err or "timed out" in err):
-            response.status_code = status.HTTP_502_BAD_GATEWAY
-        else:
-            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        response.status_code = record_error(result["error"])
+        if response.status_code in (status.HTTP_429_TOO_MANY_REQUESTS, status.HTTP_503_SERVICE_UNAVAILABLE):
+            admission = get_admission_controller()
+            response.headers["Retry-After"] = str(admission.retry_after() if admission else 1)
     else:
         response.status_code = status.HTTP_200_OK
     return result
 
+def _validate_batch_item(raw):
+    """
+    Validates one batch entry against ConversationRequest.
+    Returns a Conversation or an inline error response.
+    """
+    if isinstance(raw, (bytes, str)):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            return error_response("Invalid input: batch line is not valid JSON")
+    try:
+        return Conversation.from_request(ConversationRequest.model_validate(raw))
+    except ValidationError as e:
+        return error_response(f"Invalid input: {e.errors()[0]['msg']}")
+
+async def _iter_ndjson(body):
+    # The body is read up front: the streaming response owns the receive
+    # channel once it starts. Lines are still parsed and validated lazily.
+    index = 0
+    for line in body.splitlines():
+        if line.strip():
+            yield index, _validate_batch_item(line)
+            index += 1
+
+async def _iter_list(items):
+    for index, raw in enumerate(items):
+        yield index, _validate_batch_item(raw)
+
+@app.post("/classify/batch")
+async def classify_batch(request: Request, concurrency: Optional[int] = Query(None, ge=1),
+                         x_priority: Optional[str] = Header(None)):
+    """
+    Accepts a JSON list or an NDJSON stream (Content-Type: application/x-ndjson) of
+    conversations and streams one NDJSON result per conversation as each one finishes.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        items = _iter_ndjson(await request.body())
+    else:
+        try:
+            body = json.loads(await request.body())
+        except ValueError:
+            body = None
+        if not isinstance(body, list):
+            return JSONResponse(
+                error_response("Invalid input: batch body must be a JSON list or NDJSON stream"),
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        items = _iter_list(body)
+    # Batches are backfill unless the caller says otherwise
+    priority = priority_class(x_priority) if x_priority else "batch"
+    return StreamingResponse(classify_batch_ndjson(items, concurrency, priority), media_type="application/x-ndjson")
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_job(request: Request, response: Response, x_priority: Optional[str] = Header(None)):
+    """
+    Queues one conversation, a JSON list of them, or {"conversations": [...],
+    "webhook_url": ...} as a job and returns its id without waiting for results.
+    """
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        body = None
+    webhook_url = None
+    if isinstance(body, dict) and "conversations" in body:
+        webhook_url = body.get("webhook_url")
+        body = body["conversations"]
+    elif isinstance(body, dict):
+        body = [body]
+    if not isinstance(body, list) or not body:
+        return JSONResponse(
+            error_response("Invalid input: job body must be a conversation, a non-empty list or {\"conversations\": [...]}"),
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(body) > max_job_size():
+        return JSONResponse(
+            error_response(f"Invalid input: a job holds at most {max_job_size()} conversations"),
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+    if webhook_url is not None:
+        webhook_error = await webhook_url_error(webhook_url)
+        if webhook_error is not None:
+            return JSONResponse(error_response(webhook_error), status_code=status.HTTP_400_BAD_REQUEST)
+    items = []
+    for raw in body:
+        item = _validate_batch_item(raw)
+        if isinstance(item, Conversation):
+            items.append((item.raw, None))
+        else:
+            items.append((raw.get("conversation_number") if isinstance(raw, dict) else None, item))
+    # A single conversation keeps the caller's priority; bulk jobs are backfill unless stated otherwise
+    if x_priority or len(items) == 1:
+        priority = priority_class(x_priority)
+    else:
+        priority = "batch"
+    job_id = await asyncio.to_thread(get_job_store().submit, items, priority, webhook_url)
+    workers = get_job_workers()
+    if workers is not None:
+        await workers.submitted(job_id)
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return {"job_id": job_id, "status": "queued", "total": len(items), "location": f"/jobs/{job_id}"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0)):
+    """
+    Status, counts and results (finished items, by index) of a job. With
+    ?wait=N, long-polls up to N seconds (capped) for the job to complete.
+    """
+    workers = get_job_workers()
+    timeout = min(wait, max_wait_seconds())
+    if workers is not None:
+        job = await workers.wait(job_id, timeout)
+    else:
+        job = await asyncio.to_thread(get_job_store().get, job_id)
+    if job is None:
+        return JSONResponse(error_response("Job not found"), status_code=status.HTTP_404_NOT_FOUND)
+    return job
+
+@app.get("/stats")
+async def stats(since: Optional[str] = None, until: Optional[str] = None, group_by: Optional[str] = None,
+                intent: Optional[str] = None, topic: Optional[str] = None, sentiment: Optional[str] = None):
+    """
+    Distribution of stored classifications from the hourly rollups: total and
+    mean latency, optionally within [since, until) (epoch or ISO 8601, UTC),
+    filtered by label and grouped by a comma-separated subset of
+    intent, topic, sentiment, hour and day.
+    """
+    store = get_results_store()
+    if store is None:
+        return {"enabled": False}
+    started = time.perf_counter()
+    filters = {label: value for label, value in zip(LABELS, (intent, topic, sentiment)) if value is not None}
+    dimensions = [d.strip() for d in group_by.split(",") if d.strip()] if group_by else []
+    try:
+        # Off the event loop: reads wait for the writer thread's batch commits
+        result = await asyncio.to_thread(store.stats, parse_time(since), parse_time(until), dimensions, filters)
+    except ValueError as e:
+        message = str(e) if str(e).startswith("Invalid input") else f"Invalid input: {e}"
+        return JSONResponse(error_response(message), status_code=status.HTTP_400_BAD_REQUEST)
+    return {"enabled": True, **result, "query_ms": round((time.perf_counter() - started) * 1000, 3)}
+
+@app.get("/results/{conversation_number}")
+async def results(conversation_number: str, limit: int = Query(100, ge=1, le=1000)):
+    """Stored classifications of one conversation, newest first."""
+    store = get_results_store()
+    if store is None:
+        return {"enabled": False}
+    results = await asyncio.to_thread(store.results_for, conversation_number, limit)
+    return {"conversation_number": conversation_number, "results": results}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss/eviction counters of the classification cache."""
+    cache = get_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: warm-up finished and an Ollama backend is available (503 otherwise)."""
+    ready, details = check_ready()
+    return JSONResponse(details, status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+def _admin_denied(token):
+    """An error response unless `token` matches ADMIN_TOKEN (admin endpoints are off without one)."""
+    expected = os.getenv("ADMIN_TOKEN")
+    if not expected:
+        return error_response("Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), expected.encode("utf-8")):
+        return error_response("Invalid admin token")
+    return None
+
+@app.get("/admin/profile")
+async def admin_profile(seconds: float = Query(10, gt=0), format: str = Query("json", pattern="^(json|folded)$"),
+                        x_admin_token: Optional[str] = Header(None)):
+    """
+    Samples the CPU of the running server for `seconds` (capped) and returns
+    the busiest functions and folded stacks, or only the folded stacks as text
+    with ?format=folded (flamegraph.pl, speedscope). Requires X-Admin-Token.
+    """
+    denied = _admin_denied(x_admin_token)
+    if denied is not None:
+        return JSONResponse(denied, status_code=status.HTTP_403_FORBIDDEN)
+    result = await asyncio.to_thread(capture_profile, seconds)
+    if isinstance(result, dict):
+        return JSONResponse(result, status_code=status.HTTP_409_CONFLICT)
+    profiler, duration = result
+    if format == "folded":
+        return PlainTextResponse("\n".join(profiler.folded()) + "\n")
+    return {
+        "seconds": round(duration, 3),
+        "interval_ms": profiler.interval * 1000,
+        "samples": profiler.samples,
+        "idle_samples": profiler.idle_samples,
+        "threads": len(profiler.threads),
+        "functions": profiler.top_functions(),
+        "folded": profiler.folded(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of the in-process metrics registry."""
+    return Response(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,174 @@
+"""
+microbatch.py
+Optional micro-batching of LLM calls.
+
+Requests arriving within MICROBATCH_MAX_WAIT_MS of each other (up to
+MICROBATCH_MAX_SIZE conversations) are classified with a single Ollama call,
+so the system prompt and few-shots are evaluated once per batch instead of once
+per conversation. Each entry of the batched reply is validated with
+classifier.parse_classification; missing or malformed entries fall back to a
+single-conversation call.
+"""
+
+import asyncio
+import os
+
+# Generation budget per conversation in a batched reply
+TOKENS_PER_CONVERSATION = 120
+
+_batcher = None
+
+
+class _Pending:
+    __slots__ = ("conversation_number", "aggregated_text", "messages", "future")
+
+    def __init__(self, conversation_number, aggregated_text, messages, future):
+        self.conversation_number = conversation_number
+        self.aggregated_text = aggregated_text
+        self.messages = messages
+        self.future = future
+
+
+class MicroBatcher:
+    """Collects concurrent classification requests on one event loop into batched LLM calls."""
+
+    def __init__(self, max_size=8, max_wait_ms=20.0):
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.loop = asyncio.get_running_loop()
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def submit(self, conversation_number, aggregated_text, messages):
+        """
+        Queues one conversation and waits for its LLM response (same shape as
+        ollama_classify_async). `messages` is the single-conversation prompt used
+        for fallback.
+        """
+        key = str(conversation_number)
+        # Entries are demultiplexed by conversation_number, so it must be unique per batch
+        if any(p.conversation_number == key for p in self._pending):
+            self._flush()
+        future = self.loop.create_future()
+        self._pending.append(_Pending(key, aggregated_text, messages, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._pending = self._pending, []
+        if items:
+            task = self.loop.create_task(self._run(items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items):
+        import llm_wrapper
+        try:
+            if len(items) == 1:
+                await self._run_single(items[0])
+                return
+            from prompt_builder import BATCH_CLASSIFICATION_SCHEMA, build_batch_prompt
+            prompt = build_batch_prompt([(p.conversation_number, p.aggregated_text) for p in items])
+            if "error" in prompt:
+                response = prompt
+            else:
+                response = await llm_wrapper.ollama_classify_async(
+                    prompt["messages"],
+                    num_predict=TOKENS_PER_CONVERSATION * len(items),
+                    schema=BATCH_CLASSIFICATION_SCHEMA,
+                )
+            self.batches += 1
+            self.batched_items += len(items)
+            if _is_unavailable(response):
+                # Backend is down: retrying each item individually would only add load
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_result(response)
+                return
+            entries = demultiplex(response)
+            fallback = []
+            for item in items:
+                entry = entries.get(item.conversation_number)
+                if entry is None:
+                    fallback.append(item)
+                elif not item.future.done():
+                    item.future.set_result(entry)
+            if fallback:
+                self.fallbacks += len(fallback)
+                await asyncio.gather(*[self._run_single(item) for item in fallback])
+        except Exception as e:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+
+    async def _run_single(self, item):
+        import llm_wrapper
+        result = await llm_wrapper.ollama_classify_async(item.messages)
+        if not item.future.done():
+            item.future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "batched_items": self.batched_items,
+            "fallbacks": self.fallbacks,
+            "pending": len(self._pending),
+        }
+
+
+def _is_unavailable(response):
+    from error_handler import status_code_for_error
+    return isinstance(response, dict) and "error" in response and status_code_for_error(response["error"]) == 502
+
+
+def demultiplex(response):
+    """
+    Splits a batched LLM reply into {conversation_number: classification}.
+    Only entries that validate (classifier.normalize_classification) are
+    returned, unchanged: parsing and its metrics happen once per conversation
+    when the response is built.
+    """
+    from classifier import normalize_classification
+    if isinstance(response, dict):
+        entries = response.get("classifications")
+    elif isinstance(response, list):
+        entries = response
+    else:
+        entries = None
+    if not isinstance(entries, list):
+        return {}
+    result = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get("conversation_number") is None:
+            continue
+        classification = {k: v for k, v in entry.items() if k != "conversation_number"}
+        if isinstance(normalize_classification(classification), tuple):
+            result.setdefault(str(entry["conversation_number"]), classification)
+    return result
+
+
+def get_microbatcher():
+    """
+    Returns the micro-batcher for the running event loop, or None when
+    MICROBATCH_ENABLED is not set.
+    """
+    global _batcher
+    if os.getenv("MICROBATCH_ENABLED", "false").lower() not in ("1", "true", "yes", "on"):
+        return None
+    loop = asyncio.get_running_loop()
+    if _batcher is None or _batcher.loop is not loop:
+        _batcher = MicroBatcher(
+            max_size=int(os.getenv("MICROBATCH_MAX_SIZE", "8")),
+            max_wait_ms=float(os.getenv("MICROBATCH_MAX_WAIT_MS", "20")),
+        )
+    return _batcher
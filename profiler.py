@@ -0,0 +1,120 @@
+"""
+profiler.py
+Sampling CPU profiler for the running server (GET /admin/profile).
+
+A background thread snapshots the Python stack of every other thread
+(sys._current_frames) every PROFILE_INTERVAL_MS (default 5) for the requested
+number of seconds and counts identical stacks. Threads parked in a wait
+(selector, lock, condition, queue) are counted as idle and left out, so the
+profile shows where CPU time goes. The result has the functions with the
+most samples (self and total) and the folded stacks ("a;b;c count") read by
+flamegraph.pl and speedscope. Sampling only reads frames: the server keeps
+serving while it runs. One profile runs at a time.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from error_handler import error_response
+
+# Leaf functions of a thread that is waiting rather than running
+IDLE_FUNCTIONS = frozenset((
+    "select", "poll", "wait", "_wait_for_tstate_lock", "accept", "recv", "recv_into", "readinto",
+))
+TOP_FUNCTIONS = 50
+
+_running = threading.Lock()
+
+
+def profile_interval():
+    return max(0.001, float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0)
+
+
+def max_profile_seconds():
+    return float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+
+class SamplingProfiler:
+    """Collects folded stacks of all other threads; run() blocks for the duration."""
+
+    def __init__(self, interval=None):
+        self.interval = profile_interval() if interval is None else interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.threads = set()
+        self._labels = {}
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def sample(self, exclude=()):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in exclude:
+                continue
+            if frame.f_code.co_name in IDLE_FUNCTIONS:
+                self.idle_samples += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            self.threads.add(thread_id)
+
+    def run(self, seconds):
+        own = {threading.get_ident()}
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            self.sample(own)
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            time.sleep(min(self.interval, deadline - now))
+        return time.perf_counter() - started
+
+    def folded(self):
+        """Folded stacks, most frequent first: "thread;outer;...;leaf count"."""
+        return [f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()]
+
+    def top_functions(self, limit=TOP_FUNCTIONS):
+        """Functions by samples on top of the stack (self) and anywhere in it (total)."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # Recursion counts a function once per sample
+            for label in set(stack[1:]):
+                total[label] += count
+        ranked = sorted(total, key=lambda label: (own[label], total[label]), reverse=True)[:limit]
+        return [{
+            "function": label,
+            "self": own[label],
+            "total": total[label],
+            "self_pct": round(100.0 * own[label] / self.samples, 2) if self.samples else 0.0,
+        } for label in ranked]
+
+
+def capture_profile(seconds, interval=None):
+    """
+    Samples the process for `seconds` (capped at PROFILE_MAX_SECONDS).
+    Returns the profiler and the measured duration, or an error response
+    when another profile is running.
+    """
+    if not _running.acquire(blocking=False):
+        return error_response("A profile is already running")
+    try:
+        profiler = SamplingProfiler(interval)
+        duration = profiler.run(min(seconds, max_profile_seconds()))
+        return profiler, duration
+    finally:
+        _running.release()
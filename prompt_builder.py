@@ -1,7 +1,11 @@
 
+import hashlib
 import json
 import os
-print(f"[DEBUG] Loaded prompt_builder.py from: {os.path.abspath(__file__)}")
+
+from aggregator import estimate_tokens
+from fewshot import FewShotLibrary, example_from_record, load_examples, render_turns
+from tracing import traced
 
 # Allowed values for schema fields
 INTENT_OPTIONS = [
@@ -64,51 +68,248 @@ FEW_SHOTS = [
     }
 ]
 
+# Strict classification instructions sent as the system message
+SYSTEM_PROMPT = (
+    "You are a highly accurate customer-support query classifier.\n"
+    "Your task is to classify the conversation into a short description, intent, topic, and sentiment.\n"
+    "IMPORTANT:\n"
+    "1. Use the **entire conversation** to determine intent and topic.\n"
+    "2. Determine sentiment **ONLY from the customer's messages**.\n"
+    "   - Positive: satisfaction, happiness, appreciation.\n"
+    "   - Neutral: questions, clarifications, factual statements.\n"
+    "   - Negative: frustration, anger, disappointment, urgency.\n"
+    "3. Completely ignore the agent's tone for sentiment.\n"
+    "4. Return a SINGLE JSON object **exactly** matching this schema:\n"
+    "   - categorization: short descriptive summary of the customer issue.\n"
+    f"   - intent: one of {INTENT_OPTIONS}\n"
+    f"   - topic: one of {TOPIC_OPTIONS}\n"
+    f"   - sentiment: one of {SENTIMENT_OPTIONS}\n"
+    "5. NO extra keys, NO explanations, NO commentary, ONLY JSON.\n"
+    "6. If unsure, make the best judgment based on customer words."
+)
+
+# Retrieval of few-shot examples per conversation (see fewshot.py); when off,
+# FEW_SHOTS are all part of the static prefix. Off unless a library is
+# configured: the 4 built-in examples alone are too few to retrieve from, and
+# retrieval gives up KV reuse for the few-shot turns.
+FEWSHOT_RETRIEVAL = os.getenv(
+    "FEWSHOT_RETRIEVAL", "true" if os.getenv("FEWSHOT_LIBRARY_PATH") else "false"
+).lower() in ("1", "true", "yes", "on")
+FEWSHOT_K = int(os.getenv("FEWSHOT_K", "3"))
+FEWSHOT_TOKEN_BUDGET = int(os.getenv("FEWSHOT_TOKEN_BUDGET", "300"))
+
+def _load_library():
+    """FEW_SHOTS plus the examples at FEWSHOT_LIBRARY_PATH, indexed for retrieval."""
+    examples = [example_from_record(ex) for ex in FEW_SHOTS]
+    path = os.getenv("FEWSHOT_LIBRARY_PATH")
+    if path:
+        try:
+            examples.extend(load_examples(path))
+        except OSError as e:
+            from logger import logger
+            logger.error("Failed to load few-shot library from %s: %s", path, e)
+    return FewShotLibrary(examples)
+
+def _compile_prefix():
+    """
+    Renders the static part of every prompt: the system message, followed by
+    the few-shot user/assistant turns unless they are retrieved per request.
+    Returns a tuple of (role, content) pairs.
+    """
+    turns = [("system", SYSTEM_PROMPT)]
+    if FEWSHOT_RETRIEVAL:
+        return tuple(turns)
+    # Add few-shot examples as multi-turn user/assistant pairs
+    for ex in FEW_SHOTS:
+        turns.append(("user", render_turns(ex["messages"])))
+        turns.append(("assistant", json.dumps(ex["output"], ensure_ascii=False)))
+    return tuple(turns)
+
+# Compiled once at import: every request shares this byte-identical prefix,
+# which lets Ollama reuse its KV cache for the system prompt (and static few-shots).
+PROMPT_PREFIX = _compile_prefix()
+PROMPT_PREFIX_BYTES = json.dumps(
+    [{"role": role, "content": content} for role, content in PROMPT_PREFIX], ensure_ascii=False
+).encode("utf-8")
+FEWSHOT_LIBRARY = _load_library() if FEWSHOT_RETRIEVAL else None
+
+# Identifies the prompt contents (instructions, label sets, few-shots or the
+# retrieval library and settings) so cached classifications are invalidated
+# whenever the prompt changes.
+_version = hashlib.sha256(PROMPT_PREFIX_BYTES)
+if FEWSHOT_LIBRARY is not None:
+    _version.update(f"|{FEWSHOT_LIBRARY.fingerprint}|{FEWSHOT_K}|{FEWSHOT_TOKEN_BUDGET}".encode("utf-8"))
+PROMPT_VERSION = _version.hexdigest()[:16]
+
+def _prompt_head(query_text):
+    """Fresh message dicts for the prefix plus the few-shots retrieved for `query_text`."""
+    turns = PROMPT_PREFIX
+    if FEWSHOT_LIBRARY is not None:
+        turns = turns + tuple(FEWSHOT_LIBRARY.turns(query_text, FEWSHOT_K, FEWSHOT_TOKEN_BUDGET))
+    return [{"role": role, "content": content} for role, content in turns]
+
+def _classification_properties():
+    return {
+        "categorization": {"type": "string"},
+        "intent": {"type": "string", "enum": INTENT_OPTIONS},
+        "topic": {"type": "string", "enum": TOPIC_OPTIONS},
+        "sentiment": {"type": "string", "enum": SENTIMENT_OPTIONS},
+    }
+
+# JSON schema sent as Ollama's `format`, so decoding is constrained to a valid
+# object with allowed labels and generation cannot wander past it.
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": _classification_properties(),
+    "required": ["categorization", "intent", "topic", "sentiment"],
+}
+
+BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "classifications": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"conversation_number": {"type": "string"}, **_classification_properties()},
+                "required": ["conversation_number", "categorization", "intent", "topic", "sentiment"],
+            },
+        },
+    },
+    "required": ["classifications"],
+}
+
+# Token allowance for free-text string fields (the categorization summary)
+FREE_TEXT_TOKENS = 40
+
+def schema_token_budget(schema):
+    """
+    Upper estimate of the tokens needed to emit one object matching `schema`
+    (~3 characters per token for keys, punctuation and the longest enum value).
+    Arrays are counted as a single item; callers scale batch budgets themselves.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        budget = 2
+        for key, sub in schema.get("properties", {}).items():
+            budget += len(key) // 3 + 3 + schema_token_budget(sub)
+        return budget
+    if kind == "array":
+        return 2 + schema_token_budget(schema.get("items", {}))
+    if "enum" in schema:
+        return max(len(str(v)) for v in schema["enum"]) // 3 + 2
+    if kind == "string":
+        return FREE_TEXT_TOKENS
+    return 4
+
+CLASSIFICATION_NUM_PREDICT = schema_token_budget(CLASSIFICATION_SCHEMA)
+
+def _prompt_sizes(result, *args, **kwargs):
+    """Span attributes of the prompt builders."""
+    if "messages" not in result:
+        return {}
+    contents = [message["content"] for message in result["messages"]]
+    return {
+        "messages": len(contents),
+        "fewshots": (len(contents) - len(PROMPT_PREFIX) - 1) // 2,
+        "prompt_chars": sum(len(content) for content in contents),
+        "estimated_tokens": sum(estimate_tokens(content) for content in contents),
+    }
+
+@traced("build_prompt", _prompt_sizes)
 def build_prompt(conversation_number, aggregated_text):
     """
     Constructs the prompt for LLM classification.
-    Includes strict instructions and 4 few-shot examples.
+    Includes strict instructions from the precompiled prefix, the few-shot
+    examples most similar to the conversation (or the static ones) and the
+    conversation as the final user turn.
     Returns a dict with 'messages' or 'error'.
     """
     try:
         if not conversation_number or not aggregated_text:
             return {"error": "Invalid input: conversation_number and aggregated_text are required"}
-        SYSTEM_PROMPT = (
-            "You are a highly accurate customer-support query classifier.\n"
-            "Your task is to classify the conversation into a short description, intent, topic, and sentiment.\n"
-            "IMPORTANT:\n"
-            "1. Use the **entire conversation** to determine intent and topic.\n"
-            "2. Determine sentiment **ONLY from the customer's messages**.\n"
-            "   - Positive: satisfaction, happiness, appreciation.\n"
-            "   - Neutral: questions, clarifications, factual statements.\n"
-            "   - Negative: frustration, anger, disappointment, urgency.\n"
-            "3. Completely ignore the agent's tone for sentiment.\n"
-            "4. Return a SINGLE JSON object **exactly** matching this schema:\n"
-            "   - categorization: short descriptive summary of the customer issue.\n"
-            f"   - intent: one of {INTENT_OPTIONS}\n"
-            f"   - topic: one of {TOPIC_OPTIONS}\n"
-            f"   - sentiment: one of {SENTIMENT_OPTIONS}\n"
-            "5. NO extra keys, NO explanations, NO commentary, ONLY JSON.\n"
-            "6. If unsure, make the best judgment based on customer words."
-        )
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ]
-        # Add few-shot examples as multi-turn user/assistant pairs
-        for ex in FEW_SHOTS:
-            # Combine all customer/agent messages into a single string for the user turn
-            user_msgs = []
-            for msg in ex["messages"]:
-                if msg["sender"] == "customer":
-                    user_msgs.append(f"Customer: {msg['text']}")
-                elif msg["sender"] == "agent":
-                    user_msgs.append(f"Agent: {msg['text']}")
-            user_content = "\n".join(user_msgs)
-            messages.append({"role": "user", "content": user_content})
-            messages.append({"role": "assistant", "content": json.dumps(ex["output"], ensure_ascii=False)})
+        # Fresh dicts around the shared strings, so callers cannot alter the prefix
+        messages = _prompt_head(aggregated_text)
         # Add actual conversation
         user_query = f"Customer Query:\n{aggregated_text}\nReturn ONLY JSON:"
         messages.append({"role": "user", "content": user_query})
         return {"messages": messages}
     except Exception as e:
         return {"error": f"Prompt construction error: {str(e)}"}
+
+@traced("build_incremental_prompt", _prompt_sizes)
+def build_incremental_prompt(conversation_number, previous_classification, new_turns_text):
+    """
+    Constructs a compact prompt for a conversation that was classified before:
+    the previous classification plus only the turns added since, instead of
+    the full thread. Reuses the precompiled prefix; few-shots are retrieved
+    for the new turns.
+    Returns a dict with 'messages' or 'error'.
+    """
+    try:
+        if not conversation_number or not previous_classification or not new_turns_text:
+            return {"error": "Invalid input: conversation_number, previous classification and new turns are required"}
+        messages = _prompt_head(new_turns_text)
+        user_query = (
+            "Previous classification of this conversation:\n"
+            f"{json.dumps(previous_classification, ensure_ascii=False)}\n"
+            f"New messages since then:\n{new_turns_text}\n"
+            "Return ONLY JSON with the updated classification of the whole conversation:"
+        )
+        messages.append({"role": "user", "content": user_query})
+        return {"messages": messages}
+    except Exception as e:
+        return {"error": f"Prompt construction error: {str(e)}"}
+
+# Longest part of a broken reply quoted back in the "fix this JSON" follow-up
+FIX_PROMPT_MAX_CHARS = 1500
+
+def build_fix_prompt(bad_output):
+    """
+    Constructs the short follow-up that asks the model to turn an unusable
+    reply into valid classification JSON. No few-shots or conversation: the
+    broken reply is the only context, so it costs a fraction of a full run.
+    Returns a dict with 'messages' or 'error'.
+    """
+    if not bad_output:
+        return {"error": "Invalid input: nothing to fix"}
+    instructions = (
+        "Rewrite the text below as ONE valid JSON object with the keys categorization (short string), "
+        f"intent (one of {INTENT_OPTIONS}), topic (one of {TOPIC_OPTIONS}) and "
+        f"sentiment (one of {SENTIMENT_OPTIONS}). Keep the meaning; output ONLY JSON."
+    )
+    return {"messages": [
+        {"role": "system", "content": "You repair malformed JSON."},
+        {"role": "user", "content": f"{instructions}\n\n{bad_output[:FIX_PROMPT_MAX_CHARS]}"},
+    ]}
+
+@traced("build_batch_prompt", _prompt_sizes)
+def build_batch_prompt(conversations):
+    """
+    Constructs one prompt that classifies several conversations at once.
+    `conversations` is a list of (conversation_number, aggregated_text) pairs.
+    Reuses the precompiled prefix; the final user turn lists every conversation
+    and asks for a JSON object whose "classifications" array is keyed by
+    conversation_number.
+    Returns a dict with 'messages' or 'error'.
+    """
+    try:
+        if not conversations:
+            return {"error": "Invalid input: at least one conversation is required"}
+        parts = [
+            f"Classify each of the following {len(conversations)} conversations independently.",
+        ]
+        for conversation_number, aggregated_text in conversations:
+            if not conversation_number or not aggregated_text:
+                return {"error": "Invalid input: conversation_number and aggregated_text are required"}
+            parts.append(f"Conversation {json.dumps(str(conversation_number))}:\n{aggregated_text}")
+        parts.append(
+            'Return ONLY JSON of the form {"classifications": [{"conversation_number": "...", '
+            '"categorization": "...", "intent": "...", "topic": "...", "sentiment": "..."}, ...]} '
+            "with exactly one entry per conversation:"
+        )
+        messages = _prompt_head("\n".join(text for _, text in conversations))
+        messages.append({"role": "user", "content": "\n\n".join(parts)})
+        return {"messages": messages}
+    except Exception as e:
+        return {"error": f"Prompt construction error: {str(e)}"}
@@ -0,0 +1,286 @@
+"""
+results_store.py
+Persistent store of classification results with incremental rollups.
+
+Every successful classification is appended to a SQLite table (conversation
+number, labels, model, prompt version, latency, source) indexed by time and
+conversation number. In the same transaction, a rollup table of counts and
+latency sums per hour bucket and (intent, topic, sentiment) is upserted, so
+distribution queries (/stats) read a few rollup rows instead of rescanning
+results.
+
+Writes never block the request: results are queued and a background thread
+commits them in batches every RESULTS_FLUSH_SECONDS (default 1) or
+RESULTS_FLUSH_SIZE results (default 500), so /stats lags by at most about one
+flush. RESULTS_DB_PATH defaults to $WORKING_DIR/results.db;
+RESULTS_STORE_ENABLED=false disables the store.
+"""
+
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from logger import logger
+from metrics import REGISTRY
+
+BUCKET_SECONDS = 3600
+LABELS = ("intent", "topic", "sentiment")
+# Dimensions /stats can group by: the labels plus hour or day buckets (UTC)
+GROUP_BY = LABELS + ("hour", "day")
+MAX_PENDING = 100000
+
+_store = None
+_store_lock = threading.Lock()
+_FLUSH = object()
+_STOP = object()
+
+
+def results_store_enabled():
+    return os.getenv("RESULTS_STORE_ENABLED", "true").lower() not in ("0", "false", "no", "off")
+
+
+def parse_time(value):
+    """Epoch seconds from an epoch number or an ISO 8601 date/datetime (UTC unless stated); None if empty."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class ResultsStore:
+    """
+    Results and rollups in SQLite, written in batches by one background thread.
+    record() is thread-safe and only enqueues; queries read the committed state.
+    """
+
+    def __init__(self, db_path, flush_seconds=1.0, flush_size=500):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.flush_seconds = flush_seconds
+        self.flush_size = max(1, flush_size)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY, conversation_number TEXT NOT NULL, intent TEXT, topic TEXT, sentiment TEXT, "
+            "categorization TEXT, model TEXT, prompt_version TEXT, latency_ms REAL, source TEXT, "
+            "created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_conversation ON results (conversation_number)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS result_rollups ("
+            "bucket INTEGER NOT NULL, intent TEXT NOT NULL, topic TEXT NOT NULL, sentiment TEXT NOT NULL, "
+            "count INTEGER NOT NULL, latency_count INTEGER NOT NULL, latency_ms_sum REAL NOT NULL, "
+            "PRIMARY KEY (bucket, intent, topic, sentiment)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self._read_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=MAX_PENDING)
+        self._writer = threading.Thread(target=self._write_loop, name="results-store", daemon=True)
+        self._writer.start()
+        self._closed = False
+
+    def record(self, conversation_number, classification, latency_ms=None, source="llm", model=None,
+               prompt_version=None, created_at=None):
+        """Queues one classification for storage; dropped (and counted) if the writer is too far behind."""
+        row = (
+            str(conversation_number),
+            *(str(classification.get(label) or "") for label in LABELS),
+            classification.get("categorization"),
+            model,
+            prompt_version,
+            latency_ms,
+            source,
+            time.time() if created_at is None else created_at,
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            REGISTRY.counter("results_dropped_total", "Results not stored because the writer fell behind").inc()
+
+    def flush(self, timeout=10.0):
+        """Blocks until everything recorded so far has been committed."""
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_STOP, None))
+        self._writer.join(timeout=10.0)
+        with self._read_lock:
+            self._db.close()
+
+    def _write_loop(self):
+        while True:
+            rows, signals = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if isinstance(item[0], str):
+                    rows.append(item)
+                else:
+                    signals.append(item)
+                if signals or len(rows) >= self.flush_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self._write(rows)
+                except sqlite3.Error as e:
+                    logger.error("Failed to store %d classification results: %s", len(rows), e)
+            for signal, event in signals:
+                if signal is _STOP:
+                    return
+                event.set()
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        rollups = {}
+        for row in rows:
+            key = (int(row[-1] // BUCKET_SECONDS * BUCKET_SECONDS), row[1], row[2], row[3])
+            count, timed, latency = rollups.get(key, (0, 0, 0.0))
+            if row[7] is not None:
+                timed, latency = timed + 1, latency + row[7]
+            rollups[key] = (count + 1, timed, latency)
+        with self._read_lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO results (conversation_number, intent, topic, sentiment, categorization, model, "
+                    "prompt_version, latency_ms, source, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._db.executemany(
+                    "INSERT INTO result_rollups (bucket, intent, topic, sentiment, count, latency_count, "
+                    "latency_ms_sum) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (bucket, intent, topic, sentiment) DO UPDATE SET "
+                    "count = count + excluded.count, latency_count = latency_count + excluded.latency_count, "
+                    "latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum",
+                    [key + value for key, value in rollups.items()],
+                )
+        REGISTRY.counter("results_recorded_total", "Classification results committed to the results store").inc(
+            len(rows))
+        REGISTRY.histogram("results_flush_seconds", "Duration of one results store batch commit").observe(
+            time.perf_counter() - started)
+
+    def stats(self, since=None, until=None, group_by=(), filters=None):
+        """
+        Counts and mean latency from the rollups, optionally restricted to
+        [since, until) (epoch seconds, rounded down to the hour) and to label
+        values in `filters`, and grouped by any of GROUP_BY.
+        """
+        unknown = [dimension for dimension in group_by if dimension not in GROUP_BY]
+        if unknown:
+            raise ValueError(f"Invalid input: cannot group by {', '.join(unknown)}")
+        columns = []
+        for dimension in group_by:
+            if dimension == "hour":
+                columns.append("bucket")
+            elif dimension == "day":
+                columns.append("bucket - bucket % 86400")
+            else:
+                columns.append(dimension)
+        where, params = [], []
+        if since is not None:
+            where.append("bucket >= ?")
+            params.append(int(since // BUCKET_SECONDS * BUCKET_SECONDS))
+        if until is not None:
+            where.append("bucket < ?")
+            params.append(until)
+        for label, value in (filters or {}).items():
+            if label not in LABELS:
+                raise ValueError(f"Invalid input: cannot filter by {label}")
+            where.append(f"{label} = ?")
+            params.append(value)
+        sql = "SELECT " + "".join(f"{column}, " for column in columns) + "SUM(count), SUM(latency_count), SUM(latency_ms_sum) " \
+              "FROM result_rollups"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if columns:
+            sql += " GROUP BY " + ", ".join(columns) + " ORDER BY SUM(count) DESC"
+        with self._read_lock:
+            rows = self._db.execute(sql, params).fetchall()
+        groups = []
+        total, timed_total, latency_total = 0, 0, 0.0
+        for row in rows:
+            count, timed, latency = row[-3] or 0, row[-2] or 0, row[-1] or 0.0
+            total += count
+            timed_total += timed
+            latency_total += latency
+            group = {}
+            for dimension, value in zip(group_by, row):
+                group[dimension] = (datetime.fromtimestamp(value, timezone.utc).isoformat()
+                                    if dimension in ("hour", "day") else value)
+            group["count"] = count
+            group["avg_latency_ms"] = round(latency / timed, 3) if timed else None
+            groups.append(group)
+        summary = {"total": total, "avg_latency_ms": round(latency_total / timed_total, 3) if timed_total else None}
+        if group_by:
+            summary["groups"] = groups
+        return summary
+
+    def results_for(self, conversation_number, limit=100):
+        """Stored results of one conversation, newest first."""
+        with self._read_lock:
+            rows = self._db.execute(
+                "SELECT intent, topic, sentiment, categorization, model, prompt_version, latency_ms, source, "
+                "created_at FROM results WHERE conversation_number = ? ORDER BY created_at DESC LIMIT ?",
+                (str(conversation_number), limit),
+            ).fetchall()
+        fields = LABELS + ("categorization", "model", "prompt_version", "latency_ms", "source", "created_at")
+        return [dict(zip(fields, row)) for row in rows]
+
+
+def get_results_store():
+    """Returns the process-wide results store, or None when RESULTS_STORE_ENABLED is false."""
+    global _store
+    if not results_store_enabled():
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultsStore(
+                    os.getenv("RESULTS_DB_PATH") or os.path.join(os.getenv("WORKING_DIR", "./data"), "results.db"),
+                    flush_seconds=float(os.getenv("RESULTS_FLUSH_SECONDS", "1")),
+                    flush_size=int(os.getenv("RESULTS_FLUSH_SIZE", "500")),
+                )
+                # Commit what is still queued when a CLI run or the server exits
+                atexit.register(_store.close)
+    return _store
+
+
+def record_result(conversation_number, classification, latency_ms=None, source="llm"):
+    """Stores a classification in the process-wide results store, if enabled."""
+    store = get_results_store()
+    if store is None:
+        return
+    from prompt_builder import PROMPT_VERSION
+    store.record(conversation_number, classification, latency_ms, source, os.getenv("OLLAMA_MODEL"), PROMPT_VERSION)
+
+
+def reset_results_store():
+    """Flushes, closes and forgets the results store (used by tests)."""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            atexit.unregister(_store.close)
+            _store.close()
+        _store = None
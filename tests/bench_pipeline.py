@@ -0,0 +1,103 @@
+"""
+bench_pipeline.py
+Micro-benchmark of the per-request CPU and allocation cost of the request pipeline
+(validation, aggregation, prompt building, response assembly) without the LLM call.
+
+Compares the previous dict-based path (model_dump, hand validation,
+tweets_to_messages, deepcopy of the input) with the typed Conversation path.
+
+Usage:
+    python tests/bench_pipeline.py [--tweets 200] [--iterations 2000]
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logger import logger
+from aggregator import tweets_to_messages
+from api import _build_response, _prepare_llm_messages
+from classifier import parse_classification
+from conversation import Conversation
+from main import ConversationRequest
+from prompt_builder import build_prompt
+
+LLM_RESPONSE = {"categorization": "Billing issue", "intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+
+
+def make_request(tweet_count):
+    tweets = [
+        {
+            "tweet_id": i,
+            "author_id": "115712" if i % 2 == 0 else "sprintcare",
+            "role": "Customer" if i % 2 == 0 else "Service Provider",
+            "inbound": i % 2 == 0,
+            "created_at": "Tue Oct 31 21:45:10 +0000 2017",
+            "text": f"@sprintcare message number {i} about my bill and the service outage",
+        }
+        for i in range(tweet_count)
+    ]
+    return ConversationRequest.model_validate({"conversation_number": "1", "tweets": tweets})
+
+
+def dict_pipeline(model):
+    request_json = model.model_dump()
+    conversation = Conversation.from_dict(request_json)  # hand validation
+    messages = tweets_to_messages(request_json["tweets"])
+    aggregated_text = " ".join(m["text"] for m in messages if m["text"])
+    build_prompt(conversation.conversation_number, aggregated_text)
+    classification = parse_classification(LLM_RESPONSE)
+    response = copy.deepcopy(request_json)
+    response["classification"] = classification
+    return response
+
+
+def typed_pipeline(model):
+    timings = {}
+    prepared = _prepare_llm_messages(Conversation.from_request(model), timings)
+    return _build_response(prepared, LLM_RESPONSE, timings)
+
+
+def measure(fn, model, iterations):
+    for _ in range(min(iterations, 50)):
+        fn(model)
+    started = time.process_time()
+    for _ in range(iterations):
+        fn(model)
+    cpu_us = (time.process_time() - started) / iterations * 1e6
+    tracemalloc.start()
+    fn(model)
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    fn(model)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"cpu_us_per_request": round(cpu_us, 1), "peak_alloc_bytes_per_request": peak - baseline}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tweets", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    logger.disabled = True
+    model = make_request(args.tweets)
+    dict_result = measure(dict_pipeline, model, args.iterations)
+    typed_result = measure(typed_pipeline, model, args.iterations)
+    report = {
+        "tweets": args.tweets,
+        "dict_pipeline": dict_result,
+        "typed_pipeline": typed_result,
+        "cpu_reduction_pct": round(100 * (1 - typed_result["cpu_us_per_request"] / dict_result["cpu_us_per_request"]), 1),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
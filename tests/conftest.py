@@ -0,0 +1,48 @@
+"""
+conftest.py
+Shared fixtures: isolate process-wide state between tests.
+"""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    from cache import reset_cache
+    from cassette import reset_cassette
+    from backends import reset_backend_pool
+    from conversation_state import reset_state_store
+    reset_cache()
+    reset_cassette()
+    reset_backend_pool()
+    reset_state_store()
+    yield
+    reset_cache()
+    reset_cassette()
+    reset_backend_pool()
+    reset_state_store()
+
+
+@pytest.fixture(autouse=True)
+def job_store(monkeypatch, tmp_path):
+    # Every test gets its own persistent job queue
+    from jobs import reset_job_store
+    monkeypatch.setenv("JOBS_DB_PATH", str(tmp_path / "jobs.db"))
+    reset_job_store()
+    yield
+    reset_job_store()
+
+
+@pytest.fixture(autouse=True)
+def results_store(monkeypatch, tmp_path):
+    from results_store import reset_results_store
+    monkeypatch.setenv("RESULTS_DB_PATH", str(tmp_path / "results.db"))
+    reset_results_store()
+    yield
+    reset_results_store()
+
+
+@pytest.fixture(autouse=True)
+def no_warmup(monkeypatch):
+    # TestClient runs the app lifespan; tests opt in to the Ollama warm-up explicitly
+    monkeypatch.setenv("WARMUP_ENABLED", "false")
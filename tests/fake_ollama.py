@@ -0,0 +1,231 @@
+"""
+fake_ollama.py
+Local stand-in for Ollama's /api/chat, for load tests and benchmarks.
+
+Replies with a valid classification (labels picked from the request's `format`
+schema, deterministically per prompt), streamed in token-sized chunks at a
+configurable token rate after a configurable time-to-first-token, and fails a
+configurable fraction of requests with HTTP 500.
+
+Usage:
+    python tests/fake_ollama.py --port 11434 --latency-ms 200 --latency-dist lognormal \
+        --tokens-per-sec 40 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import socket
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+DEFAULT_LABELS = {
+    "intent": ["Order Status", "Complaint", "Technical Support", "Other"],
+    "topic": ["Orders", "Account", "Technical", "General"],
+    "sentiment": ["Positive", "Neutral", "Negative"],
+}
+
+
+class FakeOllamaConfig:
+    """
+    latency_ms: mean time to first token; latency_dist: one of DISTRIBUTIONS
+    (`jitter` is the relative spread for uniform/lognormal); tokens_per_sec: 0
+    streams instantly; error_rate: fraction of requests answered with HTTP 500.
+    """
+
+    def __init__(self, latency_ms=50.0, latency_dist="fixed", jitter=0.5,
+                 tokens_per_sec=0.0, error_rate=0.0, seed=None):
+        if latency_dist not in DISTRIBUTIONS:
+            raise ValueError(f"latency_dist must be one of {DISTRIBUTIONS}")
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.jitter = jitter
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def sample_latency(self):
+        """Time to first token, in seconds."""
+        mean = self.latency_ms / 1000.0
+        if self.latency_dist == "uniform":
+            return self.random.uniform(mean * (1 - self.jitter), mean * (1 + self.jitter))
+        if self.latency_dist == "exponential":
+            return self.random.expovariate(1 / mean) if mean > 0 else 0.0
+        if self.latency_dist == "lognormal":
+            if mean <= 0:
+                return 0.0
+            # Parameterized so the distribution mean stays at latency_ms
+            sigma = self.jitter
+            mu = math.log(mean) - sigma * sigma / 2
+            return self.random.lognormvariate(mu, sigma)
+        return mean
+
+
+def _labels(schema):
+    """Allowed label lists per field from a request's `format` schema."""
+    labels = dict(DEFAULT_LABELS)
+    if isinstance(schema, dict):
+        properties = schema.get("properties", {})
+        if "classifications" in properties:
+            properties = properties["classifications"].get("items", {}).get("properties", {})
+        for field in labels:
+            enum = properties.get(field, {}).get("enum")
+            if enum:
+                labels[field] = enum
+    return labels
+
+
+def _reply(messages, schema):
+    """A deterministic classification (or batch of them) for the prompt."""
+    query = messages[-1].get("content", "") if messages else ""
+    digest = hashlib.sha256(query.encode("utf-8")).digest()
+    labels = _labels(schema)
+
+    def classify(seed):
+        return {
+            "categorization": "Customer support request",
+            "intent": labels["intent"][seed[0] % len(labels["intent"])],
+            "topic": labels["topic"][seed[1] % len(labels["topic"])],
+            "sentiment": labels["sentiment"][seed[2] % len(labels["sentiment"])],
+        }
+
+    if isinstance(schema, dict) and "classifications" in schema.get("properties", {}):
+        # Micro-batched prompt: one entry per `Conversation "<n>":` block
+        numbers = [part.split('"')[1] for part in query.split("Conversation ")[1:] if part.startswith('"')]
+        return {"classifications": [dict(classify(hashlib.sha256(n.encode()).digest()), conversation_number=n)
+                                    for n in numbers]}
+    return classify(digest)
+
+
+def _tokens(text):
+    """Splits the reply into ~4-character chunks, roughly one per token."""
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def create_app(config=None):
+    config = config or FakeOllamaConfig()
+    app = FastAPI()
+    app.state.config = config
+    app.state.requests = 0
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "fake"}]}
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        payload = await request.json()
+        app.state.requests += 1
+        model = payload.get("model", "fake")
+        messages = payload.get("messages") or []
+        prompt_chars = sum(len(m.get("content", "")) for m in messages)
+        started = time.perf_counter_ns()
+        await asyncio.sleep(config.sample_latency())
+        if config.error_rate and config.random.random() < config.error_rate:
+            return JSONResponse({"error": "fake ollama: injected failure"}, status_code=500)
+        content = json.dumps(_reply(messages, payload.get("format")), ensure_ascii=False)
+        tokens = _tokens(content)
+        eval_ns = int(len(tokens) / config.tokens_per_sec * 1e9) if config.tokens_per_sec else 0
+        final = {
+            "model": model,
+            "done": True,
+            "prompt_eval_count": prompt_chars // 4,
+            "eval_count": len(tokens),
+            # Ollama's durations are in nanoseconds; the time to first token stands in for prompt evaluation
+            "prompt_eval_duration": time.perf_counter_ns() - started,
+            "eval_duration": eval_ns,
+        }
+        if not payload.get("stream", True):
+            if config.tokens_per_sec:
+                await asyncio.sleep(len(tokens) / config.tokens_per_sec)
+            return dict(final, message={"role": "assistant", "content": content})
+
+        async def stream():
+            for token in tokens:
+                if config.tokens_per_sec:
+                    await asyncio.sleep(1 / config.tokens_per_sec)
+                chunk = {"model": model, "message": {"role": "assistant", "content": token}, "done": False}
+                yield json.dumps(chunk) + "\n"
+            yield json.dumps(dict(final, message={"role": "assistant", "content": ""})) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerThread:
+    """Runs an ASGI app with uvicorn in a background thread (context manager)."""
+
+    def __init__(self, app, port=None, host="127.0.0.1"):
+        import uvicorn
+        self.port = port or free_port()
+        self.url = f"http://{host}:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host=host, port=self.port, log_level="warning", log_config=None, access_log=False,
+        ))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout=10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"Server on port {self.port} failed to start")
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        # Don't wait for handlers still sleeping on behalf of disconnected clients
+        self.server.should_exit = True
+        self.server.force_exit = True
+        self.thread.join(timeout=10.0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="mean time to first token")
+    parser.add_argument("--latency-dist", choices=DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.5, help="relative spread (uniform/lognormal)")
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0, help="0 streams the reply instantly")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return FakeOllamaConfig(
+        latency_ms=args.latency_ms, latency_dist=args.latency_dist, jitter=args.jitter,
+        tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate, seed=args.seed,
+    )
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Fake Ollama /api/chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
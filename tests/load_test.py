@@ -0,0 +1,300 @@
+"""
+load_test.py
+Open-loop load generator for the classification API.
+
+Starts the real FastAPI app (uvicorn subprocess) against a local fake Ollama
+(tests/fake_ollama.py), or drives an already running server with --app-url.
+Requests are sent on a fixed schedule (or Poisson arrivals) at each target
+rate regardless of how fast responses come back, and latency is measured from
+the scheduled send time, so client-side queueing is not hidden. Every request
+carries a unique conversation so the classification cache does not short-cut
+the LLM call.
+
+Prints (or writes with --output) a JSON report with p50/p95/p99 latency,
+throughput and error rates per load level. With --baseline, levels are compared
+against a previous report and the exit status is 1 on regression.
+
+Usage:
+    python tests/load_test.py --rps 20 50 100 --duration 10 --concurrency 64 \
+        --latency-ms 200 --tokens-per-sec 50 --output bench.json
+    python tests/load_test.py --rps 50 --baseline bench.json --max-regression 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.fake_ollama import add_arguments, free_port
+
+SAMPLE_TEXTS = [
+    "Where is my order? It was supposed to arrive yesterday.",
+    "I was charged twice on my bill this month, please fix it.",
+    "My internet keeps dropping every evening since the upgrade.",
+    "I want to cancel my subscription and get a refund.",
+    "Thanks for the quick help with my account yesterday!",
+]
+
+
+def make_request(index, run_id):
+    """A unique two-tweet conversation (unique text defeats the result cache)."""
+    text = SAMPLE_TEXTS[index % len(SAMPLE_TEXTS)]
+    return {
+        "conversation_number": f"{run_id}-{index}",
+        "tweets": [
+            {"tweet_id": 2 * index, "author_id": "customer", "role": "Customer", "inbound": True,
+             "created_at": "Tue Oct 31 21:45:10 +0000 2017", "text": f"@support {text} (ref {run_id}-{index})"},
+            {"tweet_id": 2 * index + 1, "author_id": "support", "role": "Service Provider", "inbound": False,
+             "created_at": "Tue Oct 31 21:47:10 +0000 2017", "text": "Sorry to hear that, please DM us."},
+        ],
+    }
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(rps, duration, concurrency, results, wall):
+    """Per-level report from (latency_seconds, outcome) pairs; outcome is a status code or exception name."""
+    latencies = sorted(latency * 1000 for latency, outcome in results if outcome == 200)
+    errors = {}
+    for _, outcome in results:
+        if outcome != 200:
+            errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+    sent = len(results)
+    ok = len(latencies)
+    return {
+        "target_rps": rps,
+        "duration_s": duration,
+        "concurrency": concurrency,
+        "sent": sent,
+        "ok": ok,
+        "errors": errors,
+        "error_rate": round((sent - ok) / sent, 4) if sent else 0.0,
+        "throughput_rps": round(ok / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": _round(percentile(latencies, 50)),
+            "p95": _round(percentile(latencies, 95)),
+            "p99": _round(percentile(latencies, 99)),
+            "max": _round(latencies[-1] if latencies else None),
+            "mean": _round(sum(latencies) / ok if ok else None),
+        },
+    }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+async def run_level(app_url, rps, duration, concurrency, arrival="constant", timeout=60.0, seed=None):
+    """Drives POST /classify at `rps` for `duration` seconds; returns the level summary."""
+    import httpx
+    rng = random.Random(seed)
+    run_id = uuid.uuid4().hex[:8]
+    loop = asyncio.get_running_loop()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=timeout) as client:
+        async def one(index, scheduled):
+            try:
+                response = await client.post("/classify", json=make_request(index, run_id))
+                outcome = response.status_code
+            except Exception as e:
+                outcome = type(e).__name__
+            return loop.time() - scheduled, outcome
+
+        tasks = []
+        started = loop.time()
+        offset = 0.0
+        for index in range(max(1, int(rps * duration))):
+            scheduled = started + offset
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(index, scheduled)))
+            offset += rng.expovariate(rps) if arrival == "poisson" else 1.0 / rps
+        results = await asyncio.gather(*tasks)
+        wall = loop.time() - started
+    return summarize(rps, duration, concurrency, results, wall)
+
+
+def run_benchmark(app_url, levels, duration, concurrency, arrival="constant", seed=None):
+    return [
+        asyncio.run(run_level(app_url, rps, duration, concurrency, arrival=arrival, seed=seed))
+        for rps in levels
+    ]
+
+
+def compare(report, baseline, max_regression):
+    """
+    Returns regressions of `report` against `baseline` (levels matched by
+    target_rps): p95/p99 latency or throughput worse by more than
+    max_regression (relative), or a higher error rate.
+    """
+    regressions = []
+    previous = {level["target_rps"]: level for level in baseline.get("levels", [])}
+    for level in report["levels"]:
+        old = previous.get(level["target_rps"])
+        if not old:
+            continue
+        for pct in ("p95", "p99"):
+            new_value, old_value = level["latency_ms"][pct], old["latency_ms"][pct]
+            if new_value and old_value and new_value > old_value * (1 + max_regression):
+                regressions.append(f"{level['target_rps']} rps: {pct} {old_value} -> {new_value} ms")
+        if old["throughput_rps"] and level["throughput_rps"] < old["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{level['target_rps']} rps: throughput {old['throughput_rps']} -> {level['throughput_rps']}")
+        if level["error_rate"] > old["error_rate"] + 0.01:
+            regressions.append(f"{level['target_rps']} rps: error rate {old['error_rate']} -> {level['error_rate']}")
+    return regressions
+
+
+def _wait_for_port(port, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with {process.returncode} before listening on {port}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Timed out waiting for port {port}")
+
+
+def _wait_for_ready(app_url, process, timeout=60.0):
+    """Polls /readyz until the app has finished warming up."""
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with {process.returncode} before becoming ready")
+        try:
+            if httpx.get(f"{app_url}/readyz", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {app_url}/readyz")
+
+
+def _fake_ollama_args(args):
+    return [
+        "--latency-ms", str(args.latency_ms), "--latency-dist", args.latency_dist, "--jitter", str(args.jitter),
+        "--tokens-per-sec", str(args.tokens_per_sec), "--error-rate", str(args.error_rate),
+    ] + (["--seed", str(args.seed)] if args.seed is not None else [])
+
+
+def start_stack(args):
+    """Starts fake Ollama and the API as subprocesses; returns (app_url, processes)."""
+    ollama_port, app_port = free_port(), free_port()
+    ollama = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "tests", "fake_ollama.py"), "--port", str(ollama_port)]
+        + _fake_ollama_args(args)
+    )
+    env = dict(
+        os.environ,
+        OLLAMA_ENDPOINT=f"http://127.0.0.1:{ollama_port}",
+        OLLAMA_MODEL="fake",
+        CACHE_ENABLED="true" if args.cache else "false",
+        LOG_LEVEL=args.log_level,
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env,
+    )
+    processes = [ollama, app]
+    try:
+        _wait_for_port(ollama_port, ollama)
+        _wait_for_port(app_port, app)
+        _wait_for_ready(f"http://127.0.0.1:{app_port}", app)
+    except Exception:
+        stop_stack(processes)
+        raise
+    return f"http://127.0.0.1:{app_port}", processes
+
+
+def stop_stack(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Open-loop load test for POST /classify")
+    parser.add_argument("--rps", type=float, nargs="+", default=[10.0], help="target request rates (one level each)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    parser.add_argument("--concurrency", type=int, default=64, help="max client connections")
+    parser.add_argument("--arrival", choices=("constant", "poisson"), default="constant")
+    parser.add_argument("--app-url", help="drive an already running server instead of starting one")
+    parser.add_argument("--cache", action="store_true", help="leave the classification cache enabled")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for the started server")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    processes = []
+    app_url = args.app_url
+    if not app_url:
+        app_url, processes = start_stack(args)
+    try:
+        levels = run_benchmark(app_url, args.rps, args.duration, args.concurrency, arrival=args.arrival, seed=args.seed)
+    finally:
+        stop_stack(processes)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "app_url": args.app_url,
+        "fake_ollama": None if args.app_url else {
+            "latency_ms": args.latency_ms, "latency_dist": args.latency_dist, "jitter": args.jitter,
+            "tokens_per_sec": args.tokens_per_sec, "error_rate": args.error_rate,
+        },
+        "arrival": args.arrival,
+        "levels": levels,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        report["regressions"] = regressions
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
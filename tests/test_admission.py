@@ -0,0 +1,77 @@
+"""
+test_admission.py
+Tests for admission control and load shedding.
+"""
+
+import asyncio
+from unittest.mock import patch
+from admission import QUEUE_FULL_ERROR, QUEUE_TIMEOUT_ERROR, AdmissionController, priority_class
+
+def test_priority_class_aliases():
+    assert priority_class("Live") == "interactive"
+    assert priority_class("backfill") == "batch"
+    assert priority_class(None) == "default"
+    assert priority_class("urgent!!") == "default"
+
+def test_queue_full_is_shed_and_queued_request_admitted_on_release():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+        assert await controller.acquire() is None
+        queued = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert await controller.acquire() == {"error": QUEUE_FULL_ERROR}
+        controller.release()
+        assert await queued is None
+        return controller.stats()
+    assert asyncio.run(run())["in_flight"] == 1
+
+def test_interactive_request_displaces_backfill():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=5)
+        await controller.acquire()
+        order = []
+        async def wait(name, priority):
+            result = await controller.acquire(priority)
+            order.append((name, result))
+        first = asyncio.ensure_future(wait("batch-1", "batch"))
+        second = asyncio.ensure_future(wait("batch-2", "batch"))
+        await asyncio.sleep(0)
+        live = asyncio.ensure_future(wait("live", "interactive"))
+        await asyncio.sleep(0)
+        controller.release()
+        await asyncio.sleep(0)
+        controller.release()
+        await asyncio.gather(first, second, live)
+        return order
+    assert asyncio.run(run()) == [("batch-2", {"error": QUEUE_FULL_ERROR}), ("live", None), ("batch-1", None)]
+
+def test_queue_wait_deadline():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=0.05)
+        await controller.acquire()
+        result = await controller.acquire()
+        return result, controller.stats()
+    result, stats = asyncio.run(run())
+    assert result == {"error": QUEUE_TIMEOUT_ERROR}
+    assert stats["queued"] == 0
+
+def test_saturated_server_returns_429_with_retry_after(monkeypatch):
+    import httpx
+    from main import app
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setenv("ADMISSION_MAX_IN_FLIGHT", "1")
+    monkeypatch.setenv("ADMISSION_MAX_QUEUE", "0")
+    async def slow_llm(messages, num_predict=None, schema=None):
+        await asyncio.sleep(0.2)
+        return {"categorization": "Order", "intent": "Order Status", "topic": "Orders", "sentiment": "Neutral"}
+    def request(n):
+        return {"conversation_number": str(n), "messages": [{"sender": "customer", "text": f"Admission order {n}?"}]}
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(*[client.post("/classify", json=request(n)) for n in range(2)])
+    with patch("llm_wrapper.ollama_classify_async", side_effect=slow_llm):
+        responses = asyncio.run(run())
+    assert sorted(r.status_code for r in responses) == [200, 429]
+    shed = next(r for r in responses if r.status_code == 429)
+    assert int(shed.headers["Retry-After"]) >= 1
+    assert shed.json() == {"error": QUEUE_FULL_ERROR}
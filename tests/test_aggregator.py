@@ -47,3 +47,47 @@ def test_multiple_missing_texts():
     }
     result = aggregate_conversation(request_json)
     assert "Missing text" in result["error"]
+
+def long_thread():
+    turns = [{"sender": "customer", "text": "My phone was charged twice for the same plan."}]
+    for i in range(30):
+        turns.append({"sender": "agent", "text": f"Agent reply {i}: please DM us your account details so we can check."})
+        turns.append({"sender": "customer", "text": f"Customer follow-up {i}: still waiting."})
+    turns.append({"sender": "agent", "text": "The refund has been issued."})
+    return {"conversation_number": "900", "messages": turns}
+
+def test_short_thread_is_not_windowed():
+    result = aggregate_conversation(long_thread(), budget=100000)
+    assert result["truncation"] is None
+
+def test_long_thread_is_windowed_to_budget():
+    from aggregator import estimate_tokens
+    result = aggregate_conversation(long_thread(), budget=120)
+    text = result["aggregated_text"]
+    assert text.startswith("My phone was charged twice")
+    assert text.endswith("Customer follow-up 29: still waiting. The refund has been issued.")
+    assert "turns omitted ...]" in text
+    assert estimate_tokens(text) <= 130
+    truncation = result["truncation"]
+    assert truncation["omitted_turns"] > 0
+    assert truncation["kept_turns"] + truncation["omitted_turns"] == 62
+    # Customer turns are kept before older agent turns
+    assert text.count("Customer follow-up") > text.count("Agent reply")
+
+def test_budget_per_model(monkeypatch):
+    from aggregator import token_budget
+    monkeypatch.setenv("AGGREGATE_TOKEN_BUDGETS", "llama3=1500, mistral=3000")
+    monkeypatch.setenv("AGGREGATE_TOKEN_BUDGET", "900")
+    assert token_budget("llama3:8b") == 1500
+    assert token_budget("mistral") == 3000
+    assert token_budget("phi3") == 900
+
+def test_response_records_truncation(monkeypatch):
+    from unittest.mock import patch
+    from api import classify_conversation
+    monkeypatch.setenv("AGGREGATE_TOKEN_BUDGET", "120")
+    llm = {"categorization": "Double charge", "intent": "Account/Billing", "topic": "Payments", "sentiment": "Negative"}
+    with patch("llm_wrapper.ollama_classify", return_value=llm) as mock_llm:
+        response = classify_conversation(long_thread())
+    assert response["truncation"]["omitted_turns"] > 0
+    assert "turns omitted" in mock_llm.call_args[0][0][-1]["content"]
@@ -0,0 +1,130 @@
+"""
+test_backends.py
+Tests for multi-backend routing, circuit breaking, failover and hedging,
+using local stub Ollama servers.
+"""
+
+import asyncio
+import time
+import pytest
+from backends import CLOSED, HALF_OPEN, OPEN, BackendPool, get_backend_pool
+from metrics import REGISTRY
+from tests.fake_ollama import FakeOllamaConfig, ServerThread, create_app, free_port
+
+MESSAGES = [{"role": "user", "content": "Customer Query:\nWhere is my order?\nReturn ONLY JSON:"}]
+
+@pytest.fixture
+def stub():
+    servers = []
+    def start(**config):
+        server = ServerThread(create_app(FakeOllamaConfig(**config))).start()
+        servers.append(server)
+        return server.url
+    yield start
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def backends_env(monkeypatch):
+    monkeypatch.setenv("OLLAMA_MODEL", "fake")
+    def configure(*urls, **env):
+        monkeypatch.setenv("OLLAMA_ENDPOINTS", ",".join(urls))
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+    return configure
+
+def dead_url():
+    return f"http://127.0.0.1:{free_port()}"
+
+def run_async(coro_fn):
+    import llm_wrapper
+    async def run():
+        try:
+            return await coro_fn()
+        finally:
+            await llm_wrapper.close_async_client()
+    return asyncio.run(run())
+
+def counter_value(name):
+    # Read without registering: get-or-create here would define the metric with empty help text
+    counter = REGISTRY.get(name)
+    return counter.value() if counter else 0
+
+def test_least_outstanding_routing():
+    pool = BackendPool(["http://a", "http://b", "http://c"])
+    first, second, third = pool.acquire(), pool.acquire(), pool.acquire()
+    assert len({first.url, second.url, third.url}) == 3
+    pool.release(second, True, 0.1)
+    assert pool.acquire() is second
+
+def test_breaker_opens_and_recovers_through_half_open():
+    pool = BackendPool(["http://a"], failure_threshold=2, reset_timeout=0.05)
+    backend = pool.backends[0]
+    for _ in range(2):
+        pool.release(pool.acquire(), False)
+    assert backend.state == OPEN
+    assert pool.acquire() is None
+    time.sleep(0.06)
+    trial = pool.acquire()
+    assert trial is backend and backend.state == HALF_OPEN
+    # Only one trial request while half-open
+    assert pool.acquire() is None
+    pool.release(trial, True, 0.1)
+    assert backend.state == CLOSED
+
+def test_sync_failover_to_healthy_backend(stub, backends_env):
+    from llm_wrapper import ollama_classify
+    backends_env(dead_url(), stub(latency_ms=1))
+    failovers = counter_value("llm_failovers_total")
+    for _ in range(3):
+        assert "intent" in ollama_classify(MESSAGES)
+    assert counter_value("llm_failovers_total") > failovers
+    dead = get_backend_pool().backends[0]
+    assert dead.failures >= 1
+
+def test_async_failover_on_http_errors(stub, backends_env):
+    from llm_wrapper import ollama_classify_async
+    backends_env(stub(latency_ms=1, error_rate=1.0), stub(latency_ms=1), OLLAMA_BREAKER_FAILURES=2)
+    results = run_async(lambda: asyncio.gather(*[ollama_classify_async(MESSAGES) for _ in range(4)]))
+    assert all("intent" in r for r in results)
+    assert get_backend_pool().backends[0].state == OPEN
+
+def test_all_backends_down_is_a_connectivity_error(backends_env):
+    from llm_wrapper import ollama_classify_async
+    backends_env(dead_url(), dead_url())
+    result = run_async(lambda: ollama_classify_async(MESSAGES))
+    assert result == {"error": "LLM connectivity error"}
+
+def test_read_timeout(stub, backends_env):
+    from llm_wrapper import ollama_classify_async
+    backends_env(stub(latency_ms=2000), OLLAMA_READ_TIMEOUT=0.2)
+    started = time.perf_counter()
+    result = run_async(lambda: ollama_classify_async(MESSAGES))
+    assert result == {"error": "LLM request timed out"}
+    assert time.perf_counter() - started < 1.5
+
+def test_hedged_request_wins_on_second_backend(stub, backends_env):
+    from llm_wrapper import ollama_classify_async
+    backends_env(stub(latency_ms=3000), stub(latency_ms=1), OLLAMA_HEDGE_PERCENTILE=95)
+    pool = get_backend_pool()
+    pool._latencies.extend([0.05] * pool.hedge_min_samples)
+    hedged = counter_value("llm_hedged_requests_total")
+    started = time.perf_counter()
+    result = run_async(lambda: ollama_classify_async(MESSAGES))
+    assert "intent" in result
+    assert time.perf_counter() - started < 1.5
+    assert counter_value("llm_hedged_requests_total") == hedged + 1
+    # The losing request was cancelled without tripping its breaker
+    assert [b.outstanding for b in pool.backends] == [0, 0]
+    assert pool.backends[0].failures == 0
+
+def test_health_probe_takes_unreachable_backend_out(stub):
+    import httpx
+    pool = BackendPool([dead_url(), stub()])
+    async def probe():
+        async with httpx.AsyncClient() as client:
+            await pool.probe(client, timeout=0.5)
+    asyncio.run(probe())
+    assert [b.healthy for b in pool.backends] == [False, True]
+    assert pool.acquire() is pool.backends[1]
+    assert pool.acquire(exclude=[pool.backends[1]]) is None
@@ -0,0 +1,99 @@
+"""
+test_batch.py
+Tests for batch classification and the /classify/batch endpoint.
+"""
+
+import asyncio
+import json
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from main import app
+
+mock_llm_response = {"intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}
+
+def conversation(number, text="Where is my order?"):
+    return {
+        "conversation_number": str(number),
+        "messages": [{"sender": "customer", "text": text}]
+    }
+
+def test_batch_list_streams_ndjson_with_inline_errors():
+    async def mock_llm(messages):
+        return mock_llm_response
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            body = [conversation(1), {"conversation_number": "2"}, conversation(3)]
+            response = client.post("/classify/batch", json=body)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = {r["index"]: r for r in map(json.loads, response.text.splitlines())}
+    assert records[0]["status_code"] == 200
+    assert records[0]["result"]["classification"]["intent"] == "Order Status"
+    assert records[1]["status_code"] == 400
+    assert "Invalid input" in records[1]["error"]
+    assert records[2]["conversation_number"] == "3"
+
+def test_batch_ndjson_input():
+    async def mock_llm(messages):
+        return mock_llm_response
+    lines = "\n".join([json.dumps(conversation(1)), "not json", json.dumps(conversation(2))])
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            response = client.post(
+                "/classify/batch",
+                content=lines,
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+    records = sorted(map(json.loads, response.text.splitlines()), key=lambda r: r["index"])
+    assert [r["status_code"] for r in records] == [200, 400, 200]
+
+def test_batch_rejects_non_list_body():
+    with TestClient(app) as client:
+        response = client.post("/classify/batch", json={"conversation_number": "1"})
+    assert response.status_code == 400
+
+def test_classify_batch_completion_order_and_concurrency_limit():
+    from batch import classify_batch
+    in_flight = 0
+    peak = 0
+    async def mock_llm(messages):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        # First conversation is the slowest
+        slow = "slow" in messages[-1]["content"]
+        await asyncio.sleep(0.05 if slow else 0.01)
+        in_flight -= 1
+        return mock_llm_response
+    async def items():
+        yield 0, conversation(0, "slow order")
+        for i in range(1, 6):
+            yield i, conversation(i, f"Where is order {i}?")
+    async def run():
+        return [r async for r in classify_batch(items(), concurrency=2)]
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        records = asyncio.run(run())
+    assert len(records) == 6
+    assert records[0]["index"] != 0
+    assert peak == 2
+
+def test_classify_batch_fans_out_near_duplicates():
+    from batch import classify_batch
+    calls = []
+    async def mock_llm(messages, num_predict=None, schema=None):
+        calls.append(messages[-1]["content"])
+        await asyncio.sleep(0.01)
+        return mock_llm_response
+    async def items():
+        yield 0, conversation(0, "@sprintcare where is my order #1234? https://t.co/a")
+        yield 1, conversation(1, "My bill is wrong")
+        yield 2, conversation(2, "@Sprintcare Where is my order #98? https://t.co/b *QB")
+    async def run():
+        return [r async for r in classify_batch(items(), concurrency=1)]
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        records = {r["index"]: r for r in asyncio.run(run())}
+    assert len(calls) == 2
+    assert records[2]["status_code"] == 200
+    assert records[2]["result"]["classification"] == mock_llm_response
+    assert records[2]["result"]["dedup"] == {"cluster": 0, "representative": "0"}
+    assert "dedup" not in records[1]["result"]
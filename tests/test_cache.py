@@ -0,0 +1,118 @@
+"""
+test_cache.py
+Tests for the classification cache.
+"""
+
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+from cache import ClassificationCache, cache_key, get_cache
+from api import classify_conversation
+
+classification = {"intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}
+
+def test_cache_key_normalizes_whitespace_and_includes_model_and_prompt():
+    key = cache_key("Where is  my\norder?", "llama3", "v1")
+    assert key == cache_key(" Where is my order? ", "llama3", "v1")
+    assert key != cache_key("Where is my order?", "mistral", "v1")
+    assert key != cache_key("Where is my order?", "llama3", "v2")
+
+def test_lru_eviction_and_ttl():
+    cache = ClassificationCache(max_entries=2, ttl_seconds=0.05)
+    cache.put("a", classification)
+    cache.put("b", classification)
+    cache.get("a")
+    cache.put("c", classification)
+    assert cache.get("b") is None
+    assert cache.get("a") == classification
+    time.sleep(0.06)
+    assert cache.get("c") is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["expirations"] == 1
+
+def test_errors_are_not_cached():
+    cache = ClassificationCache()
+    assert cache.get_or_compute("k", lambda: {"error": "LLM connectivity error"}) == {"error": "LLM connectivity error"}
+    assert cache.get("k") is None
+
+def test_disk_tier_survives_restart(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = ClassificationCache(db_path=db_path)
+    cache.put("k", classification)
+    cache.close()
+    restarted = ClassificationCache(db_path=db_path)
+    assert restarted.get("k") == classification
+    assert restarted.stats()["disk_hits"] == 1
+
+def test_async_disk_tier_reads_off_the_loop(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = ClassificationCache(db_path=db_path, flush_seconds=60)
+    for i in range(3):
+        cache.put(f"k{i}", classification)
+    assert cache.flush()
+    cache.close()
+    restarted = ClassificationCache(db_path=db_path)
+    threads = []
+    get_disk = restarted._get_disk
+    def tracked(key):
+        threads.append(threading.get_ident())
+        return get_disk(key)
+    restarted._get_disk = tracked
+    async def compute():
+        raise AssertionError("served from disk")
+    async def run():
+        return await restarted.get_or_compute_async("k1", compute), threading.get_ident()
+    value, loop_thread = asyncio.run(run())
+    assert value == classification
+    assert threads and loop_thread not in threads
+    assert restarted.stats()["disk_hits"] == 1
+    restarted.close()
+
+def test_single_flight_threads():
+    cache = ClassificationCache()
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return classification
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("k", compute))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [classification] * 5
+    assert cache.stats()["coalesced"] == 4
+
+def test_single_flight_async():
+    cache = ClassificationCache()
+    calls = []
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return classification
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute_async("k", compute) for _ in range(5)])
+    assert asyncio.run(run()) == [classification] * 5
+    assert len(calls) == 1
+
+def test_api_serves_repeated_conversation_from_cache(monkeypatch):
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    request_json = {
+        "conversation_number": "1",
+        "messages": [{"sender": "customer", "text": "Where is my order?"}]
+    }
+    with patch("llm_wrapper.ollama_classify", return_value=classification) as mock_llm:
+        first = classify_conversation(request_json)
+        second = classify_conversation(dict(request_json, conversation_number="2"))
+    assert mock_llm.call_count == 1
+    assert second["conversation_number"] == "2"
+    assert second["classification"] == first["classification"]
+    assert get_cache().stats()["hits"] == 1
+
+def test_cache_disabled(monkeypatch):
+    monkeypatch.setenv("CACHE_ENABLED", "false")
+    assert get_cache() is None
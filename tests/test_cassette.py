@@ -0,0 +1,72 @@
+"""
+test_cassette.py
+Tests for LLM record/replay cassettes.
+"""
+
+import json
+import pytest
+from cassette import Cassette, get_cassette, request_key, reset_cassette
+from error_handler import status_code_for_error
+from llm_wrapper import ollama_classify
+
+LLM_RESULT = {"categorization": "Late order", "intent": "Order Status", "topic": "Orders", "sentiment": "Neutral"}
+MESSAGES = [{"role": "user", "content": "Customer Query:\nWhere is my order?\nReturn ONLY JSON:"}]
+
+class StreamResponse:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def raise_for_status(self):
+        pass
+    def iter_lines(self):
+        yield json.dumps({"message": {"content": json.dumps(LLM_RESULT)}, "done": True, "eval_count": 20}).encode()
+
+@pytest.fixture
+def llm(monkeypatch, tmp_path):
+    calls = []
+    def mock_post(url, json, timeout, stream):
+        calls.append(json)
+        return StreamResponse()
+    monkeypatch.setattr("requests.post", mock_post)
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setenv("LLM_CASSETTE_PATH", str(tmp_path / "cassette.jsonl"))
+    return calls
+
+def test_record_then_replay(llm, monkeypatch, tmp_path):
+    monkeypatch.setenv("LLM_MODE", "record")
+    assert ollama_classify(MESSAGES) == LLM_RESULT
+    assert ollama_classify(MESSAGES) == LLM_RESULT
+    assert len(llm) == 1
+    assert get_cassette().stats()["recorded"] == 1
+    reset_cassette()
+    monkeypatch.setenv("LLM_MODE", "replay")
+    assert ollama_classify(MESSAGES) == LLM_RESULT
+    assert len(llm) == 1
+    assert get_cassette().stats()["hits"] == 1
+
+def test_replay_miss_is_reported_and_never_calls_ollama(llm, monkeypatch):
+    monkeypatch.setenv("LLM_MODE", "replay")
+    result = ollama_classify(MESSAGES)
+    assert result["error"].startswith("LLM cassette miss: llama3|")
+    assert status_code_for_error(result["error"]) == 404
+    assert llm == []
+    assert get_cassette().stats()["misses"] == 1
+
+def test_live_mode_has_no_cassette(monkeypatch):
+    monkeypatch.delenv("LLM_MODE", raising=False)
+    assert get_cassette() is None
+
+def test_key_depends_on_model_and_request():
+    payload = {"messages": MESSAGES, "options": {"num_predict": 80}, "stream": True}
+    assert request_key("llama3", payload) == request_key("llama3", dict(payload, stream=False))
+    assert request_key("llama3", payload) != request_key("mistral", payload)
+    assert request_key("llama3", payload) != request_key("llama3", dict(payload, options={"num_predict": 90}))
+
+def test_torn_line_is_skipped_and_not_extended(tmp_path):
+    path = tmp_path / "cassette.jsonl"
+    path.write_text('{"k": "a", "v": {"intent": "Other"}}\n{"k": "b", "v": {"int')
+    cassette = Cassette(str(path), "record")
+    assert len(cassette) == 1
+    cassette.record("c", {"intent": "Complaint"})
+    assert len(Cassette(str(path), "replay")) == 2
@@ -4,7 +4,10 @@ Tests for the classifier.
 """
 
 import pytest
-from classifier import parse_classification
+from unittest.mock import patch
+from api import classify_conversation
+from classifier import extract_json, match_label, parse_classification
+from metrics import REGISTRY
 
 def test_valid_classification_dict():
     response = {
@@ -15,15 +18,17 @@ def test_valid_classification_dict():
         }
     }
     result = parse_classification(response)
-    assert result["intent"] == "Cancellation"
-    assert result["topic"] == "Subscription"
+    # Off-enum labels are mapped onto the allowed ones
+    assert result["intent"] == "Cancel Order"
+    assert result["topic"] == "Account"
     assert result["sentiment"] == "Negative"
 
 def test_valid_classification_json():
     response = '{"classification": {"intent": "Cancellation", "topic": "Subscription", "sentiment": "Negative"}}'
     result = parse_classification(response)
-    assert result["intent"] == "Cancellation"
-    assert result["topic"] == "Subscription"
+    # Off-enum labels are mapped onto the allowed ones
+    assert result["intent"] == "Cancel Order"
+    assert result["topic"] == "Account"
     assert result["sentiment"] == "Negative"
 
 def test_missing_field():
@@ -47,3 +52,61 @@ def test_empty_response():
     result = parse_classification("")
     assert "error" in result
     assert "Empty LLM response" in result["error"]
+
+def test_labels_are_matched_onto_enums():
+    assert match_label("intent", "order_status") == ("Order Status", "normalized")
+    assert match_label("sentiment", "NEGATIVE.") == ("Negative", "normalized")
+    assert match_label("topic", "Account/Billing") == ("Account", "alias")
+    assert match_label("intent", "Technical Suport") == ("Technical Support", "fuzzy")
+    assert match_label("intent", "Astrology") == (None, None)
+    assert match_label("sentiment", "Bewildered") == (None, None)
+
+def test_keys_wrappers_and_categorization_are_normalized():
+    response = [{"result": {"Intent": "Shipping", "TOPIC": "delivery", "Sentiment": "neutral", "Category": ["Late"]}}]
+    assert parse_classification(response) == {
+        "categorization": '["Late"]', "intent": "Shipping", "topic": "Shipping/Delivery", "sentiment": "Neutral",
+    }
+
+def test_fenced_and_truncated_json_is_repaired():
+    fenced = '```json\n{"intent": "Complaint", "topic": "Account", "sentiment": "Negative",}\n```'
+    assert parse_classification(fenced)["intent"] == "Complaint"
+    value, repaired = extract_json('{"categorization": "Late parcel", "intent": "Order Status", "topic": "Ship')
+    assert repaired and value == {"categorization": "Late parcel", "intent": "Order Status", "topic": "Ship"}
+    value, _ = extract_json('{"intent": "Order Status", "topic": "Shipping", "sen')
+    assert value == {"intent": "Order Status", "topic": "Shipping"}
+    assert parse_classification('{"intent": "Order Status", "topic": "Shipping", "sentiment": "Neu')["sentiment"] == "Neutral"
+
+def test_unusable_reply_gets_one_fix_followup():
+    broken = '{"intent": "Complaint", "topic": "Account"}'
+    fixed = {"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+    request = {"conversation_number": "1", "messages": [{"sender": "customer", "text": "Still locked out!"}]}
+    # Read without registering: get-or-create here would define the metric with empty help text
+    followups = REGISTRY.get("classification_followups_total")
+    fixed_before = followups.value(outcome="fixed") if followups else 0
+    with patch("llm_wrapper.ollama_classify", side_effect=[broken, fixed]) as mock:
+        response = classify_conversation(request)
+    assert response["classification"]["sentiment"] == "Negative"
+    assert mock.call_count == 2
+    assert "You repair malformed JSON." in mock.call_args_list[1].args[0][0]["content"]
+    assert REGISTRY.get("classification_followups_total").value(outcome="fixed") == fixed_before + 1
+    with patch("llm_wrapper.ollama_classify", side_effect=[broken, broken]) as mock:
+        response = classify_conversation({"conversation_number": "2", "messages": [{"sender": "customer", "text": "Hi"}]})
+    assert mock.call_count == 2
+    assert "Missing field in classification: sentiment" in response["error"]
+
+def test_unmatched_labels_fall_back_only_after_the_followup():
+    bad = {"intent": "asdfgh", "topic": "zzzz", "sentiment": "Negative"}
+    assert "Invalid intent" in parse_classification(bad)["error"]
+    fixed = {"intent": "Complaint", "topic": "Orders", "sentiment": "Negative"}
+    request = {"conversation_number": "5", "messages": [{"sender": "customer", "text": "Nonsense labels please"}]}
+    with patch("llm_wrapper.ollama_classify", side_effect=[bad, fixed]) as mock:
+        assert classify_conversation(request)["classification"]["intent"] == "Complaint"
+    assert mock.call_count == 2
+    followups = REGISTRY.get("classification_followups_total")
+    fallbacks = followups.value(outcome="fallback")
+    request = {"conversation_number": "6", "messages": [{"sender": "customer", "text": "Still nonsense labels"}]}
+    with patch("llm_wrapper.ollama_classify", side_effect=[bad, bad]) as mock:
+        classification = classify_conversation(request)["classification"]
+    assert mock.call_count == 2
+    assert (classification["intent"], classification["topic"]) == ("Other", "General")
+    assert followups.value(outcome="fallback") == fallbacks + 1
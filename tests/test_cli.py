@@ -0,0 +1,91 @@
+"""
+test_cli.py
+Tests for the bulk classify-file CLI.
+"""
+
+import io
+import json
+import os
+from unittest.mock import patch
+from cli import classify_file, load_checkpoint, normalize_conversation
+from ingest import iter_json_array
+
+mock_llm_response = {"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+
+def write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+def conversation(number):
+    return {
+        "conversation_number": number,
+        "tweets": [
+            {"tweet_id": number, "author_id": "115712", "inbound": True,
+             "created_at": "Tue Oct 31 21:45:10 +0000 2017", "text": f"@sprintcare is the worst customer service #{number}"}
+        ]
+    }
+
+def test_iter_json_array_small_chunks():
+    data = [conversation(1), conversation(2), {"n": 12345}]
+    assert list(iter_json_array(io.StringIO(json.dumps(data)), chunk_size=3)) == data
+
+def test_normalize_conversation_derives_role():
+    conv = normalize_conversation(conversation(7))
+    assert conv["conversation_number"] == "7"
+    assert conv["tweets"][0]["role"] == "Customer"
+
+def test_classify_file_appends_and_resumes(tmp_path):
+    input_path = str(tmp_path / "input.jsonl")
+    output_path = str(tmp_path / "out.jsonl")
+    write_jsonl(input_path, [conversation(1), conversation(2), conversation(3)])
+    # Conversation 1 was classified by an earlier, interrupted run
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"conversation_number": "1", "classification": mock_llm_response}) + "\n")
+        f.write('{"conversation_number": "2", "classif')
+    with patch("llm_wrapper.ollama_classify", return_value=mock_llm_response) as mock_llm:
+        # The conversations differ only in a ticket number; keep them apart to exercise resume
+        summary = classify_file(input_path, output_path, workers=2, dedup_threshold=0)
+    assert summary == {"classified": 2, "skipped": 1, "failed": 0}
+    assert mock_llm.call_count == 2
+    assert load_checkpoint(output_path) == {"1", "2", "3"}
+
+def test_classify_file_retries_then_dead_letters(tmp_path):
+    input_path = str(tmp_path / "input.json")
+    output_path = str(tmp_path / "out.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        json.dump([conversation(1)], f)
+    with patch("llm_wrapper.ollama_classify", return_value={"error": "LLM connectivity error"}) as mock_llm:
+        summary = classify_file(input_path, output_path, retries=2, backoff=0)
+    assert summary["failed"] == 1
+    assert mock_llm.call_count == 3
+    with open(output_path + ".dead.jsonl", encoding="utf-8") as f:
+        dead = [json.loads(line) for line in f]
+    assert dead[0]["conversation_number"] == "1"
+    assert dead[0]["attempts"] == 3
+    assert os.path.getsize(output_path) == 0
+
+def test_classify_file_does_not_retry_input_errors(tmp_path):
+    input_path = str(tmp_path / "input.jsonl")
+    output_path = str(tmp_path / "out.jsonl")
+    write_jsonl(input_path, [{"conversation_number": "9", "messages": []}])
+    with patch("llm_wrapper.ollama_classify", return_value=mock_llm_response) as mock_llm:
+        summary = classify_file(input_path, output_path, retries=2, backoff=0)
+    assert summary["failed"] == 1
+    assert mock_llm.call_count == 0
+
+def test_classify_file_fans_out_near_duplicates(tmp_path):
+    input_path = str(tmp_path / "input.jsonl")
+    output_path = str(tmp_path / "out.jsonl")
+    write_jsonl(input_path, [conversation(1), conversation(2), conversation(3)])
+    with patch("llm_wrapper.ollama_classify", return_value=mock_llm_response) as mock_llm:
+        summary = classify_file(input_path, output_path, workers=2)
+    assert mock_llm.call_count == 1
+    assert summary["classified"] == 3
+    assert summary["dedup"]["clusters"] == 1
+    assert summary["dedup"]["largest_cluster"] == 3
+    with open(output_path, encoding="utf-8") as f:
+        results = [json.loads(line) for line in f]
+    assert all(r["classification"] == mock_llm_response for r in results)
+    assert sorted(r["conversation_number"] for r in results) == ["1", "2", "3"]
+    assert [r["dedup"]["representative"] for r in results if "dedup" in r] == ["1", "1"]
@@ -0,0 +1,50 @@
+"""
+test_conversation.py
+Tests for the internal Conversation/Turn representation.
+"""
+
+from unittest.mock import patch
+from conversation import Conversation, Turn
+from aggregator import aggregate_conversation
+from api import classify_conversation
+
+tweets_request = {
+    "conversation_number": "7",
+    "tweets": [
+        {"tweet_id": 1, "author_id": "115712", "role": "Customer", "inbound": True,
+         "created_at": "Tue Oct 31 21:45:10 +0000 2017", "text": "@sprintcare is the worst customer service"},
+        {"tweet_id": 2, "author_id": "sprintcare", "role": "Service Provider", "inbound": False,
+         "created_at": "Tue Oct 31 21:46:24 +0000 2017", "text": "@115712 Please DM us."},
+    ]
+}
+
+def test_from_dict_maps_roles_once():
+    conversation = Conversation.from_dict(tweets_request)
+    assert [t.sender for t in conversation.turns] == ["customer", "agent"]
+    assert conversation.turns[0].tweet_id == 1
+    assert conversation.raw is tweets_request
+
+def test_from_dict_keeps_validation_errors():
+    assert Conversation.from_dict({"conversation_number": "1", "messages": []})["error"] == "Messages must be a non-empty list"
+    assert Conversation.from_dict([1])["error"] == "Invalid input: not a JSON object"
+
+def test_from_request_model():
+    from main import ConversationRequest
+    model = ConversationRequest.model_validate(tweets_request)
+    conversation = Conversation.from_request(model)
+    assert conversation.conversation_number == "7"
+    assert [t.sender for t in conversation.turns] == ["customer", "agent"]
+    assert conversation.raw["tweets"][1]["author_id"] == "sprintcare"
+
+def test_aggregate_typed_conversation_reuses_turns():
+    conversation = Conversation("1", (Turn("customer", "Hello"), Turn("agent", ""), Turn("agent", "Hi")), {})
+    result = aggregate_conversation(conversation)
+    assert result["aggregated_text"] == "Hello Hi"
+    assert result["messages"] is conversation.turns
+
+def test_response_does_not_mutate_or_copy_input():
+    with patch("llm_wrapper.ollama_classify", return_value={"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}):
+        response = classify_conversation(tweets_request)
+    assert "classification" not in tweets_request
+    assert response["tweets"] is tweets_request["tweets"]
+    assert response["classification"]["intent"] == "Complaint"
@@ -0,0 +1,75 @@
+"""
+test_conversation_state.py
+Tests for incremental re-classification of growing conversations.
+"""
+
+import asyncio
+from unittest.mock import patch
+from conversation_state import ConversationStateStore, get_state_store
+from api import classify_conversation, classify_conversation_async
+
+classification = {"categorization": "Late order", "intent": "Order Status", "topic": "Shipping", "sentiment": "Negative"}
+
+def tweet(tweet_id, role, text):
+    return {"tweet_id": tweet_id, "author_id": role, "role": role, "text": text}
+
+def thread(*tweets):
+    return {"conversation_number": "conv-1", "tweets": list(tweets)}
+
+OPENING = tweet(1, "Customer", "Where is my order?")
+REPLY = tweet(2, "Service Provider", "Sorry, please DM us your order number.")
+
+def test_store_is_bounded_lru():
+    store = ConversationStateStore(max_entries=2)
+    store.put("a", [1], classification)
+    store.put("b", [2], classification)
+    store.get("a")
+    store.put("c", [3], classification)
+    assert store.get("b") is None
+    assert store.get("a") == (frozenset({"1"}), classification)
+    assert store.stats() == {"entries": 2, "max_entries": 2, "evictions": 1}
+
+def test_agent_only_additions_skip_the_llm():
+    with patch("llm_wrapper.ollama_classify", return_value=classification) as mock:
+        classify_conversation(thread(OPENING))
+        response = classify_conversation(thread(OPENING, REPLY))
+        assert mock.call_count == 1
+    assert response["classification"] == classification
+    assert response["incremental"] == {"mode": "reused", "new_turns": 1}
+
+def test_new_customer_turns_send_compact_prompt():
+    updated = dict(classification, sentiment="Positive")
+    with patch("llm_wrapper.ollama_classify", side_effect=[classification, updated]) as mock:
+        classify_conversation(thread(OPENING, REPLY))
+        response = classify_conversation(thread(OPENING, REPLY, tweet(3, "Customer", "Got it, thanks!")))
+        prompt = mock.call_args_list[1].args[0][-1]["content"]
+    assert response["classification"]["sentiment"] == "Positive"
+    assert response["incremental"] == {"mode": "incremental", "new_turns": 1}
+    assert '"intent": "Order Status"' in prompt
+    assert "Customer: Got it, thanks!" in prompt
+    assert "Where is my order?" not in prompt
+
+def test_unrelated_thread_and_messages_format_get_full_classification():
+    with patch("llm_wrapper.ollama_classify", return_value=classification) as mock:
+        classify_conversation(thread(OPENING, REPLY))
+        # Same conversation_number but not an extension of the stored thread
+        response = classify_conversation(thread(tweet(9, "Customer", "My bill is wrong")))
+        assert "incremental" not in response
+        legacy = {"conversation_number": "conv-2", "messages": [{"sender": "customer", "text": "Hi"}]}
+        classify_conversation(legacy)
+        classify_conversation(legacy)
+        assert mock.call_count == 3
+
+def test_async_path_and_disabled_store(monkeypatch):
+    async def fake(messages, num_predict=None, schema=None):
+        return classification
+
+    with patch("llm_wrapper.ollama_classify_async", side_effect=fake) as mock:
+        asyncio.run(classify_conversation_async(thread(OPENING)))
+        response = asyncio.run(classify_conversation_async(thread(OPENING, REPLY)))
+        assert mock.call_count == 1
+        assert response["incremental"]["mode"] == "reused"
+        monkeypatch.setenv("CONVERSATION_STATE_MAX_ENTRIES", "0")
+        assert get_state_store() is None
+        asyncio.run(classify_conversation_async(thread(OPENING, REPLY)))
+        assert mock.call_count == 2
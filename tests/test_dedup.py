@@ -0,0 +1,29 @@
+"""
+test_dedup.py
+Tests for near-duplicate detection.
+"""
+
+from dedup import DedupIndex, lsh_bands, normalize_text
+
+def test_normalize_strips_handles_urls_numbers_and_signatures():
+    text = "@sprintcare My phone #12345 died AGAIN!! https://t.co/xyz ^JK *QB"
+    assert normalize_text(text) == "my phone died again"
+    assert normalize_text("@sprintcare https://t.co/x 555") == ""
+
+def test_lsh_bands_stay_at_or_below_threshold():
+    assert lsh_bands(0.8, 64) == (8, 8)
+    assert lsh_bands(0.95, 64) == (4, 16)
+
+def test_index_clusters_near_duplicates_only():
+    index = DedupIndex(threshold=0.8)
+    base = ("my internet has been down since yesterday evening and the router keeps blinking red "
+            "please send a technician as soon as possible")
+    assert index.assign(base) == (0, True)
+    assert index.assign("@support " + base.replace("yesterday", "tuesday") + " -AB") == (0, False)
+    assert index.assign("I was charged twice for my bill this month") == (1, True)
+    assert index.assign("@support 123") is None
+    stats = index.stats()
+    assert stats["clusters"] == 2
+    assert stats["duplicates"] == 1
+    assert stats["conversations"] == 4
+    assert stats["cluster_sizes"] == {"1": 1, "2-4": 1}
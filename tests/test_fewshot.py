@@ -0,0 +1,56 @@
+"""
+test_fewshot.py
+Tests for few-shot retrieval.
+"""
+
+import time
+
+from fewshot import FewShotLibrary, select_examples
+
+def _example(text, intent="Order Status", topic="Orders", sentiment="Neutral"):
+    return {"text": text, "output": {"intent": intent, "topic": topic, "sentiment": sentiment}}
+
+def test_search_ranks_by_similarity_and_skips_unrelated():
+    library = FewShotLibrary([
+        _example("Customer: My parcel is late, where is the tracking number?"),
+        _example("Customer: I was charged twice on my card", "Account/Billing", "Payments", "Negative"),
+        _example("Customer: The tracking page shows my parcel stuck in customs"),
+    ])
+    assert library.search("tracking says my parcel is stuck", k=3) == [2, 0]
+    assert library.search("hello there", k=3) == []
+    turns = library.turns("tracking says my parcel is stuck", k=3)
+    # Most similar example last, right before the query
+    assert turns[-2] == ("user", "Customer: The tracking page shows my parcel stuck in customs")
+    assert [role for role, _ in turns] == ["user", "assistant"] * 2
+
+def test_search_respects_token_budget():
+    long_text = "Customer: my parcel tracking " + "is still not updated and " * 40
+    library = FewShotLibrary([_example(long_text), _example("Customer: parcel tracking not updated")])
+    assert library.search("parcel tracking not updated", k=2, budget=60) == [1]
+    assert library.search("parcel tracking not updated", k=2, budget=10000) == [1, 0]
+
+def test_select_examples_caps_per_label_and_filters_labels():
+    allowed = {"intent": ["Order Status", "Other"], "topic": ["Orders"], "sentiment": ["Neutral"]}
+    records = [
+        {"messages": [{"sender": "customer", "text": f"Order {i} has not arrived"}],
+         "classification": {"intent": "Order Status", "topic": "Orders", "sentiment": "Neutral"}}
+        for i in range(5)
+    ]
+    records.append({"tweets": [{"role": "Customer", "text": "Order 0 has not arrived"}],
+                    "classification": {"intent": "Order Status", "topic": "Orders", "sentiment": "Neutral"}})
+    records.append({"messages": [{"sender": "customer", "text": "Weird"}],
+                    "classification": {"intent": "Unknown", "topic": "Orders", "sentiment": "Neutral"}})
+    selected = select_examples(records, allowed, per_label=3)
+    assert [example["text"] for example in selected] == [f"Customer: Order {i} has not arrived" for i in range(3)]
+
+def test_retrieval_is_fast_on_a_large_library():
+    words = [f"w{i}" for i in range(3000)]
+    examples = [_example("Customer: " + " ".join(words[(i * 7 + j * 13) % 3000] for j in range(25)))
+                for i in range(2000)]
+    library = FewShotLibrary(examples)
+    query = " ".join(words[:40])
+    library.search(query)
+    started = time.perf_counter()
+    for _ in range(100):
+        library.search(query, k=3, budget=400)
+    assert (time.perf_counter() - started) / 100 < 0.002
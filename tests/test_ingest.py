@@ -0,0 +1,84 @@
+"""
+test_ingest.py
+Tests for streaming ingestion of raw tweet dumps.
+"""
+
+import csv
+import json
+from unittest.mock import patch
+from cli import classify_file
+from ingest import build_index, iter_threads, parse_tweet_id
+
+FIELDS = ["tweet_id", "author_id", "inbound", "created_at", "text", "response_tweet_id", "in_response_to_tweet_id"]
+
+ROWS = [
+    # Reply written before the tweet it answers appears in the file; pandas-style "3.0" parent id
+    ["1", "sprintcare", "False", "Tue Oct 31 22:10:47 +0000 2017", "@115712 Please send us a DM", "2", "3.0"],
+    ["2", "115712", "True", "Tue Oct 31 22:11:45 +0000 2017", "@sprintcare Sent!", "", "1"],
+    ["3", "115712", "True", "Tue Oct 31 22:08:27 +0000 2017", "@sprintcare No one is\nresponding", "1", ""],
+    ["3", "115712", "True", "Tue Oct 31 22:08:27 +0000 2017", "duplicate row", "", ""],
+    ["not-an-id", "x", "True", "", "bad row", "", ""],
+    ["8", "115713", "True", "Tue Oct 31 22:00:00 +0000 2017", "@AppleSupport my phone is slow", "", ""],
+    ["9", "AppleSupport", "False", "Tue Oct 31 22:05:00 +0000 2017", "@115713 Which iOS version?", "", "7"],
+]
+
+def write_csv(path):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        writer.writerows(ROWS)
+    return str(path)
+
+def test_parse_tweet_id():
+    assert parse_tweet_id("8.0") == 8
+    assert parse_tweet_id(12) == 12
+    assert parse_tweet_id("") is None
+    assert parse_tweet_id("abc") is None
+
+def test_csv_threads_are_reconstructed_in_order(tmp_path):
+    path = write_csv(tmp_path / "tweets.csv")
+    stats = {}
+    threads = {t["conversation_number"]: t for t in iter_threads(path, stats=stats)}
+    assert set(threads) == {"3", "8", "9"}
+    thread = threads["3"]["tweets"]
+    assert [t["tweet_id"] for t in thread] == [3, 1, 2]
+    assert [t["role"] for t in thread] == ["Customer", "Service Provider", "Customer"]
+    assert thread[0]["text"] == "@sprintcare No one is\nresponding"
+    assert stats["skipped"] == 1 and stats["duplicates"] == 1
+    assert stats["threads"] == 3 and stats["authors"] == 4
+
+def test_min_tweets_drops_short_threads(tmp_path):
+    path = write_csv(tmp_path / "tweets.csv")
+    stats = {}
+    threads = list(iter_threads(path, min_tweets=2, stats=stats))
+    assert [t["conversation_number"] for t in threads] == ["3"]
+    assert stats["dropped_threads"] == 2
+
+def test_jsonl_without_inbound_uses_root_author(tmp_path):
+    path = tmp_path / "tweets.jsonl"
+    records = [
+        {"tweet_id": 10, "author_id": "cust", "text": "@help my card was declined"},
+        {"tweet_id": 11, "author_id": "help", "text": "@cust Sorry about that", "in_response_to_tweet_id": 10},
+        {"tweet_id": 12, "author_id": "cust", "text": "@help still broken", "in_response_to_tweet_id": 11},
+    ]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records), encoding="utf-8")
+    (thread,) = iter_threads(str(path))
+    assert [t["role"] for t in thread["tweets"]] == ["Customer", "Service Provider", "Customer"]
+    index = build_index(str(path))
+    assert list(index.roots) == [0, 0, 0]
+
+def test_json_array_feeds_classify_file(tmp_path):
+    path = tmp_path / "tweets.json"
+    path.write_text(json.dumps([
+        {"tweet_id": 20, "author_id": "a", "inbound": True, "text": "@shop where is my parcel"},
+        {"tweet_id": 21, "author_id": "shop", "inbound": False, "text": "@a It ships today", "in_response_to_tweet_id": 20},
+    ]), encoding="utf-8")
+    output = str(tmp_path / "out.jsonl")
+    response = {"intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}
+    with patch("llm_wrapper.ollama_classify", return_value=response):
+        summary = classify_file(str(path), output, workers=1, raw_tweets=True)
+    assert summary["classified"] == 1
+    with open(output, encoding="utf-8") as f:
+        (result,) = [json.loads(line) for line in f]
+    assert result["conversation_number"] == "20"
+    assert result["classification"]["intent"] == "Order Status"
@@ -23,7 +23,9 @@ def test_full_workflow_success(mock_llm):
     response = classify_conversation(valid_request)
     assert response["conversation_number"] == "1001"
     assert "classification" in response
-    assert response["classification"]["intent"] == "TBD" or response["classification"]["intent"] == "Cancellation"
+    # Off-enum labels are mapped onto the allowed ones
+    assert response["classification"]["intent"] == "Cancel Order"
+    assert response["classification"]["topic"] == "Account"
 
 # Edge case: missing messages
 @patch("llm_wrapper.ollama_classify", return_value=mock_llm_response)
@@ -39,3 +41,14 @@ def test_llm_error_propagation(mock_llm):
     response = classify_conversation(valid_request)
     # Should propagate error from LLM wrapper
     assert "error" in response or "classification" in response
+
+# Async path: awaitable classify_conversation variant
+def test_full_workflow_async_success():
+    import asyncio
+    async def mock_llm(messages):
+        return mock_llm_response
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        from api import classify_conversation_async
+        response = asyncio.run(classify_conversation_async(valid_request))
+    assert response["conversation_number"] == "1001"
+    assert response["classification"]["sentiment"] == "Negative"
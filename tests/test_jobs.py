@@ -0,0 +1,117 @@
+"""
+test_jobs.py
+Tests for the asynchronous job API and its persistent queue.
+"""
+
+import time
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from jobs import JobStore, get_job_store
+from main import app
+
+mock_llm_response = {"intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}
+
+def conversation(number, text="Where is my order?"):
+    return {"conversation_number": str(number), "messages": [{"sender": "customer", "text": text}]}
+
+async def mock_llm(messages, num_predict=None, schema=None):
+    return mock_llm_response
+
+def test_job_is_accepted_and_long_polled_to_completion():
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            response = client.post("/jobs", json=[conversation(1), {"conversation_number": "2"}, conversation(3)])
+            assert response.status_code == 202
+            job_id = response.json()["job_id"]
+            assert response.headers["location"] == f"/jobs/{job_id}"
+            job = client.get(f"/jobs/{job_id}", params={"wait": 5}).json()
+    assert job["status"] == "completed"
+    assert (job["total"], job["done"], job["failed"]) == (3, 3, 1)
+    assert job["priority"] == "batch"
+    assert [r["status_code"] for r in job["results"]] == [200, 400, 200]
+    assert job["results"][0]["result"]["classification"]["intent"] == "Order Status"
+
+def test_single_conversation_and_unknown_job():
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            response = client.post("/jobs", json=conversation(1), headers={"X-Priority": "interactive"})
+            job = client.get(f"/jobs/{response.json()['job_id']}", params={"wait": 5}).json()
+            assert job["priority"] == "interactive"
+            assert job["results"][0]["conversation_number"] == "1"
+            assert client.get("/jobs/nope").status_code == 404
+            assert client.post("/jobs", json=[]).status_code == 400
+
+def test_running_items_are_requeued_after_restart():
+    store = get_job_store()
+    job_id = store.submit([(conversation(1), None), (conversation(2), None)])
+    # A previous process claimed an item and died before finishing it
+    assert store.claim().index == 0
+    restarted = JobStore(store.db_path)
+    # Still leased: the owner may be another live process on the same database
+    assert restarted.recover() == 0
+    assert restarted.recover(now=time.time() + store.lease_seconds + 1) == 1
+    assert restarted.queue_depth() == 2
+    restarted.close()
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            job = client.get(f"/jobs/{job_id}", params={"wait": 5}).json()
+    assert job["status"] == "completed" and job["done"] == 2
+
+def test_overload_is_retried_and_webhook_sent(monkeypatch):
+    monkeypatch.setenv("JOB_RETRY_BACKOFF_SECONDS", "0")
+    monkeypatch.setenv("WEBHOOK_ALLOWED_HOSTS", "hooks.example")
+    calls = []
+    async def flaky(messages, num_predict=None, schema=None):
+        calls.append(1)
+        if len(calls) == 1:
+            return {"error": "LLM connectivity error: connection refused"}
+        return mock_llm_response
+    delivered = []
+    async def fake_webhook(url, payload):
+        delivered.append((url, payload))
+        return True
+    with patch("llm_wrapper.ollama_classify_async", side_effect=flaky), patch("jobs.post_webhook", fake_webhook):
+        with TestClient(app) as client:
+            body = {"conversations": [conversation(1)], "webhook_url": "http://hooks.example/done"}
+            job_id = client.post("/jobs", json=body).json()["job_id"]
+            job = client.get(f"/jobs/{job_id}", params={"wait": 5}).json()
+            for _ in range(50):
+                if delivered:
+                    break
+                time.sleep(0.01)
+    assert len(calls) == 2
+    assert job["failed"] == 0
+    assert delivered[0][0] == "http://hooks.example/done"
+    assert delivered[0][1]["job_id"] == job_id
+    assert get_job_store().undelivered_webhooks() == []
+
+def test_webhooks_to_internal_addresses_are_refused(monkeypatch):
+    monkeypatch.delenv("WEBHOOK_ALLOWED_HOSTS", raising=False)
+    with TestClient(app) as client:
+        for url in ("http://127.0.0.1:11434/api/chat", "http://169.254.169.254/latest/meta-data",
+                    "http://10.0.0.5/hook", "http://[::1]/hook", "ftp://hooks.example/"):
+            body = {"conversations": [conversation(1)], "webhook_url": url}
+            assert client.post("/jobs", json=body).status_code == 400, url
+        monkeypatch.setenv("WEBHOOK_ALLOWED_HOSTS", "hooks.example")
+        body = {"conversations": [conversation(1)], "webhook_url": "http://other.example/hook"}
+        assert "WEBHOOK_ALLOWED_HOSTS" in client.post("/jobs", json=body).json()["error"]
+
+def test_lost_lease_discards_the_late_result():
+    store = get_job_store()
+    store.submit([(conversation(1), None)])
+    item = store.claim()
+    other = JobStore(store.db_path)
+    other.recover(now=time.time() + store.lease_seconds + 1)
+    assert other.claim().index == 0
+    assert not store.complete(item, {"index": 0, "status_code": 200, "result": {}})
+    other.close()
+
+def test_timed_out_long_polls_do_not_accumulate():
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm), TestClient(app) as client:
+        from jobs import get_job_workers
+        job_id = get_job_store().submit([(conversation(1), None)])
+        # Claimed by a process that never finishes it
+        get_job_store().claim()
+        for _ in range(3):
+            assert client.get(f"/jobs/{job_id}", params={"wait": 0.05}).json()["status"] == "running"
+        assert get_job_workers()._completed == {}
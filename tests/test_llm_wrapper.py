@@ -43,3 +43,128 @@ def test_llm_timeout(monkeypatch):
     os.environ["OLLAMA_MODEL"] = "llama3"
     result = ollama_classify("Test prompt")
     assert "error" in result
+
+def test_async_llm_call_reuses_pooled_client(monkeypatch):
+    import asyncio
+    import httpx
+    import llm_wrapper
+    seen = []
+    def handler(request):
+        seen.append(request.url.path)
+        return httpx.Response(200, json={"message": {"content": '{"intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}'}})
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setattr(llm_wrapper, "_async_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    async def run():
+        client = llm_wrapper.init_async_client()
+        results = await asyncio.gather(*[llm_wrapper.ollama_classify_async([]) for _ in range(5)])
+        assert llm_wrapper.init_async_client() is client
+        await llm_wrapper.close_async_client()
+        return results
+    results = asyncio.run(run())
+    assert all(r["intent"] == "Order Status" for r in results)
+    assert seen == ["/api/chat"] * 5
+    assert llm_wrapper._async_client is None
+
+def test_async_llm_connectivity_error(monkeypatch):
+    import asyncio
+    import httpx
+    import llm_wrapper
+    def handler(request):
+        raise httpx.ConnectError("refused")
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setattr(llm_wrapper, "_async_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    result = asyncio.run(llm_wrapper.ollama_classify_async([]))
+    assert result["error"] == "LLM connectivity error"
+
+def stream_lines(pieces, done=True):
+    lines = [json.dumps({"message": {"role": "assistant", "content": p}, "done": False}) for p in pieces]
+    if done:
+        lines.append(json.dumps({"message": {"role": "assistant", "content": ""}, "done": True,
+                                 "prompt_eval_count": 30, "eval_count": len(pieces)}))
+    return lines
+
+def test_stream_reader_stops_at_balanced_object():
+    from llm_wrapper import _StreamReader
+    reader = _StreamReader(tail_chunks=1)
+    pieces = ['{"categorization": "Brace } in {text', '", "intent": "Other"', '}', '\n\n\n', 'more']
+    stopped = [reader.feed(line) for line in stream_lines(pieces, done=False)[:4]]
+    # One chunk past the balanced object without the final chunk
+    assert stopped == [False, False, False, True]
+    assert json.loads(reader.content())["intent"] == "Other"
+    assert reader.usage() == {"eval_count": 4, "estimated": True}
+
+def test_stream_reader_waits_for_final_chunk():
+    from llm_wrapper import _StreamReader
+    reader = _StreamReader()
+    stopped = [reader.feed(line) for line in stream_lines(['{"intent": "Other"}', '\n'])]
+    assert stopped == [False, False, True]
+    assert reader.content() == '{"intent": "Other"}'
+    assert reader.usage()["prompt_eval_count"] == 30 and "estimated" not in reader.usage()
+
+def test_sync_call_sends_schema_and_stops_early(monkeypatch):
+    monkeypatch.setenv("LLM_STREAM_TAIL_CHUNKS", "1")
+    from prompt_builder import CLASSIFICATION_SCHEMA, CLASSIFICATION_NUM_PREDICT
+    sent, read = {}, []
+    class StreamResponse(MockResponse):
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def iter_lines(self):
+            for line in stream_lines(['{"intent": "Complaint", ', '"topic": "Account", "sentiment": "Negative"}',
+                                      ' trailing', ' more'], done=False):
+                read.append(line)
+                yield line.encode()
+    def mock_post(url, json, timeout, stream):
+        sent.update(json)
+        return StreamResponse({})
+    monkeypatch.setattr("requests.post", mock_post)
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.delenv("LLM_NUM_PREDICT", raising=False)
+    result = ollama_classify([])
+    assert result == {"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+    assert len(read) == 3
+    assert sent["format"] == CLASSIFICATION_SCHEMA
+    assert sent["stream"] is True
+    assert sent["options"]["num_predict"] == CLASSIFICATION_NUM_PREDICT < 700
+
+def test_async_stream_records_usage_of_final_chunk(monkeypatch):
+    import asyncio
+    import httpx
+    import llm_wrapper
+    from metrics import REGISTRY
+    def handler(request):
+        body = "\n".join(stream_lines(['{"intent": "Other", "topic": "General", "sentiment": "Neutral"', '}', '\n'])) + "\n"
+        return httpx.Response(200, content=body.encode())
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setattr(llm_wrapper, "_async_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    # Read without registering: get-or-create here would define the metrics with test help text and buckets
+    counter, histogram = REGISTRY.get("llm_early_stops_total"), REGISTRY.get("llm_prompt_eval_tokens")
+    stops = counter.value() if counter else 0
+    evaluated = histogram.count() if histogram else 0
+    result = asyncio.run(llm_wrapper.ollama_classify_async([]))
+    assert result["topic"] == "General"
+    # The final chunk after the object was read, so Ollama's counts were recorded
+    assert REGISTRY.get("llm_prompt_eval_tokens").count() == evaluated + 1
+    counter = REGISTRY.get("llm_early_stops_total")
+    assert (counter.value() if counter else 0) == stops
+
+def test_preload_model_keeps_model_resident(monkeypatch):
+    import asyncio
+    import httpx
+    import llm_wrapper
+    bodies = []
+    def handler(request):
+        bodies.append((request.url.host, json.loads(request.content)))
+        if request.url.host == "down":
+            return httpx.Response(500)
+        return httpx.Response(200, json={"model": "llama3", "done": True, "done_reason": "load"})
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setenv("OLLAMA_KEEP_ALIVE", "30m")
+    monkeypatch.setenv("OLLAMA_ENDPOINTS", "http://up:11434,http://down:11434")
+    monkeypatch.setattr(llm_wrapper, "_async_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    assert asyncio.run(llm_wrapper.preload_model_async()) is None
+    assert sorted(host for host, _ in bodies) == ["down", "up"]
+    assert bodies[0][1] == {"model": "llama3", "messages": [], "keep_alive": "30m"}
+    monkeypatch.setenv("OLLAMA_ENDPOINTS", "http://down:11434")
+    assert "could not preload" in asyncio.run(llm_wrapper.preload_model_async())["error"]
@@ -0,0 +1,33 @@
+"""
+test_load_test.py
+Smoke test for the fake Ollama server and the open-loop load generator.
+"""
+
+import asyncio
+from tests.fake_ollama import FakeOllamaConfig, ServerThread, create_app
+from tests.load_test import compare, percentile, run_level
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) is None
+
+def test_load_generator_against_real_app(monkeypatch):
+    from main import app
+    monkeypatch.setenv("OLLAMA_MODEL", "fake")
+    monkeypatch.setenv("CACHE_ENABLED", "false")
+    with ServerThread(create_app(FakeOllamaConfig(latency_ms=5, error_rate=0.0, seed=1))) as ollama:
+        monkeypatch.setenv("OLLAMA_ENDPOINT", ollama.url)
+        with ServerThread(app) as api:
+            level = asyncio.run(run_level(api.url, rps=20, duration=0.5, concurrency=4))
+    assert level["sent"] == 10
+    assert level["ok"] == 10, level["errors"]
+    assert level["error_rate"] == 0.0
+    assert 0 < level["latency_ms"]["p50"] <= level["latency_ms"]["p99"]
+
+def test_compare_flags_latency_regression():
+    level = {"target_rps": 10, "latency_ms": {"p95": 100, "p99": 150}, "throughput_rps": 10, "error_rate": 0.0}
+    slower = dict(level, latency_ms={"p95": 200, "p99": 150})
+    assert compare({"levels": [slower]}, {"levels": [level]}, 0.2) == ["10 rps: p95 100 -> 200 ms"]
+    assert compare({"levels": [level]}, {"levels": [level]}, 0.2) == []
@@ -0,0 +1,69 @@
+"""
+test_local_classifier.py
+Tests for the local pre-classifier and the classification cascade.
+"""
+
+import json
+from unittest.mock import patch
+from local_classifier import LocalClassifier, features, train_from_files
+from api import classify_conversation
+
+negative_billing = {"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+order_status = {"intent": "Order Status", "topic": "Shipping/Delivery", "sentiment": "Neutral"}
+
+examples = (
+    [(f"@sprintcare is the worst customer service, overcharged again {i}", negative_billing) for i in range(20)]
+    + [(f"Where is my order? It has not arrived yet {i}", order_status) for i in range(20)]
+)
+
+def result_record(text, classification):
+    return {"conversation_number": "1", "messages": [{"sender": "customer", "text": text}], "classification": classification}
+
+def test_features_ignore_handles_and_urls():
+    assert features("@sprintcare hello https://t.co/x", 1024) == features("hello", 1024)
+
+def test_predicts_with_confidence():
+    model = LocalClassifier()
+    assert model.train(examples) == 40
+    classification, confidence = model.predict("@delta worst customer service ever, overcharged")
+    assert classification == negative_billing
+    assert confidence > 0.9
+    _, low = model.predict("hello there")
+    assert low < confidence
+
+def test_save_and_load_round_trip(tmp_path):
+    model = LocalClassifier(buckets=4096)
+    model.train(examples)
+    path = str(tmp_path / "model.json")
+    model.save(path)
+    loaded = LocalClassifier.load(path)
+    assert loaded.predict("where is my order")[0] == model.predict("where is my order")[0]
+
+def test_train_from_results_skips_labels_outside_options(tmp_path):
+    path = tmp_path / "classified_results_1.json"
+    records = [result_record(text, c) for text, c in examples]
+    records.append(result_record("cancel it", {"intent": "Cancellation", "topic": "Subscription", "sentiment": "Negative"}))
+    path.write_text(json.dumps(records))
+    model, used = train_from_files([str(path)])
+    assert used == 41
+    assert "Cancellation" not in model.fields["intent"]["docs"]
+    assert model.fields["sentiment"]["docs"]["Negative"] == 21
+
+def test_cascade_skips_llm_when_confident(tmp_path, monkeypatch):
+    model = LocalClassifier()
+    model.train(examples)
+    path = str(tmp_path / "model.json")
+    model.save(path)
+    monkeypatch.setenv("CASCADE_MODEL_PATH", path)
+    monkeypatch.setenv("CASCADE_THRESHOLD", "0.9")
+    request_json = {"conversation_number": "5", "messages": [{"sender": "customer", "text": "Where is my order? Not arrived"}]}
+    with patch("llm_wrapper.ollama_classify", return_value=negative_billing) as mock_llm:
+        response = classify_conversation(request_json)
+        assert mock_llm.call_count == 0
+        assert response["cascade"]["tier"] == "local"
+        assert response["classification"] == order_status
+        # An unfamiliar conversation escalates to the LLM
+        monkeypatch.setenv("CASCADE_THRESHOLD", "1.01")
+        escalated = classify_conversation(dict(request_json, conversation_number="6"))
+        assert mock_llm.call_count == 1
+        assert escalated["cascade"]["tier"] == "llm"
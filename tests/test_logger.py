@@ -14,3 +14,43 @@ def test_logger_info(caplog):
     with caplog.at_level(logging.INFO):
         logger.info("Test info log")
         assert "Test info log" in caplog.text
+
+def test_background_json_logging_with_structured_fields():
+    import io
+    import json
+    from logger import configure_logging, flush_logging, shutdown_logging
+    stream = io.StringIO()
+    configure_logging(level="INFO", stream=stream, fmt="json")
+    try:
+        logger.info("Classified conversation %s", "42",
+                    extra={"conversation_number": "42", "timings": {"llm": 12.5}})
+        flush_logging()
+    finally:
+        shutdown_logging()
+    record = json.loads(stream.getvalue().splitlines()[-1])
+    assert record["message"] == "Classified conversation 42"
+    assert record["conversation_number"] == "42"
+    assert record["timings"] == {"llm": 12.5}
+
+def test_log_payload_is_free_when_debug_disabled():
+    from logger import log_payload
+    class Payload:
+        rendered = False
+        def __str__(self):
+            Payload.rendered = True
+            return "payload"
+    logger.setLevel(logging.INFO)
+    log_payload("Sending messages to Ollama", Payload())
+    assert Payload.rendered is False
+
+def test_log_payload_truncates(caplog, monkeypatch):
+    from logger import log_payload
+    monkeypatch.setenv("LOG_PAYLOAD_MAX_CHARS", "10")
+    previous = logger.level
+    logger.setLevel(logging.DEBUG)
+    try:
+        with caplog.at_level(logging.DEBUG):
+            log_payload("Raw LLM response", {"content": "x" * 100})
+    finally:
+        logger.setLevel(previous)
+    assert "[truncated" in caplog.text
@@ -0,0 +1,47 @@
+"""
+test_metrics.py
+Tests for the metrics registry and the /metrics endpoint.
+"""
+
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from metrics import Registry, render_prometheus
+
+def test_render_prometheus_text_format():
+    registry = Registry()
+    registry.counter("jobs_total", "Jobs", ("kind",)).inc(2, kind='a"b')
+    registry.gauge("queue_depth", "Queued items").set(3)
+    registry.histogram("work_seconds", "Work", buckets=(0.1, 1.0)).observe(0.5)
+    text = render_prometheus(registry)
+    assert '# TYPE jobs_total counter\njobs_total{kind="a\\"b"} 2\n' in text
+    assert "queue_depth 3\n" in text
+    assert 'work_seconds_bucket{le="0.1"} 0\n' in text
+    assert 'work_seconds_bucket{le="1.0"} 1\n' in text
+    assert 'work_seconds_bucket{le="+Inf"} 1\n' in text
+    assert "work_seconds_sum 0.5\nwork_seconds_count 1\n" in text
+
+def test_metrics_endpoint_exports_stages_errors_and_llm_usage(monkeypatch):
+    from main import app
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    llm_result = {"categorization": "Late order", "intent": "Order Status", "topic": "Orders", "sentiment": "Neutral"}
+    async def mock_llm(messages, num_predict=None, schema=None):
+        from llm_wrapper import _record_usage
+        _record_usage({"prompt_eval_count": 12, "eval_count": 30, "eval_duration": 250_000_000})
+        return llm_result
+    request = {"conversation_number": "m1", "messages": [{"sender": "customer", "text": "Where is my metrics order?"}]}
+    with TestClient(app) as client:
+        with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+            assert client.post("/classify", json=request).status_code == 200
+        with patch("llm_wrapper.ollama_classify_async", return_value={"error": "LLM connectivity error"}):
+            request["messages"][0]["text"] = "Another metrics order?"
+            assert client.post("/classify", json=request).status_code == 502
+        response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    for stage in ("validate", "aggregate", "build_prompt", "llm", "parse"):
+        assert f'classify_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'classify_errors_total{category="llm_unavailable",status_code="502"}' in text
+    assert 'llm_duration_seconds_count{phase="eval"}' in text
+    assert 'llm_tokens_total{kind="generated"}' in text
+    assert "http_requests_in_flight 1" in text  # the /metrics request itself
+    assert 'http_request_seconds_count{path="/classify",status_code="200"}' in text
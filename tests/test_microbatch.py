@@ -0,0 +1,105 @@
+"""
+test_microbatch.py
+Tests for micro-batching of LLM calls.
+"""
+
+import asyncio
+from unittest.mock import patch
+from microbatch import MicroBatcher, demultiplex
+from prompt_builder import build_batch_prompt, build_prompt
+
+def classification(intent="Order Status"):
+    return {"intent": intent, "topic": "Shipping", "sentiment": "Neutral"}
+
+def submit_all(batcher_kwargs, texts):
+    async def run():
+        batcher = MicroBatcher(**batcher_kwargs)
+        results = await asyncio.gather(*[
+            batcher.submit(str(i), text, build_prompt(str(i), text)["messages"])
+            for i, text in enumerate(texts)
+        ])
+        return batcher, results
+    return asyncio.run(run())
+
+def test_build_batch_prompt_lists_every_conversation(monkeypatch):
+    import prompt_builder
+    monkeypatch.setattr(prompt_builder, "FEWSHOT_LIBRARY", None)
+    messages = build_batch_prompt([("1", "Where is my order?"), ("2", "Internet down")])["messages"]
+    single = build_prompt("1", "Where is my order?")["messages"]
+    assert messages[:-1] == single[:-1]
+    assert 'Conversation "1"' in messages[-1]["content"]
+    assert 'Conversation "2"' in messages[-1]["content"]
+
+def test_demultiplex_skips_malformed_entries():
+    from metrics import REGISTRY
+    def parsed():
+        counter = REGISTRY.get("classifications_parsed_total")
+        return sum(value for _, _, value in counter.samples()) if counter else 0
+    before = parsed()
+    response = {"classifications": [
+        dict(classification(), conversation_number="1"),
+        {"conversation_number": "2", "intent": "Other"},
+        classification(),
+    ]}
+    assert demultiplex(response) == {"1": classification()}
+    # Entries are parsed (and counted) once, when each response is built
+    assert parsed() == before
+
+def test_concurrent_requests_share_one_llm_call():
+    calls = []
+    async def mock_llm(messages, num_predict=None, schema=None):
+        calls.append(messages)
+        content = messages[-1]["content"]
+        entries = [dict(classification(), conversation_number=str(i)) for i in range(3) if f'Conversation "{i}"' in content]
+        return {"classifications": entries}
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        batcher, results = submit_all({"max_size": 3, "max_wait_ms": 1000}, ["a", "b", "c"])
+    assert len(calls) == 1
+    assert results == [classification()] * 3
+    assert batcher.stats()["batches"] == 1
+
+def test_missing_entries_fall_back_to_single_calls():
+    single_calls = []
+    async def mock_llm(messages, num_predict=None, schema=None):
+        content = messages[-1]["content"]
+        if content.startswith("Classify each"):
+            # Only the first conversation comes back
+            return {"classifications": [dict(classification(), conversation_number="0")]}
+        single_calls.append(content)
+        return classification("Complaint")
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        batcher, results = submit_all({"max_size": 8, "max_wait_ms": 5}, ["a", "b"])
+    assert results[0]["intent"] == "Order Status"
+    assert results[1]["intent"] == "Complaint"
+    assert len(single_calls) == 1
+    assert batcher.stats()["fallbacks"] == 1
+
+def test_backend_errors_are_not_retried_per_item():
+    calls = []
+    async def mock_llm(messages, num_predict=None, schema=None):
+        calls.append(1)
+        return {"error": "LLM connectivity error"}
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        _, results = submit_all({"max_size": 2, "max_wait_ms": 1000}, ["a", "b"])
+    assert len(calls) == 1
+    assert all(r == {"error": "LLM connectivity error"} for r in results)
+
+def test_api_uses_microbatcher_when_enabled(monkeypatch):
+    from api import classify_conversation_async
+    monkeypatch.setenv("MICROBATCH_ENABLED", "true")
+    monkeypatch.setenv("MICROBATCH_MAX_WAIT_MS", "5")
+    calls = []
+    async def mock_llm(messages, num_predict=None, schema=None):
+        calls.append(num_predict)
+        content = messages[-1]["content"]
+        return {"classifications": [dict(classification(), conversation_number=n) for n in ("10", "11") if f'"{n}"' in content]}
+    requests_json = [
+        {"conversation_number": n, "messages": [{"sender": "customer", "text": f"Where is order {n}?"}]}
+        for n in ("10", "11")
+    ]
+    async def run():
+        return await asyncio.gather(*[classify_conversation_async(r) for r in requests_json])
+    with patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        responses = asyncio.run(run())
+    assert len(calls) == 1
+    assert [r["classification"]["intent"] for r in responses] == ["Order Status"] * 2
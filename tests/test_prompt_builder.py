@@ -25,3 +25,49 @@ def test_error_handling():
     # Simulate error by passing None (should not raise exception)
     result = build_prompt(None, None)
     assert "error" in result
+
+@pytest.fixture
+def static_prompts(monkeypatch):
+    """prompt_builder re-imported with the static few-shot prefix (no retrieval)."""
+    import importlib
+    import prompt_builder
+    with monkeypatch.context() as m:
+        m.setenv("FEWSHOT_RETRIEVAL", "false")
+        m.delenv("FEWSHOT_LIBRARY_PATH", raising=False)
+        yield importlib.reload(prompt_builder)
+    importlib.reload(prompt_builder)
+
+def test_prompt_prefix_is_byte_stable(static_prompts):
+    import json
+    first = static_prompts.build_prompt("1", "Where is my order?")["messages"]
+    second = static_prompts.build_prompt("2", "My internet is down.")["messages"]
+    prefix_len = len(static_prompts.PROMPT_PREFIX)
+    assert json.dumps(first[:prefix_len], ensure_ascii=False).encode("utf-8") == static_prompts.PROMPT_PREFIX_BYTES
+    assert json.dumps(second[:prefix_len], ensure_ascii=False).encode("utf-8") == static_prompts.PROMPT_PREFIX_BYTES
+    assert len(first) == prefix_len + 1
+    assert first[-1] == {"role": "user", "content": "Customer Query:\nWhere is my order?\nReturn ONLY JSON:"}
+    assert len(static_prompts.PROMPT_VERSION) == 16
+
+def test_prompt_prefix_cannot_be_mutated_by_callers(static_prompts):
+    import json
+    messages = static_prompts.build_prompt("1", "Where is my order?")["messages"]
+    messages[0]["content"] = "changed"
+    again = static_prompts.build_prompt("1", "Where is my order?")["messages"]
+    assert json.dumps(again[:-1], ensure_ascii=False).encode("utf-8") == static_prompts.PROMPT_PREFIX_BYTES
+
+def test_fewshots_retrieved_for_the_conversation(monkeypatch):
+    import prompt_builder
+    from fewshot import FewShotLibrary
+    library = FewShotLibrary([
+        {"text": "My router keeps blinking red", "output": {"intent": "Technical Support"}},
+        {"text": "Refund for a broken blender", "output": {"intent": "Return/Refund"}},
+        {"text": "The router reboots every hour", "output": {"intent": "Technical Support"}},
+    ])
+    monkeypatch.setattr(prompt_builder, "FEWSHOT_LIBRARY", library)
+    messages = prompt_builder.build_prompt("1", "router blinking again")["messages"]
+    prefix_len = len(prompt_builder.PROMPT_PREFIX)
+    # Only the two similar examples, the most similar right before the query, after the shared prefix
+    assert [m["content"] for m in messages[prefix_len:-1:2]] == [
+        "The router reboots every hour", "My router keeps blinking red"]
+    assert all(m["role"] == "assistant" for m in messages[prefix_len + 1:-1:2])
+    assert len(messages) == prefix_len + 5
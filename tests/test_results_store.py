@@ -0,0 +1,54 @@
+"""
+test_results_store.py
+Tests for the persistent results store and the /stats endpoint.
+"""
+
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from api import classify_conversation
+from main import app
+from results_store import ResultsStore, get_results_store, parse_time
+
+DAY = 86400
+MONDAY = parse_time("2026-10-12T09:30:00")
+
+def label(intent, topic, sentiment):
+    return {"intent": intent, "topic": topic, "sentiment": sentiment}
+
+def test_rollups_answer_grouped_and_filtered_queries(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.db"), flush_seconds=0.01)
+    store.record("1", label("Complaint", "Shipping", "Negative"), 100.0, created_at=MONDAY)
+    store.record("2", label("Complaint", "Shipping", "Negative"), 300.0, created_at=MONDAY + 60)
+    store.record("3", label("Order Status", "Shipping", "Neutral"), None, source="dedup", created_at=MONDAY + DAY)
+    store.record("4", label("Complaint", "Billing", "Negative"), 50.0, created_at=MONDAY - 7 * DAY)
+    assert store.flush()
+    week = store.stats(since=MONDAY, group_by=["intent"], filters={"topic": "Shipping"})
+    assert week["total"] == 3
+    assert week["groups"] == [
+        {"intent": "Complaint", "count": 2, "avg_latency_ms": 200.0},
+        {"intent": "Order Status", "count": 1, "avg_latency_ms": None},
+    ]
+    days = store.stats(group_by=["day"], filters={"sentiment": "Negative"})
+    assert [(g["day"][:10], g["count"]) for g in sorted(days["groups"], key=lambda g: g["day"])] == [
+        ("2026-10-05", 1), ("2026-10-12", 2)]
+    assert store.results_for("3")[0]["source"] == "dedup"
+    store.close()
+    # Rollups persist across restarts
+    reopened = ResultsStore(str(tmp_path / "results.db"))
+    assert reopened.stats()["total"] == 4
+    reopened.close()
+
+def test_classifications_are_recorded_and_served_by_stats():
+    response = {"intent": "Complaint", "topic": "Account", "sentiment": "Negative"}
+    with patch("llm_wrapper.ollama_classify", return_value=response):
+        classify_conversation({"conversation_number": "9", "messages": [{"sender": "customer", "text": "Locked out"}]})
+    get_results_store().flush()
+    with TestClient(app) as client:
+        stats = client.get("/stats", params={"group_by": "intent,sentiment", "topic": "Account"}).json()
+        assert stats["total"] == 1
+        assert stats["groups"][0] == {"intent": "Complaint", "sentiment": "Negative", "count": 1,
+                                      "avg_latency_ms": stats["avg_latency_ms"]}
+        stored = client.get("/results/9").json()["results"]
+        assert stored[0]["intent"] == "Complaint" and stored[0]["source"] == "llm"
+        assert client.get("/stats", params={"group_by": "author"}).status_code == 400
+        assert client.get("/stats", params={"since": "last week"}).status_code == 400
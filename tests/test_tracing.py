@@ -0,0 +1,109 @@
+"""
+test_tracing.py
+Tests for per-request tracing and the sampling CPU profiler.
+"""
+
+import json
+import os
+import threading
+from unittest.mock import patch
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+from profiler import capture_profile
+from tracing import export_trace, span, start_trace, traced
+
+@pytest.fixture
+def trace_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("TRACE_DIR", str(tmp_path / "traces"))
+    monkeypatch.setenv("TRACE_SAMPLE_RATE", "0")
+    return tmp_path / "traces"
+
+def test_traced_request_exports_span_tree(trace_dir, monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    async def fake_llm(messages, num_predict=None, schema=None):
+        return {"intent": "Complaint", "topic": "Orders", "sentiment": "Negative"}
+    body = {"conversation_number": "77", "tweets": [
+        {"tweet_id": 1, "author_id": "a", "role": "Customer", "inbound": True, "created_at": "", "text": "Package lost, traced"},
+        {"tweet_id": 2, "author_id": "b", "role": "Service Provider", "inbound": False, "created_at": "", "text": "Sorry!"},
+    ]}
+    with patch("llm_wrapper.ollama_classify_async", fake_llm), TestClient(app) as client:
+        untraced = client.post("/classify", json=dict(body, conversation_number="78"))
+        no_token = client.post("/classify", json=dict(body, conversation_number="79"), headers={"X-Trace": "1"})
+        response = client.post("/classify", json=body, headers={"X-Trace": "1", "X-Admin-Token": "secret"})
+    assert "X-Trace-Id" not in untraced.headers
+    assert "X-Trace-Id" not in no_token.headers and no_token.status_code == 200
+    trace_id = response.headers["X-Trace-Id"]
+    assert sorted(p.name for p in trace_dir.iterdir()) == [f"{trace_id}.otlp.json", f"{trace_id}.trace.json"]
+
+    spans = json.loads((trace_dir / f"{trace_id}.otlp.json").read_text())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    by_name = {s["name"]: s for s in spans}
+    parent = lambda name: next(s["name"] for s in spans if s["spanId"] == by_name[name]["parentSpanId"])
+    assert parent("classify_conversation") == "main.classify"
+    assert parent("aggregate_conversation") == "classify_conversation"
+    assert parent("build_prompt") == "classify_conversation"
+    assert parent("parse_classification") == "classify_conversation"
+    attributes = {a["key"]: a["value"] for a in by_name["aggregate_conversation"]["attributes"]}
+    assert attributes["turns"] == {"intValue": "2"}
+    assert "prompt_chars" in {a["key"] for a in by_name["build_prompt"]["attributes"]}
+
+    events = json.loads((trace_dir / f"{trace_id}.trace.json").read_text())["traceEvents"]
+    complete = [e for e in events if e["ph"] == "X"]
+    assert {e["name"] for e in complete} == set(by_name)
+    root = next(e for e in complete if e["name"] == "main.classify")
+    assert all(root["ts"] <= e["ts"] and e["ts"] + e["dur"] <= root["ts"] + root["dur"] + 1 for e in complete)
+
+def test_spans_are_free_outside_a_trace(trace_dir):
+    calls = []
+    @traced("work", lambda result, x: {"x": x})
+    def work(x):
+        calls.append(x)
+        return {"error": "boom"} if x < 0 else x
+    with span("outside") as outside:
+        assert outside is None
+    assert work(1) == 1
+    with start_trace("root") as root:
+        work(-1)
+    failed = next(s for s in root.trace.spans if s.name == "work")
+    assert failed.error == "boom" and failed.attributes == {"x": -1} and failed.parent_id == root.span_id
+    assert calls == [1, -1]
+
+def test_trace_dir_keeps_newest_files(trace_dir, monkeypatch):
+    monkeypatch.setenv("TRACE_MAX_FILES", "4")
+    ids = []
+    for i in range(3):
+        with start_trace("root", defer_export=True) as root:
+            pass
+        assert not trace_dir.exists() or len(list(trace_dir.iterdir())) == 2 * i
+        export_trace(root.trace)
+        ids.append(root.trace.trace_id)
+        # Distinct modification times for the oldest-first pruning
+        for path in trace_dir.iterdir():
+            if path.name.startswith(root.trace.trace_id):
+                os.utime(path, ns=(i * 10**9, i * 10**9))
+    assert sorted(p.name.split(".")[0] for p in trace_dir.iterdir()) == sorted(ids[1:] * 2)
+
+def test_profiler_samples_busy_threads(monkeypatch):
+    stop = threading.Event()
+    def spin_for_profiler():
+        while not stop.is_set():
+            sum(range(1000))
+    worker = threading.Thread(target=spin_for_profiler)
+    worker.start()
+    try:
+        profiler, duration = capture_profile(0.2, interval=0.002)
+    finally:
+        stop.set()
+        worker.join()
+    assert duration >= 0.2 and profiler.samples > 0
+    assert any("spin_for_profiler" in line for line in profiler.folded())
+    assert any(f["function"].startswith("spin_for_profiler") for f in profiler.top_functions())
+
+def test_admin_profile_requires_token(monkeypatch):
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    with TestClient(app) as client:
+        assert client.get("/admin/profile", params={"seconds": 0.05}).status_code == 403
+        monkeypatch.setenv("ADMIN_TOKEN", "secret")
+        assert client.get("/admin/profile", params={"seconds": 0.05}, headers={"X-Admin-Token": "nope"}).status_code == 403
+        profile = client.get("/admin/profile", params={"seconds": 0.05}, headers={"X-Admin-Token": "secret"}).json()
+        assert profile["samples"] + profile["idle_samples"] > 0
@@ -0,0 +1,58 @@
+"""
+test_warmup.py
+Tests for startup warm-up and the health/readiness endpoints.
+"""
+
+import asyncio
+import time
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from warmup import Readiness, warm_up
+
+classification = {"categorization": "Late order", "intent": "Order Status", "topic": "Shipping", "sentiment": "Neutral"}
+
+async def mock_llm(messages, num_predict=None, schema=None):
+    return classification
+
+def test_warm_up_retries_until_model_is_loaded(monkeypatch):
+    monkeypatch.setenv("OLLAMA_MODEL", "llama3")
+    monkeypatch.setenv("WARMUP_RETRY_SECONDS", "0.01")
+    async def preload():
+        preload.calls += 1
+        return {"error": "LLM connectivity error: could not preload model llama3"} if preload.calls == 1 else None
+    preload.calls = 0
+    readiness = Readiness()
+    with patch("llm_wrapper.preload_model_async", side_effect=preload), \
+            patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm) as llm:
+        asyncio.run(warm_up(readiness))
+    assert readiness.ready
+    assert readiness.attempts == 2
+    assert llm.call_count == 1
+    assert set(readiness.phases) == {"resolve", "preload", "synthetic_classification"}
+    assert readiness.time_to_ready > 0
+
+def test_readyz_turns_ready_after_warm_up(monkeypatch):
+    from main import app
+    monkeypatch.setenv("WARMUP_ENABLED", "true")
+    monkeypatch.setenv("OLLAMA_HEALTH_INTERVAL", "0")
+    gate = {"open": False}
+    async def preload():
+        return None if gate["open"] else {"error": "LLM connectivity error: could not preload model"}
+    monkeypatch.setenv("WARMUP_RETRY_SECONDS", "0.01")
+    with patch("llm_wrapper.preload_model_async", side_effect=preload), \
+            patch("llm_wrapper.ollama_classify_async", side_effect=mock_llm):
+        with TestClient(app) as client:
+            assert client.get("/healthz").json() == {"status": "ok"}
+            response = client.get("/readyz")
+            assert response.status_code == 503
+            assert not response.json()["ready"]
+            gate["open"] = True
+            deadline = time.monotonic() + 5
+            while client.get("/readyz").status_code != 200 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            body = client.get("/readyz").json()
+            metrics = client.get("/metrics").text
+    assert body["ready"]
+    assert body["time_to_ready_seconds"] > 0
+    assert "imports" in body["phases_ms"]
+    assert "startup_time_to_ready_seconds" in metrics
@@ -0,0 +1,309 @@
+"""
+tracing.py
+Opt-in per-request tracing of the classification pipeline.
+
+A /classify request is traced when it carries `X-Trace: 1` together with a
+valid X-Admin-Token, or is picked by TRACE_SAMPLE_RATE (default 0). A traced request records a tree of spans
+(main.classify > classify_conversation > aggregate_conversation, build_prompt,
+admission, ollama_classify, parse_classification) with their sizes: turn
+count, prompt characters, estimated and Ollama-reported tokens. When the
+request finishes, the trace is written to TRACE_DIR (default
+$WORKING_DIR/traces) in the formats listed in TRACE_FORMATS (default both):
+
+  - chrome: <trace_id>.trace.json, Chrome trace events for chrome://tracing or Perfetto;
+  - otlp:   <trace_id>.otlp.json, an OTLP/JSON ExportTraceServiceRequest.
+
+The trace id is returned in the X-Trace-Id response header. Only the newest
+TRACE_MAX_FILES (default 1000) trace files are kept in TRACE_DIR.
+
+The current span lives in a context variable, so spans follow the request
+across awaits, tasks and asyncio.to_thread. Untraced calls of an instrumented
+function cost one context variable lookup.
+"""
+
+import functools
+import inspect
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from logger import logger
+from metrics import REGISTRY
+
+FORMATS = ("chrome", "otlp")
+SERVICE_NAME = "customer-support-query-classification"
+# OTLP status codes
+_STATUS_UNSET = 0
+_STATUS_ERROR = 2
+
+_current = ContextVar("trace_span", default=None)
+
+
+def trace_sample_rate():
+    return float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+
+
+def trace_dir():
+    return os.getenv("TRACE_DIR") or os.path.join(os.getenv("WORKING_DIR", "./data"), "traces")
+
+
+def trace_formats():
+    requested = (part.strip().lower() for part in os.getenv("TRACE_FORMATS", "chrome,otlp").split(","))
+    return [fmt for fmt in requested if fmt in FORMATS]
+
+
+def trace_max_files():
+    return int(os.getenv("TRACE_MAX_FILES", "1000"))
+
+
+def should_trace(header=None):
+    """
+    True when the X-Trace header asks for a trace or the request is sampled.
+    Callers pass the header only when the request may ask for a trace.
+    """
+    if header is not None and header.strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    rate = trace_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "thread_id", "attributes", "error")
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.thread_id = threading.get_ident()
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.end_ns = None
+        self.start_ns = time.perf_counter_ns()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    """The finished spans of one request; times are perf_counter ns, anchored to wall time at the start."""
+
+    def __init__(self):
+        self.trace_id = _new_id(128)
+        self.wall_ns = time.time_ns()
+        self.perf_ns = time.perf_counter_ns()
+        self.spans = []
+        self.closed = False
+
+    def add(self, span):
+        # Work that outlives the request (a shared micro-batch call) is not recorded after export
+        if not self.closed:
+            self.spans.append(span)
+
+    def _unix_ns(self, perf_ns):
+        return self.wall_ns + perf_ns - self.perf_ns
+
+    def to_chrome(self):
+        """Chrome trace event format: complete ("X") events in microseconds."""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": SERVICE_NAME}}]
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            args = dict(span.attributes)
+            if span.error is not None:
+                args["error"] = span.error
+            events.append({
+                "name": span.name,
+                "cat": "classify",
+                "ph": "X",
+                "ts": self._unix_ns(span.start_ns) / 1000.0,
+                "dur": (span.end_ns - span.start_ns) / 1000.0,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"trace_id": self.trace_id}}
+
+    def to_otlp(self):
+        """OTLP/JSON ExportTraceServiceRequest (ids in hex, times as strings of Unix nanoseconds)."""
+        spans = []
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            status = {"code": _STATUS_UNSET}
+            if span.error is not None:
+                status = {"code": _STATUS_ERROR, "message": str(span.error)}
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "kind": 2 if span.parent_id is None else 1,
+                "startTimeUnixNano": str(self._unix_ns(span.start_ns)),
+                "endTimeUnixNano": str(self._unix_ns(span.end_ns)),
+                "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+                "status": status,
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+        }]}
+
+    def export(self, directory=None, formats=None):
+        """Writes the trace files; returns their paths."""
+        self.closed = True
+        directory = directory or trace_dir()
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for fmt in trace_formats() if formats is None else formats:
+            if fmt == "chrome":
+                path, data = os.path.join(directory, f"{self.trace_id}.trace.json"), self.to_chrome()
+            else:
+                path, data = os.path.join(directory, f"{self.trace_id}.otlp.json"), self.to_otlp()
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, default=str)
+            paths.append(path)
+        prune_traces(directory)
+        return paths
+
+
+def prune_traces(directory=None, max_files=None):
+    """Removes the oldest trace files beyond `max_files` (TRACE_MAX_FILES; 0 keeps all)."""
+    directory = directory or trace_dir()
+    max_files = trace_max_files() if max_files is None else max_files
+    if max_files <= 0:
+        return
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith((".trace.json", ".otlp.json")) and entry.is_file():
+                files.append((entry.stat().st_mtime_ns, entry.path))
+    if len(files) <= max_files:
+        return
+    files.sort()
+    for _, path in files[:len(files) - max_files]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def current_span():
+    return _current.get()
+
+
+def annotate(**attributes):
+    """Adds attributes (None values skipped) to the current span, if the request is traced."""
+    span = _current.get()
+    if span is not None:
+        span.attributes.update((key, value) for key, value in attributes.items() if value is not None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Child span of the current one; yields None (and records nothing) outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.end_ns = time.perf_counter_ns()
+        _current.reset(token)
+        parent.trace.add(child)
+
+
+def export_trace(trace):
+    """Writes the trace files (errors are logged, never raised to the request)."""
+    try:
+        paths = trace.export()
+        REGISTRY.counter("traces_exported_total", "Request traces written to TRACE_DIR").inc()
+        logger.info("Trace %s written to %s", trace.trace_id, ", ".join(paths), extra={"event": "trace"})
+    except OSError as e:
+        logger.error("Failed to export trace %s: %s", trace.trace_id, e)
+
+
+@contextmanager
+def start_trace(name, defer_export=False, **attributes):
+    """
+    Root span of a new trace; yields it. On exit the trace is exported,
+    unless `defer_export` leaves that to the caller (export_trace(root.trace),
+    e.g. in a thread so the event loop does not wait for the files).
+    """
+    trace = Trace()
+    root = Span(trace, name, None, attributes)
+    token = _current.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.end_ns = time.perf_counter_ns()
+        _current.reset(token)
+        trace.add(root)
+        if not defer_export:
+            export_trace(trace)
+
+
+def _finish(span, result, sizes, args, kwargs):
+    if isinstance(result, dict) and "error" in result:
+        span.error = result["error"]
+    if sizes is not None:
+        try:
+            span.attributes.update(sizes(result, *args, **kwargs))
+        except Exception as e:
+            logger.debug("Span attributes of %s failed: %s", span.name, e)
+
+
+def traced(name, sizes=None):
+    """
+    Records calls of the decorated (sync or async) function as spans named
+    `name` when the caller is traced. `sizes(result, *args, **kwargs)`, if
+    given, returns attributes for the span; an error response marks it failed.
+    """
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await func(*args, **kwargs)
+                with span(name) as current:
+                    result = await func(*args, **kwargs)
+                    _finish(current, result, sizes, args, kwargs)
+                    return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(name) as current:
+                result = func(*args, **kwargs)
+                _finish(current, result, sizes, args, kwargs)
+                return result
+        return wrapper
+    return decorate
@@ -0,0 +1,155 @@
+"""
+warmup.py
+Startup warm-up and readiness of the API server.
+
+At startup the server initializes its process-wide state (cache, backend
+pool, local classifier, conversation state) and builds one prompt from the
+precompiled prefix. It then preloads OLLAMA_MODEL on the Ollama backends,
+with OLLAMA_KEEP_ALIVE so the model stays resident, and runs one synthetic
+classification through prompt building, the LLM and parsing.
+
+/readyz answers 503 until that has succeeded (and while no backend is
+available); failed attempts are retried with exponential backoff starting at
+WARMUP_RETRY_SECONDS. WARMUP_ENABLED=false skips the warm-up. Time-to-ready,
+measured from process start, is logged and exported as a metric.
+"""
+
+import asyncio
+import os
+import time
+
+import llm_wrapper
+from backends import get_backend_pool
+from cache import get_cache
+from cassette import get_cassette
+from classifier import parse_classification
+from conversation_state import get_state_store
+from local_classifier import get_local_classifier
+from logger import logger
+from metrics import REGISTRY
+from prompt_builder import build_prompt
+
+SYNTHETIC_TEXT = "@support My order has not arrived and the tracking page shows no update. Where is it?"
+MAX_RETRY_SECONDS = 60.0
+
+_readiness = None
+
+
+def warmup_enabled():
+    return os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+class Readiness:
+    """Warm-up progress of one server process: phases (ms), attempts, last error, time to ready."""
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.ready = False
+        self.phases = {}
+        self.attempts = 0
+        self.last_error = None
+        self.time_to_ready = None
+
+    def record_phase(self, phase, started):
+        elapsed = time.perf_counter() - started
+        self.phases[phase] = round(elapsed * 1000, 3)
+        REGISTRY.gauge("startup_phase_seconds", "Duration of each startup phase", ("phase",)).set(elapsed, phase=phase)
+
+    def mark_ready(self):
+        self.ready = True
+        self.last_error = None
+        self.time_to_ready = time.perf_counter() - self.started
+        REGISTRY.gauge("startup_time_to_ready_seconds", "Seconds from process start until ready").set(
+            self.time_to_ready)
+        REGISTRY.gauge("ready", "Whether the server has finished warming up").set(1)
+        logger.info("Ready in %.2fs", self.time_to_ready, extra={"event": "ready", "timings": self.phases})
+
+    def snapshot(self):
+        return {
+            "ready": self.ready,
+            "time_to_ready_seconds": round(self.time_to_ready, 3) if self.time_to_ready is not None else None,
+            "phases_ms": dict(self.phases),
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+        }
+
+
+def start_readiness(started=None):
+    """Begins tracking readiness for this process (called at app startup)."""
+    global _readiness
+    _readiness = Readiness(started)
+    REGISTRY.gauge("ready", "Whether the server has finished warming up").set(0)
+    return _readiness
+
+
+def get_readiness():
+    return _readiness
+
+
+def resolve():
+    """Creates the process-wide singletons and builds one prompt, so the first request does not."""
+    get_cache()
+    get_backend_pool()
+    get_local_classifier()
+    get_state_store()
+    build_prompt("warmup", SYNTHETIC_TEXT)
+
+
+async def synthetic_classification():
+    """Classifies a fixed conversation straight through the LLM (no cache). Returns the classification or an error."""
+    messages = build_prompt("warmup", SYNTHETIC_TEXT)["messages"]
+    return parse_classification(await llm_wrapper.ollama_classify_async(messages))
+
+
+async def _warm_llm(readiness):
+    """One warm-up attempt against Ollama; returns None on success or an error message."""
+    cassette = get_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        # Replay never reaches Ollama: there is no model to warm
+        return None
+    started = time.perf_counter()
+    error = await llm_wrapper.preload_model_async()
+    if error is not None:
+        return error["error"]
+    readiness.record_phase("preload", started)
+    started = time.perf_counter()
+    result = await synthetic_classification()
+    if isinstance(result, dict) and "error" in result:
+        return result["error"]
+    readiness.record_phase("synthetic_classification", started)
+    return None
+
+
+async def warm_up(readiness):
+    """Runs the warm-up until it succeeds (retrying with backoff), then marks the process ready."""
+    started = time.perf_counter()
+    resolve()
+    readiness.record_phase("resolve", started)
+    delay = float(os.getenv("WARMUP_RETRY_SECONDS", "2"))
+    while True:
+        readiness.attempts += 1
+        error = await _warm_llm(readiness)
+        if error is None:
+            break
+        readiness.last_error = error
+        logger.warning("Warm-up attempt %d failed: %s; retrying in %.1fs", readiness.attempts, error, delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_SECONDS)
+    readiness.mark_ready()
+
+
+def check_ready():
+    """
+    Returns (ready, details): ready once warm-up has finished and at least one
+    Ollama backend is healthy with a closed or half-open breaker.
+    """
+    readiness = get_readiness()
+    details = readiness.snapshot() if readiness is not None else {"ready": False}
+    cassette = get_cassette()
+    backends = get_backend_pool().stats()
+    details["backends"] = backends
+    if cassette is not None and cassette.mode == "replay":
+        backend_ok = True
+    else:
+        backend_ok = any(b["healthy"] and b["state"] != "open" for b in backends)
+    return bool(details["ready"] and backend_ok), details